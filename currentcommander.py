@@ -1,23 +1,104 @@
 #!/usr/bin/python3
+import time
+# reference point of the --startup-profile timings
+startup_time = time.perf_counter()
 from os.path import expanduser, exists
 import getopt
+import os
 import sys
-import time
+import importlib
 import socket
+import queue
+import hashlib
+import contextlib
+import collections
+import json
+import re
+import base64
+import struct
+import mmap
+import csv
+import select
+import tempfile
+import shutil
+from array import array
 import configparser 
 import urwid
 import threading
-from datetime import datetime
-from pysnmp.hlapi import *
-from pysnmp.proto import rfc1902
+from datetime import datetime, timezone
 
+# The device backends are imported on first use with load_backend(), see BACKENDS.
+# pysnmp.hlapi is imported like "from pysnmp.hlapi import *"
+rfc1902 = None
 # for ANEL NetPwr REST API
-import httplib2
+httplib2 = None
 # IPMI/Redfish BMC support
-from pyghmi.ipmi import command as ipmi_command
-from pyghmi.redfish import command as redfish_command
-#from pyghmi.ipmi.command import Housekeeper
-from pyghmi.ipmi.command import Command
+ipmi_command = None
+ipmi_session = None
+# Redfish
+http_client = None
+ssl = None
+# Prometheus exporter
+http_server = None
+# control socket of the daemon
+socketserver = None
+# SNMP trap receiver, hlapi has no notification receiver
+snmp_entity_engine = None
+snmp_config = None
+snmp_udp = None
+snmp_ntfrcv = None
+
+# backend name -> list of (module, global name), '*' makes all public names of the module global
+BACKENDS = {
+    'snmp': [('pysnmp.hlapi', '*'), ('pysnmp.proto.rfc1902', 'rfc1902')],
+    'anel': [('httplib2', 'httplib2')],
+    'ipmi': [('pyghmi.ipmi.command', 'ipmi_command'), ('pyghmi.ipmi.private.session', 'ipmi_session')],
+    'redfish': [('http.client', 'http_client'), ('ssl', 'ssl')],
+    'exporter': [('http.server', 'http_server')],
+    'daemon': [('socketserver', 'socketserver')],
+    'snmp_traps': [('pysnmp.entity.engine', 'snmp_entity_engine'), ('pysnmp.entity.config', 'snmp_config'),
+                   ('pysnmp.carrier.asyncore.dgram.udp', 'snmp_udp'), ('pysnmp.entity.rfc3413.ntfrcv', 'snmp_ntfrcv')],
+}
+# backend name -> seconds spent importing it
+loaded_backends = {}
+backend_lock = threading.Lock()
+
+def load_backend(name):
+    '''
+    Imports the modules of a device backend, if they are not imported yet
+    '''
+    with backend_lock:
+        if name in loaded_backends:
+            return
+        started = time.perf_counter()
+        for module_name, global_name in BACKENDS[name]:
+            module = importlib.import_module(module_name)
+            if global_name == '*':
+                names = getattr(module, '__all__', [n for n in vars(module) if not n.startswith('_')])
+                globals().update((n, getattr(module, n)) for n in names)
+            else:
+                globals()[global_name] = module
+        loaded_backends[name] = time.perf_counter() - started
+        profile_mark('backend ' + name + ' loaded')
+
+# (name, seconds since start) of the first occurrence of each startup step
+startup_marks = []
+
+def profile_mark(name):
+    for n, t in startup_marks:
+        if n == name:
+            return
+    startup_marks.append((name, time.perf_counter() - startup_time))
+
+def startup_profile_report():
+    lines = ['startup profile, seconds since the start of the script:']
+    for name, t in startup_marks:
+        lines.append('  %8.3f  %s' % (t, name))
+    for name in loaded_backends:
+        lines.append('  backend %s: imported in %.3f s' % (name, loaded_backends[name]))
+    return '\n'.join(lines)
+
+profile_mark('modules imported')
 
 # TODO/Ideas:
 # - ATEN PDU support
@@ -25,7 +106,7 @@ from pyghmi.ipmi.command import Command
 #    - display configured outlet power on/off delays
 #    - edit outlet power on/off delays
 #    - display overcurrent protection status
-#    - power usage plot
+#    - power usage plot (history is kept in metric_history)
 # - SNMP PoE switch support
 #    - HP procurve PoE switch 2530 works
 #    - show error conditions
@@ -46,8 +127,8 @@ from pyghmi.ipmi.command import Command
 #
 # Bugs
 #
-# - fix/test presets
-# - fix error when ipmi device is not reachable 
+# - fix/test presets (fixed for ANEL, presetN entries are read from the config)
+# - fix error when ipmi device is not reachable (done, shown in the title, reconnects with backoff)
 #
 # Higher priority features
 # - create an indicator bar showing previous and next devices
@@ -63,8 +144,8 @@ from pyghmi.ipmi.command import Command
 #
 # Low priority / new features
 #
-# - reduce code duplication in SNMP device classes
-# - auto refresh
+# - reduce code duplication in SNMP device classes (done)
+# - auto refresh (done, refresh_interval config option)
 # - introduce global settings section and dialog
 #    - toggling between needs to be modified for this, because we rely on every config section being a device config
 #    - switch_on_delay (may be better as device option?)
@@ -82,7 +163,7 @@ from pyghmi.ipmi.command import Command
 # - add way to toggle view mode for ATEN PDU
 #    - mode 1: outlets, outlet details and presets 
 #    - mode 2: outlets, outlet details and power graph for PDU
-#  - use threads for all device communication - not really required, but a nice exercise
+#  - use threads for all device communication - not really required, but a nice exercise (done, DevicePoller)
 #
 # Done
 #
@@ -135,6 +216,13 @@ class ListItem(urwid.WidgetWrap):
     def __init__ (self, o):
         urwid.register_signal(self.__class__, ['item_activated'])
         self.data = o
+        self.text = self.format_outlet(o)
+        self.text_widget = urwid.Text(self.text)
+        t = urwid.AttrWrap(self.text_widget, "outlet", "outlet_selected")
+        urwid.WidgetWrap.__init__(self, t)
+
+    @staticmethod
+    def format_outlet(o):
         #name = '{:<10}{:>6s}{:>7}{:>10}{:>11}'.format(
         state = 'off'
         if o['state'] == 1:
@@ -145,12 +233,12 @@ class ListItem(urwid.WidgetWrap):
         #if 'last_off' in o:
         #    name += '{:>12s}'.format(str(o['last_off'].strftime('%H:%M:%S')))
         if 'on_delay' in o:
-            name += '{:>9s}'.format(o['on_delay'])
+            name += '{:>9d}'.format(o['on_delay'])
         if 'off_delay' in o:
-            name += '{:>10s}'.format(o['off_delay'])
+            name += '{:>10d}'.format(o['off_delay'])
         for column in ['voltage', 'current', 'power', 'powerDissipation']:
             if column in o:
-                name += '{:>8.2f}'.format(float(o[column]))
+                name += '{:>8.2f}'.format(o[column])
         if 'type' in o:
             name += '{:<14s}'.format(o['type'])
         if 'mac_addrs' in o:
@@ -158,14 +246,31 @@ class ListItem(urwid.WidgetWrap):
                 name += '{:>18s}'.format(o['mac_addrs'][0])
             else:
                 name += '{:>18s}'.format(' ')
+        if 'ip_addrs' in o:
+            if len(o['ip_addrs']) > 0:
+                name += '  {:<15s}'.format(o['ip_addrs'][0])
+            else:
+                name += '  {:<15s}'.format(' ')
+        if 'rx_bps' in o or 'tx_bps' in o:
+            for column in ['rx_bps', 'tx_bps']:
+                if column in o:
+                    name += '{:>9s}'.format(format_bps(o[column]))
+                else:
+                    name += '{:>9s}'.format(' ')
       
         if 'bootdev' in o:
             name += '{:>18s}'.format(o['bootdev'])
         
-        self.text = name
-        text = urwid.Text(name)
-        t = urwid.AttrWrap(text, "outlet", "outlet_selected")
-        urwid.WidgetWrap.__init__(self, t)
+        return name
+
+    def update(self):
+        '''
+        Shows the current values of the outlet, if they changed
+        '''
+        text = self.format_outlet(self.data)
+        if text != self.text:
+            self.text = text
+            self.text_widget.set_text(text)
 
     def keypress(self, size, key):
         return key
@@ -198,117 +303,652 @@ class ListItem(urwid.WidgetWrap):
 
 
 
+'''
+List walker for the outlets pane, that creates ListItem widgets only for the rows, that are shown.
+The outlets stay in the list of the device. At most max_widgets widgets are kept, the least
+recently shown are forgotten, so scrolling and refreshing cost the same for 8 and for 10000 rows.
+'''
+class OutletWalker(urwid.ListWalker):
+
+    max_widgets = 200
+
+    def __init__(self, on_create=None, on_forget=None):
+        self.outlets = []
+        self.focus = 0
+        # number of outlets, when the walker was updated the last time
+        self.length = 0
+        # position -> ListItem, least recently used first
+        self.widgets = collections.OrderedDict()
+        self.on_create = on_create
+        self.on_forget = on_forget
+
+    def set_outlets(self, outlets):
+        for position in list(self.widgets):
+            self._forget(position)
+        self.outlets = outlets
+        self.length = len(outlets)
+        self.focus = 0
+        self._modified()
+
+    def update(self):
+        '''
+        Updates the widgets of the changed outlets, returns True if the focused outlet changed
+        '''
+        focus_changed = False
+        for position, w in list(self.widgets.items()):
+            if position >= len(self.outlets) or w.data is not self.outlets[position]:
+                # the list shrank (e.g. the device was discovered again), maybe grew again with new outlets
+                self._forget(position)
+                focus_changed = focus_changed or position == self.focus
+            elif w.data.is_changed():
+                w.data.clear_changes()
+                w.update()
+                if position == self.focus:
+                    focus_changed = True
+        if len(self.outlets) != self.length:
+            # rows were added or removed, the focus must stay on an existing row
+            self.length = len(self.outlets)
+            if self.focus >= self.length:
+                self.focus = max(0, self.length - 1)
+                focus_changed = True
+            self._modified()
+        return focus_changed
+
+    def _forget(self, position):
+        w = self.widgets.pop(position)
+        if self.on_forget is not None:
+            self.on_forget(w)
+
+    def __len__(self):
+        return len(self.outlets)
+
+    def __getitem__(self, position):
+        if position < 0 or position >= len(self.outlets):
+            raise IndexError(position)
+        w = self.widgets.get(position)
+        if w is not None:
+            self.widgets.move_to_end(position)
+            return w
+        outlet = self.outlets[position]
+        outlet.clear_changes()
+        w = ListItem(outlet)
+        if self.on_create is not None:
+            self.on_create(w)
+        self.widgets[position] = w
+        while len(self.widgets) > self.max_widgets:
+            self._forget(next(iter(self.widgets)))
+        return w
+
+    def next_position(self, position):
+        if position + 1 >= len(self.outlets):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.outlets) - 1, -1, -1)
+        return range(0, len(self.outlets))
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+
 class ListView(urwid.WidgetWrap):
 
     def __init__(self):
         urwid.register_signal(self.__class__, ['show_details', 'item_activated'])
-        self.walker = urwid.SimpleFocusListWalker([])
+        self.walker = OutletWalker(self._connect_item, self._disconnect_item)
         self.lb = urwid.ListBox(self.walker)
         urwid.WidgetWrap.__init__(self, self.lb)
 
     def modified(self):
         focus_w, _ = self.walker.get_focus()
+        if focus_w is None:
+            return
         urwid.emit_signal(self, 'show_details', focus_w.data, [])
 
     def set_data(self, outlets):
-        outlets_widgets = [ListItem(o) for o in outlets]
+        '''
+        Shows the outlets. If the outlets of the device are shown already, only the visible
+        rows with changed outlets are updated and the focus and the scroll position stay as they are.
+        Returns True, if the rows were created new
+        '''
+        if outlets is self.walker.outlets:
+            if self.walker.update():
+                self.modified()
+            return False
+
         urwid.disconnect_signal(self.walker, 'modified', self.modified)
+        self.walker.set_outlets(outlets)
+        urwid.connect_signal(self.walker, "modified", self.modified)
+        if len(outlets) > 0:
+            self.walker.set_focus(0)
+        return True
 
-        while len(self.walker) > 0:
-            w = self.walker.pop()
-            urwid.disconnect_signal(w, "item_activated", self.item_activated)
-        self.walker.extend(outlets_widgets)
+    def _connect_item(self, w):
+        urwid.connect_signal(w, "item_activated", self.item_activated)
 
-        urwid.connect_signal(self.walker, "modified", self.modified)
-        for w in outlets_widgets:
-            urwid.connect_signal(w, "item_activated", self.item_activated)
+    def _disconnect_item(self, w):
+        urwid.disconnect_signal(w, "item_activated", self.item_activated)
 
-        self.walker.set_focus(0)
-   
     # throw up
     def item_activated(self, item):
         urwid.emit_signal(self, 'item_activated', 1, [])
 
 
+def benchmark_listview(rows):
+    '''
+    Prints the time to show, scroll and refresh an outlet list with the given number of rows,
+    once with the OutletWalker and once with a ListItem widget for every row
+    '''
+    size = (120, 40)
+    outlets = [Outlet({'name': 'port %d' % (i + 1), 'state': i % 2, 'voltage': 230.0, 'current': 0.5, 'power': 115.0})
+               for i in range(0, rows)]
+
+    def measure(name, create, refresh):
+        started = time.perf_counter()
+        lb = create()
+        lb.render(size, focus=True)
+        shown = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for n in range(0, 50):
+            lb.keypress(size, 'page down')
+            lb.render(size, focus=True)
+        scrolled = (time.perf_counter() - started) / 50
+
+        started = time.perf_counter()
+        for n in range(0, 50):
+            for i in range(n, rows, max(1, rows // 10)):
+                outlets[i].update({'power': 100.0 + n})
+            refresh(lb)
+            lb.render(size, focus=True)
+        refreshed = (time.perf_counter() - started) / 50
+        print('%-22s %10.1fms %10.2fms %10.2fms' % (name, shown * 1000, scrolled * 1000, refreshed * 1000))
+
+    def create_virtual():
+        listview = ListView()
+        listview.set_data(outlets)
+        return listview
+
+    def create_eager():
+        return urwid.ListBox(urwid.SimpleFocusListWalker([ListItem(o) for o in outlets]))
+
+    def refresh_eager(lb):
+        # what the list did before: new widgets for all rows
+        focus = lb.focus_position
+        lb.body[:] = [ListItem(o) for o in outlets]
+        lb.set_focus(focus)
+
+    print('%d rows' % rows)
+    print('%-22s %12s %12s %12s' % ('', 'first paint', 'page down', 'refresh'))
+    measure('virtual (OutletWalker)', create_virtual, lambda listview: listview.set_data(outlets))
+    measure('one widget per row', create_eager, refresh_eager)
+
+
+'''
+State of one outlet or port. The values are parsed once, when they are stored, and each field,
+that changed, sets its bit in the change mask. Whoever shows the outlets clears the mask.
+Fields, that a device doesn't provide, are None.
+
+Outlets can be used like the dicts they replace, outlet['state'] and 'voltage' in outlet still work.
+'''
+class Outlet(object):
+
+    # name, parse function (None for values, that are stored as they are)
+    fields = [
+        ('name', str), ('state', int), ('type', str),
+        ('voltage', float), ('current', float), ('power', float), ('powerDissipation', float),
+        ('max_current', float), ('on_current', float), ('on_delay', int), ('off_delay', int),
+        ('preset1', int), ('preset2', int), ('preset3', int),
+        ('admin_status', int), ('oper_status', int), ('poe_status', str),
+        ('mac_addrs', None), ('ip_addrs', None),
+        ('rx_bps', float), ('tx_bps', float), ('error_rate', float), ('discard_rate', float), ('bootdev', str), ('sensor_data', None),
+        ('last_on', None), ('last_off', None),
+    ]
+    __slots__ = [name for name, parse in fields] + ['changed']
+    # name -> (bit in the change mask, parse function)
+    field_types = dict((name, (1 << i, parse)) for i, (name, parse) in enumerate(fields))
+
+    def __init__(self, values=None):
+        for name, parse in self.fields:
+            setattr(self, name, None)
+        self.changed = 0
+        if values is not None:
+            self.update(values)
+
+    def update(self, values):
+        '''
+        Stores the values of a dict, values, that can't be parsed, are stored as None
+        '''
+        for key, value in values.items():
+            if not key in self.field_types:
+                raise KeyError('unknown outlet field ' + key)
+            bit, parse = self.field_types[key]
+            if value is not None and parse is not None:
+                try:
+                    value = parse(value)
+                except (TypeError, ValueError):
+                    value = None
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                self.changed |= bit
+
+    def is_changed(self, *keys):
+        '''
+        True if one of the fields changed since the last clear_changes(), any field if no keys are given
+        '''
+        if len(keys) == 0:
+            return self.changed != 0
+        return any(self.changed & self.field_types[key][0] for key in keys)
+
+    def clear_changes(self):
+        self.changed = 0
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name, parse in self.fields if getattr(self, name) is not None)
+
+    def __getitem__(self, key):
+        value = None
+        if key in self.field_types:
+            value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __contains__(self, key):
+        return key in self.field_types and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+
 class PowerStripController(object):
     cfg = None
     last_refresh = None
     multi_power_on_delay = 2
+    power_cycle_delay = 5
+    # set by the DevicePoller after each job
+    last_error = None
+    last_poll_duration = None
 
     def __init__(self, cfg):
         self.cfg = cfg
         self.outlets = []
-        True
+        # serializes the communication with the device, when it is used from several threads
+        self.io_lock = threading.Lock()
+        # errors of the threads working for the device besides the DevicePoller, by their name
+        self.background_errors = {}
 
     def get_last_refresh(self):
         return self.last_refresh
 
+    def start_background(self):
+        '''
+        Starts the receivers and threads, that work for the device besides the requests (e.g. the trap
+        receiver). Only the long running modes (ui, daemon, exporter) call it, a single command or a
+        batch must not bind their ports next to a running daemon
+        '''
+        pass
+
+    def set_background_error(self, source, error):
+        '''
+        Records the error of a background thread (trap receiver, ARP walk) or clears it with None.
+        The threads must not print, the ui shows the errors in the title
+        '''
+        if error is None:
+            self.background_errors.pop(source, None)
+        else:
+            self.background_errors[source] = error
+
     def _apply_on_state(self, outlets, outlet_id):
-        self.outlets[outlet_id-1]['state'] = 1
-        self.outlets[outlet_id-1]['last_on'] = datetime.now()
+        self.outlets[outlet_id-1].update({'state': 1, 'last_on': datetime.now()})
 
     def _apply_off_state(self, outlets, outlet_id):
-        self.outlets[outlet_id-1]['state'] = 0
-        self.outlets[outlet_id-1]['last_off'] = datetime.now()
+        self.outlets[outlet_id-1].update({'state': 0, 'last_off': datetime.now()})
+
+    def _store_outlet(self, i, values):
+        '''
+        Updates outlet i (starting with 0) with the values of a dict or appends it as a new Outlet
+        '''
+        if i < len(self.outlets):
+            self.outlets[i].update(values)
+        else:
+            self.outlets.append(Outlet(values))
+
+    def _get_preset_value(self, preset_index, outlet_id):
+        # presetN=0,1,... in the config, one value per outlet
+        key = 'preset' + str(preset_index + 1)
+        if not key in self.cfg:
+            return 0
+        values = self.cfg[key].split(',')
+        if outlet_id > len(values):
+            return 0
+        return int(values[outlet_id-1])
+
+    def get_preset(self, preset_index):
+        '''
+        Returns {outlet_id: state} of preset 1, 2 or 3 (preset_index 0 to 2)
+        '''
+        return dict((i + 1, self._get_preset_value(preset_index, i + 1)) for i in range(0, len(self.outlets)))
+
+    def power_cycle(self, outlet_id):
+        '''
+        Switches the outlet off and after power_cycle_delay seconds on again. With a list of outlets
+        all are switched off together, there is one delay and the power ons go through the PowerOnSequencer
+        '''
+        delay = float(self.cfg.get('power_cycle_delay', self.power_cycle_delay))
+        if not isinstance(outlet_id, list):
+            self.switch_off(outlet_id)
+            time.sleep(delay)
+            self.switch_on(outlet_id)
+            return
+        self.switch_many(dict((i, 0) for i in outlet_id))
+        time.sleep(delay)
+        PowerOnSequencer(self).run(dict((i, 1) for i in outlet_id))
+
+    def switch_many(self, states):
+        '''
+        Switches several outlets, states is a dict {outlet_id: 0 or 1}. Power offs first
+        '''
+        for outlet_id in sorted(states, key=lambda outlet_id: (states[outlet_id], outlet_id)):
+            if states[outlet_id]:
+                self.switch_on(outlet_id)
+            else:
+                self.switch_off(outlet_id)
 
+    def activate_preset(self, preset_index):
+        '''
+        Switches the outlets, that differ from the preset, with the PowerOnSequencer
+        '''
+        preset = self.get_preset(preset_index)
+        changes = dict((outlet_id, preset[outlet_id]) for outlet_id in preset if self.outlets[outlet_id-1]['state'] != preset[outlet_id])
+        PowerOnSequencer(self).run(changes)
+
+    def get_total_current(self):
+        '''
+        Returns the current drawn by all outlets in A, None if the device can't measure it
+        '''
+        return None
+
+    def get_current_budget(self):
+        '''
+        Returns the current in A, that the outlets may draw together, None for no limit
+        '''
+        if 'current_budget' in self.cfg:
+            return float(self.cfg['current_budget'])
+        return None
+
+    def get_expected_current(self, outlet_id):
+        '''
+        Returns the current in A, the outlet is expected to draw after power on, that is the last
+        current measured while it was on. None if it wasn't measured yet, the rated current of an
+        outlet is far above what most devices draw and no estimate
+        '''
+        try:
+            return float(self.outlets[outlet_id-1]['on_current'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def get_outlet_current(self, outlet_id):
+        '''
+        Returns the last current reading of the outlet in A, 0 if there is none
+        '''
+        try:
+            return float(self.outlets[outlet_id-1]['current'])
+        except (KeyError, TypeError, ValueError):
+            return 0.0
 
-class IPMISessionKeepaliveThread(threading.Thread):
-    
-    def __init__(self, stop_event):
-        self.stop_event = stop_event
+    def get_input_energy(self):
+        '''
+        Returns the energy counter of the device input in kWh from the last refresh, None if the device has none
+        '''
+        return None
+
+
+'''
+Switches outlets to new states without overloading the circuit.
+All power offs and, on devices without current measurement, the first power on are sent
+together. Devices without current measurement get multi_power_on_delay between the power ons.
+
+On devices, that measure their current, each power on waits until the current settled
+(see wait_until_settled) and the next outlet is only switched on, if the current it drew the
+last time it was on fits into the budget (current_budget in the config or the rating of the
+device). If it doesn't, the sequence stops with an IOError and the remaining outlets stay off.
+Outlets, that weren't measured yet, are switched on after multi_power_on_delay instead.
+'''
+class PowerOnSequencer(object):
+
+    settle_interval = 0.5
+    # relative change of the current, the minimum is settle_minimum A
+    settle_tolerance = 0.05
+    settle_minimum = 0.05
+    # PDUs update their readings seconds after a switch, earlier readings are not used
+    settle_time = 2
+    settle_timeout = 10
+
+    def __init__(self, device):
+        self.device = device
+
+    def run(self, states):
+        device = self.device
+        power_offs = dict((outlet_id, 0) for outlet_id in states if states[outlet_id] == 0)
+        power_ons = sorted(outlet_id for outlet_id in states if states[outlet_id] == 1)
+
+        current = None
+        if len(power_ons) > 0:
+            current = device.get_total_current()
+        if current is None:
+            first = power_offs
+            delayed = power_ons
+            if device.multi_power_on_delay <= 0:
+                first.update((outlet_id, 1) for outlet_id in power_ons)
+                delayed = []
+            elif len(power_ons) > 0:
+                first[power_ons[0]] = 1
+                delayed = power_ons[1:]
+            device.switch_many(first)
+            for outlet_id in delayed:
+                time.sleep(device.multi_power_on_delay)
+                device.switch_many({outlet_id: 1})
+            return
 
+        if len(power_offs) > 0:
+            drop = sum(device.get_outlet_current(outlet_id) for outlet_id in power_offs)
+            device.switch_many(power_offs)
+            current = self.wait_until_settled(current, -drop)
+        budget = device.get_current_budget()
+        for outlet_id in power_ons:
+            expected = device.get_expected_current(outlet_id)
+            if expected is None:
+                # nothing known about the outlet, it gets the fixed delay of devices without measurement
+                device.switch_many({outlet_id: 1})
+                time.sleep(device.multi_power_on_delay)
+                current = self.wait_until_settled(current)
+                continue
+            if budget is not None and current + expected > budget:
+                raise IOError('outlet %d needs about %.2f A, %.2f A of %.2f A are used' % (outlet_id, expected, current, budget))
+            device.switch_many({outlet_id: 1})
+            current = self.wait_until_settled(current, expected)
+
+    def wait_until_settled(self, before, change=0.0):
+        '''
+        Reads the current after a switch until it settled and returns the last reading.
+        before is the reading before the switch and change the expected change in A.
+        Readings count only settle_time after the switch and, if a change of at least settle_minimum
+        is expected, only once the current moved by settle_minimum in that direction. Then two readings
+        settle_interval apart, that differ by less than settle_tolerance, are settled.
+        After settle_timeout the last reading is returned anyway
+        '''
+        started = time.time()
+        previous = None
+        current = before
+        while True:
+            time.sleep(self.settle_interval)
+            reading = self.device.get_total_current()
+            if reading is None:
+                return current
+            current = reading
+            elapsed = time.time() - started
+            if elapsed >= self.settle_timeout:
+                return current
+            moved = abs(change) < self.settle_minimum or (current - before) * (1 if change > 0 else -1) >= self.settle_minimum
+            if (elapsed >= self.settle_time and moved and previous is not None
+                    and abs(current - previous) <= max(self.settle_minimum, self.settle_tolerance * previous)):
+                return current
+            previous = current
+
+
+'''
+One thread servicing the responses and keepalives of all IPMI sessions.
+pyghmi keeps its sessions in a class level table and Session.wait_for_rsp() handles
+all of them, so one loop is enough for any number of BMCs.
+'''
+class IPMISessionLoop(threading.Thread):
+
+    instance = None
+    lock = threading.Lock()
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='IPMISessionLoop', daemon=True)
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def start_once(cls):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = IPMISessionLoop()
+                cls.instance.start()
+            return cls.instance
+
+    @classmethod
+    def shutdown(cls):
+        with cls.lock:
+            loop = cls.instance
+            cls.instance = None
+        ipmi_session_pool.close_all()
+        if loop is not None:
+            loop.stop_event.set()
+            loop.join(2)
 
     def run(self):
-        Command.eventloop()
+        while not self.stop_event.is_set():
+            try:
+                ipmi_session.Session.wait_for_rsp(timeout=1)
+            except Exception:
+                # an error of one session must not stop the keepalives of the others
+                self.stop_event.wait(1)
+
+
+'''
+IPMI sessions by (host, port, user), reused across refreshes.
+A session that failed is dropped and a new one is opened on the next use.
+Failed logins are retried with exponential backoff, instead of running into the
+login timeout on every refresh of an unreachable BMC.
+'''
+class IPMISessionPool(object):
+
+    min_backoff = 2
+    max_backoff = 120
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        # key -> (failed logins, time of the next try)
+        self.failures = {}
+
+    def get(self, host, port, user, pwd):
+        key = (host, port, user)
+        with self.lock:
+            cmd = self.sessions.get(key)
+            if cmd is not None and not self._is_broken(cmd):
+                return cmd
+            self.sessions.pop(key, None)
+            failures, retry_at = self.failures.get(key, (0, 0))
+            if time.time() < retry_at:
+                raise IOError('%s not reachable, next try in %d s' % (host, retry_at - time.time()))
+
+        IPMISessionLoop.start_once()
+        try:
+            cmd = ipmi_command.Command(bmc=host, userid=user, password=pwd, port=port)
+        except Exception:
+            with self.lock:
+                backoff = min(self.max_backoff, self.min_backoff * 2 ** failures)
+                self.failures[key] = (failures + 1, time.time() + backoff)
+            raise
+
+        with self.lock:
+            self.failures.pop(key, None)
+            self.sessions[key] = cmd
+        return cmd
+
+    def _is_broken(self, cmd):
+        session = getattr(cmd, 'ipmi_session', None)
+        return session is None or getattr(session, 'broken', False)
+
+    def drop(self, cmd):
+        with self.lock:
+            for key in list(self.sessions):
+                if self.sessions[key] is cmd:
+                    del self.sessions[key]
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for cmd in sessions:
+            try:
+                cmd.ipmi_session.logout()
+            except Exception:
+                pass
+
+ipmi_session_pool = IPMISessionPool()
 
-    
 
 class IPMIDevice(PowerStripController):
 
     timeout = 3000
-    cmd = None
     power_state = 'unknown'
-    last_session_usage = 0
 
     def __init__(self, cfg):
         super(IPMIDevice, self).__init__(cfg)
-        
-        self.cmd = self.get_cmd()
+        # the session is opened on first use, in a DevicePoller thread
 
     def get_cmd(self):
-        # create new ipmi session to prevent running into timeouts
-        #if not self.last_session_usage == 0:
-        #    print(time.time() - self.last_session_usage)
-        #if self.cmd == None or time.time() - self.last_session_usage > 20:
-        cmd = None
-        if self.cmd == None:
-            try:
-                port = 623
-                if 'port' in self.cfg:
-                    port = int(self.cfg['port'])
-                cmd = ipmi_command.Command(
-                    bmc=self.cfg['host'], userid=self.cfg['user'], password=self.cfg['pwd'], port=port
-                )
-                self.cmd = cmd
-                self.event_thread = IPMISessionKeepaliveThread(None)
-                self.event_thread.start()
-             
-            except Exception as e:
-                #urwid.ExitMainLoop()
-                print(e)
+        port = 623
+        if 'port' in self.cfg:
+            port = int(self.cfg['port'])
+        return ipmi_session_pool.get(self.cfg['host'], port, self.cfg['user'], self.cfg['pwd'])
 
-        #self.last_session_usage = time.time()
-        return self.cmd
+    def _call(self, method, *args, **kwargs):
+        cmd = self.get_cmd()
+        try:
+            return getattr(cmd, method)(*args, **kwargs)
+        except Exception:
+            # most likely a session timeout, the next call opens a new session
+            ipmi_session_pool.drop(cmd)
+            raise
 
     def refresh_status(self):
         # state
-        state = self.get_cmd().get_power()
+        state = self._call('get_power')
         iState = 0
         if "on" in state['powerstate']:
             iState = 1
         
         # bootdev
-        bootdev = self.get_cmd().get_bootdev()
+        bootdev = self._call('get_bootdev')
         bootdevstr = 'bootdev: ' + bootdev['bootdev']
         if bootdev['persistent']:
             bootdevstr += ', persistent'
@@ -323,7 +963,7 @@ class IPMIDevice(PowerStripController):
         #    sensor_data['unit'] = x.units
         #    sensor_data['health'] = x.health
         
-        outlets =  [{
+        outlet = {
             'name': self.cfg.name,
             'state': iState,
             'preset1': 0,
@@ -331,22 +971,16 @@ class IPMIDevice(PowerStripController):
             'preset3': 0,
             'bootdev': bootdevstr,
         #        'sensor_data': sensor_data
-        }]
-        if len(self.outlets) == 0:
-            self.outlets = outlets
-        else:
-            for key in outlets[0]:
-                self.outlets[0][key] = outlets[0][key] 
-        
-        #self.outlets = outlets
+        }
+        self._store_outlet(0, outlet)
 
 
 
-    def get_event_log():
-        return self.get_cmd().get_event_log()
+    def get_event_log(self):
+        return self._call('get_event_log')
 
     def _switch(self, state):
-        self.get_cmd().set_power(state, wait=2000)
+        self._call('set_power', state, wait=2000)
 
     def switch_on(self, outlet_id):
         self._switch("on")
@@ -362,68 +996,210 @@ class IPMIDevice(PowerStripController):
         else:
             self.switch_off(outlet_id)
 
+'''
+Keep-alive HTTPS connection to a Redfish service, shared by all devices of the same BMC.
+GET responses are cached with their ETag and revalidated with If-None-Match, so unchanged
+resources come back as 304 Not Modified without a body. $select and $expand are used,
+when the service announces them in ProtocolFeaturesSupported.
+'''
+class RedfishTransport(object):
+
+    transports = {}
+    transports_lock = threading.Lock()
+    timeout = 10
+
+    @classmethod
+    def get(cls, host, port, user, pwd):
+        key = (host, port, user)
+        with cls.transports_lock:
+            if not key in cls.transports:
+                cls.transports[key] = RedfishTransport(host, port, user, pwd)
+            return cls.transports[key]
+
+    def __init__(self, host, port, user, pwd):
+        self.host = host
+        self.port = port
+        self.authorization = 'Basic ' + base64.b64encode((user + ':' + pwd).encode()).decode()
+        self.lock = threading.Lock()
+        self.conn = None
+        # path -> (etag, parsed response)
+        self.etag_cache = {}
+        self.features = None
+        self.stats = {'connections': 0, 'requests': 0, 'not_modified': 0}
+
+    def _connection(self):
+        if self.conn is None:
+            # like the verify callback used with pyghmi before, BMC certificates are not verified
+            context = ssl._create_unverified_context()
+            self.conn = http_client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+            self.stats['connections'] += 1
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        '''
+        Returns status, ETag header and body of the response
+        '''
+        request_headers = {'Authorization': self.authorization, 'Accept': 'application/json', 'Connection': 'keep-alive'}
+        if headers:
+            request_headers.update(headers)
+        if body is not None:
+            body = json.dumps(body)
+            request_headers['Content-Type'] = 'application/json'
+        with self.lock:
+            for attempt in range(0, 2):
+                conn = self._connection()
+                try:
+                    conn.request(method, path, body, request_headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http_client.HTTPException, OSError):
+                    # the BMC closed the idle connection, reconnect once
+                    self.close()
+                    if attempt > 0:
+                        raise
+                    continue
+                self.stats['requests'] += 1
+                if response.will_close:
+                    self.close()
+                return response.status, response.getheader('ETag'), data
+
+    def supports(self, feature, sub_feature=None):
+        if self.features is None:
+            self.features = self.get_json('/redfish/v1').get('ProtocolFeaturesSupported', {})
+        value = self.features.get(feature)
+        if sub_feature is not None:
+            return isinstance(value, dict) and bool(value.get(sub_feature))
+        return bool(value)
+
+    def get_json(self, path, select=None):
+        if select and self.supports('SelectQuery'):
+            path += '?$select=' + ','.join(select)
+        headers = {}
+        cached = self.etag_cache.get(path)
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        status, etag, data = self.request('GET', path, headers=headers)
+        if status == 304 and cached is not None:
+            self.stats['not_modified'] += 1
+            return cached[1]
+        if status != 200:
+            raise IOError('%s: GET %s returned HTTP %d' % (self.host, path, status))
+        result = json.loads(data.decode())
+        if etag:
+            self.etag_cache[path] = (etag, result)
+        return result
+
+    def post_json(self, path, body):
+        status, etag, data = self.request('POST', path, body)
+        if status >= 300:
+            raise IOError('%s: POST %s returned HTTP %d' % (self.host, path, status))
+
+
 class RedfishDevice(PowerStripController):
 
     timeout = 3000
-    cmd = None
+    # seconds to wait for the requested power state (power_wait in the config). The io_lock of the
+    # device is held meanwhile, after that the next refresh shows the state the BMC reports
+    power_wait = 30
+    # BootSourceOverrideTarget -> boot device names used by pyghmi and ipmi
+    boot_devices = {
+        'None': 'default',
+        'Pxe': 'network',
+        'Hdd': 'hd',
+        'Cd': 'optical',
+        'BiosSetup': 'setup',
+        'Floppy': 'floppy',
+        'Usb': 'usb',
+    }
 
     def __init__(self, cfg):
         super(RedfishDevice, self).__init__(cfg)
+        self.system_path = None
+        self.reset_target = None
+        # the connection is opened on first use, in a DevicePoller thread
 
-        power_state = 'unknown'
-        try:
-            port = 623
-            if 'port' in self.cfg:
-                port = int(self.cfg['port'])
-            self.cmd = redfish_command.Command(
-                bmc=self.cfg['host'], userid=self.cfg['user'], password=self.cfg['pwd'], port=port, verifycallback=self.verify_callback
-            )
-            #print(self.cmd)
-        except Exception as e:
-            print(e)
-
-    def verify_callback(self, x):
-        # ssl?!
-        return True
+    def get_transport(self):
+        port = 443
+        if 'port' in self.cfg:
+            port = int(self.cfg['port'])
+        return RedfishTransport.get(self.cfg['host'], port, self.cfg['user'], self.cfg['pwd'])
+
+    def _get_system(self):
+        '''
+        Returns PowerState and Boot of the first computer system of the service.
+        The first call finds the system. With $expand support the collection comes
+        with the members in the same response.
+        '''
+        transport = self.get_transport()
+        if self.system_path is None:
+            if transport.supports('ExpandQuery', 'NoLinks'):
+                systems = transport.get_json('/redfish/v1/Systems?$expand=.($levels=1)')
+            else:
+                systems = transport.get_json('/redfish/v1/Systems')
+            member = systems['Members'][0]
+            self.system_path = member['@odata.id']
+            if not 'PowerState' in member:
+                member = transport.get_json(self.system_path)
+            self.reset_target = member['Actions']['#ComputerSystem.Reset']['target']
+            return member
+        return transport.get_json(self.system_path, select=['PowerState', 'Boot'])
 
     def get_power_state(self):
-        return self.cmd.get_power()
+        return self._get_system().get('PowerState')
 
     def refresh_status(self):
-        state = self.cmd.get_power()
+        system = self._get_system()
+        iState = 0
+        if system.get('PowerState') == 'On':
+            iState = 1
 
         # bootdev
-        bootdev = self.cmd.get_bootdev()
-        bootdevstr = 'bootdev: ' + bootdev['bootdev']
-        if bootdev['persistent']:
+        boot = system.get('Boot', {})
+        target = boot.get('BootSourceOverrideTarget', 'None')
+        bootdevstr = 'bootdev: ' + self.boot_devices.get(target, str(target).lower())
+        if boot.get('BootSourceOverrideEnabled') == 'Continuous':
             bootdevstr += ', persistent'
         else:
             bootdevstr += ', temporary'
 
         outlet = {
             'name': self.cfg.name,
-            'state': 0,
+            'state': iState,
             'preset1': 0,
             'preset2': 0,
             'preset3': 0,
             'bootdev': bootdevstr
         }
-        if len(self.outlets) == 1:
-            for key in outlet:
-                self.outlets[0][key] = outlet[key]
-        else:
-            self.outlets.append(outlet)
+        self._store_outlet(0, outlet)
 
     def _switch(self, state):
-        self.cmd.set_power(state, wait=2000)
+        if self.reset_target is None:
+            self._get_system()
+        reset_type = 'On'
+        if state == 'off':
+            reset_type = 'ForceOff'
+        self.get_transport().post_json(self.reset_target, {'ResetType': reset_type})
+
+        # returns True, when the BMC reports the state
+        deadline = time.time() + float(self.cfg.get('power_wait', self.power_wait))
+        while str(self.get_power_state()).lower() != state:
+            if time.time() >= deadline:
+                return False
+            time.sleep(1)
+        return True
 
     def switch_on(self, outlet_id):
-        self._switch("on")
-        self._apply_on_state(self.outlets, outlet_id)
+        if self._switch("on"):
+            self._apply_on_state(self.outlets, outlet_id)
 
     def switch_off(self, outlet_id):
-        self._switch("off")
-        self._apply_off_state(self.outlets, outlet_id)
+        if self._switch("off"):
+            self._apply_off_state(self.outlets, outlet_id)
 
     def toggle_outlet(self, outlet_id):
         if self.outlets[outlet_id-1]['state'] == 0:
@@ -434,163 +1210,1427 @@ class RedfishDevice(PowerStripController):
 
 
 '''
-Power over Ethernet Power Sourcing Equipment
-Uses standard SNMP OIDs and should be compatible with most PoE devices with SNMP
+SNMPv3 password to key algorithm from RFC 3414, appendix A.2.
+Hashes one megabyte of the repeated password, this is the expensive part of the USM setup.
 '''
-class PoEPSE(PowerStripController):
-  
-    oids = {
-        # single values
-        'sysName': ObjectIdentity('.1.3.6.1.2.1.1.5.0'),
-    }
-    bulk_cmd_oids = {
-	# start oids
-        # pethPsePortAdminEnable: .1.3.6.1.2.1.105.1.1.1.3
-        'ifAlias': ObjectIdentity('.1.3.6.1.2.1.31.1.1.1.18'),
-        'ifAdminStatus': ObjectIdentity('.1.3.6.1.2.1.2.2.1.7'),
-        'ifOperStatus': ObjectIdentity('.1.3.6.1.2.1.2.2.1.8'),
-        'ifMtu': ObjectIdentity('.1.3.6.1.2.1.2.2.1.4'),
-        'ifJackType': ObjectIdentity('.1.3.6.1.2.1.26.2.2.1.2'),
-        'pethPsePortAdminEnable': ObjectIdentity('.1.3.6.1.2.1.105.1.1.1.3.1'),
-        'macAddresses': ObjectIdentity('.1.3.6.1.2.1.17.4.3.1.2'),
-    }
-    # key is bulk_cmd_oids key
-    bulk_cmds = {}
+def snmp_password_to_key(password, hash_name):
+    if isinstance(password, str):
+        password = password.encode()
+    count = 1048576
+    h = hashlib.new(hash_name)
+    h.update((password * (count // len(password) + 1))[:count])
+    return h.digest()
 
-    # for received data. key is same as in bulk_cmd_oids, value is an array with the value for each outlet
-    data = {}
-    mac_addresses = {}
+def snmp_localize_key(master_key, engine_id, hash_name):
+    return hashlib.new(hash_name, master_key + engine_id + master_key).digest()
 
-    def __init__(self, cfg):
-        super(PoEPSE, self).__init__(cfg)
-        self._configure_connection()
 
-    # pull into snmp client super class
-    def _get_bulk_cmd(self, first_oid_key):
-        return bulkCmd(self.snmpEngine, self.userData, self.transport, ContextData(), 0, 7, self._getObjectType(first_oid_key))
+# directory for data, that can be recreated by talking to the devices again
+CACHE_DIR = expanduser('~/.cache/currentcommander')
+
 
-    def _get_mac_addresses(self):
-        self.mac_addresses.clear()
-        for i in range(0, 8):
-            self._parse_mac_addresses(self.bulkCmdMacAddresses)
+'''
+Remembers the engine ID, boots and time of SNMPv3 agents between runs.
+
+With a known engine ID pysnmp skips the engine ID discovery and with seeded boots and time
+the first authenticated request is accepted by the agent without a time synchronization
+round trip. Entries are dropped, when a request with them fails, and read again from the
+agent after the next successful request.
+'''
+class SnmpDiscoveryCache(object):
 
-    def oid2mac(self, oid):
-        return "%0.2X:%0.2X:%0.2X:%0.2X:%0.2X:%0.2X" % (int(oid[0]), int(oid[1]), int(oid[2]), int(oid[3]), int(oid[4]), int(oid[5]))
+    # entries older than this are read again from the agent, to follow reboots
+    max_age = 86400
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+        # the last error writing the file
+        self.error = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            for key, entry in entries.items():
+                # skip invalid entries
+                self.check_entry(entry)
+                self.entries[key] = entry
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    def check_entry(self, entry):
+        '''
+        Raises an exception, if an entry read from the file is invalid
+        '''
+        bytes.fromhex(entry['engine_id'])
+        int(entry['boots']), int(entry['time']), float(entry['stamp'])
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # the cache is optional, without the file the agents are discovered again at the next start.
+            # No print, the ui may be running
+            self.error = e
+
+    def get(self, host, port):
+        with self.lock:
+            self._load()
+            return self.entries.get('%s:%s' % (host, port))
+
+    def is_stale(self, entry):
+        return entry is None or time.time() - entry['stamp'] > self.max_age
+
+    def put(self, host, port, engine_id, boots, engine_time):
+        with self.lock:
+            self._load()
+            entry = {'engine_id': engine_id.hex(), 'boots': boots, 'time': engine_time, 'stamp': time.time()}
+            self.entries['%s:%s' % (host, port)] = entry
+            self._save()
+            return entry
+
+    def forget(self, host, port):
+        with self.lock:
+            self._load()
+            if self.entries.pop('%s:%s' % (host, port), None) is not None:
+                self._save()
+
+    @staticmethod
+    def seed_engine(snmpEngine, entry, transport_info):
+        '''
+        Puts the cached engine ID of the agent into the engine ID cache of the SNMPv3 message processing
+        and its boots and estimated current time into the USM timeline of the engine. With both the first
+        request is sent authenticated right away, without the discovery round trips. pysnmp has no public
+        interface for this, returns False if its internals are different
+        '''
+        try:
+            engine_id = rfc1902.OctetString(bytes.fromhex(entry['engine_id']))
+            # 3 is SNMPv3 message processing and the USM security model
+            mp = snmpEngine.messageProcessingSubsystems[3]
+            engine_ids = getattr(mp, '_SnmpV3MessageProcessingModel__engineIdCache')
+            usm = snmpEngine.securityModels[3]
+            timeline = getattr(usm, '_SnmpUSMSecurityModel__timeline')
+        except Exception:
+            return False
+        engine_ids[transport_info] = {'securityEngineId': engine_id, 'contextEngineId': engine_id,
+                                      'contextName': rfc1902.OctetString('')}
+        engine_time = int(entry['time'] + time.time() - entry['stamp'])
+        timeline[engine_id] = (int(entry['boots']), engine_time, engine_time, int(time.time()))
+        return True
+
+    @staticmethod
+    def unseed_engine(snmpEngine, entry, transport_info):
+        '''
+        Removes what seed_engine put into the engine, the next request discovers the agent again
+        '''
+        try:
+            mp = snmpEngine.messageProcessingSubsystems[3]
+            getattr(mp, '_SnmpV3MessageProcessingModel__engineIdCache').pop(transport_info, None)
+            usm = snmpEngine.securityModels[3]
+            getattr(usm, '_SnmpUSMSecurityModel__timeline').pop(
+                rfc1902.OctetString(bytes.fromhex(entry['engine_id'])), None)
+        except Exception:
+            pass
+
+snmp_discovery_cache = SnmpDiscoveryCache(os.path.join(CACHE_DIR, 'snmp_engines.json'))
+
+
+'''
+Caches the table geometry of SNMP devices (number of ports or outlets and index mappings),
+with the sysUpTime and ifNumber of the agent at the time of the discovery.
+'''
+class SnmpGeometryCache(SnmpDiscoveryCache):
+
+    # difference between the expected and the reported sysUpTime, that is still no restart, in seconds
+    uptime_tolerance = 60
+    # entries with another version were written with other geometry keys and are discovered again
+    version = 2
+
+    def check_entry(self, entry):
+        int(entry['uptime']), float(entry['stamp']), dict(entry['geometry'])
+        if entry['version'] != self.version:
+            raise ValueError('old geometry entry')
+
+    def put(self, host, port, uptime, if_number, geometry):
+        with self.lock:
+            self._load()
+            entry = {'uptime': uptime, 'if_number': if_number, 'stamp': time.time(), 'geometry': geometry,
+                     'version': self.version}
+            self.entries['%s:%s' % (host, port)] = entry
+            self._save()
+            return entry
+
+    def is_valid(self, entry, uptime, if_number):
+        '''
+        True, if the agent didn't restart since the entry was stored and ifNumber is the same.
+        uptime is the current sysUpTime in 1/100 seconds
+        '''
+        if entry is None or entry['if_number'] != if_number:
+            return False
+        elapsed = time.time() - entry['stamp']
+        expected = entry['uptime'] + elapsed * 100
+        return uptime >= expected - max(self.uptime_tolerance, elapsed * 0.01) * 100
+
+snmp_geometry_cache = SnmpGeometryCache(os.path.join(CACHE_DIR, 'snmp_geometry.json'))
+
+
+'''
+MAC -> IP addresses learned from the ARP tables of the SNMP devices with arp_table=yes
+(a router or layer 3 switch). Every source is walked by its own thread, arp_chunk rows
+at a time, each chunk under the io_lock of the device. So a large ARP table never holds up
+a refresh of the device for long, and the port refreshes only look up the cache.
+
+An address expires arp_ttl seconds after it was seen the last time (default 600).
+A new walk starts arp_interval seconds after the end of the previous one (default 60).
+'''
+class ArpCache(object):
+
+    default_ttl = 600
+    default_interval = 60
+    default_chunk = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # MAC as int -> {ip: expiry time}
+        self.entries = {}
+        self.threads = []
+
+    def add_source(self, device):
+        t = threading.Thread(target=self._run, args=(device,), name='ArpCache-' + str(device.cfg.get('host')), daemon=True)
+        t.start()
+        self.threads.append(t)
+
+    def lookup(self, mac):
+        '''
+        Returns the IP addresses of the MAC (as int), that didn't expire yet, IPv4 first
+        '''
+        now = time.time()
+        with self.lock:
+            ips = [ip for ip, expires in self.entries.get(mac, {}).items() if expires > now]
+        return sorted(ips, key=lambda ip: (':' in ip, ip))
+
+    def put(self, mac, ip, ttl):
+        with self.lock:
+            self.entries.setdefault(mac, {})[ip] = time.time() + ttl
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for mac in list(self.entries):
+                ips = dict((ip, expires) for ip, expires in self.entries[mac].items() if expires > now)
+                if ips:
+                    self.entries[mac] = ips
+                else:
+                    del self.entries[mac]
+
+    @staticmethod
+    def parse_row(key, index, value):
+        '''
+        Returns (MAC as int, ip) of a row of ipNetToPhysicalTable or ipNetToMediaTable, or None
+        '''
+        mac = bytes(value)
+        if len(mac) != 6:
+            return None
+        parts = [int(p) for p in index.split('.')]
+        if key == 'ipNetToPhysicalPhysAddress':
+            # ifIndex, InetAddressType (1 ipv4, 2 ipv6), length, address
+            if len(parts) < 3 or parts[2] != len(parts) - 3:
+                return None
+            if parts[1] == 1 and parts[2] == 4:
+                ip = socket.inet_ntop(socket.AF_INET, bytes(parts[3:]))
+            elif parts[1] == 2 and parts[2] == 16:
+                ip = socket.inet_ntop(socket.AF_INET6, bytes(parts[3:]))
+            else:
+                return None
+        else:
+            # ifIndex, ipv4 address
+            if len(parts) != 5:
+                return None
+            ip = socket.inet_ntop(socket.AF_INET, bytes(parts[1:]))
+        return int.from_bytes(mac, 'big'), ip
+
+    def walk_chunk(self, device, key, start_index, rows, ttl):
+        '''
+        Reads up to rows rows after start_index. Returns the index of the last row read,
+        or None at the end of the table, and the number of rows read
+        '''
+        last_index = None
+        count = 0
+        with device.io_lock:
+            for index, value in device._walk_column(key, max_rows=rows, start_index=start_index):
+                last_index = index
+                count += 1
+                row = self.parse_row(key, index, value)
+                if row is not None:
+                    self.put(row[0], row[1], ttl)
+        if count < rows:
+            last_index = None
+        return last_index, count
+
+    def _run(self, device):
+        ttl = float(device.cfg.get('arp_ttl', self.default_ttl))
+        interval = float(device.cfg.get('arp_interval', self.default_interval))
+        rows = int(device.cfg.get('arp_chunk', self.default_chunk))
+        key = 'ipNetToPhysicalPhysAddress'
+        while True:
+            start_index = None
+            total = 0
+            try:
+                while True:
+                    start_index, count = self.walk_chunk(device, key, start_index, rows, ttl)
+                    total += count
+                    if start_index is None:
+                        break
+                if total == 0 and key == 'ipNetToPhysicalPhysAddress':
+                    # agent without ipNetToPhysicalTable
+                    key = 'ipNetToMediaPhysAddress'
+                    continue
+                device.set_background_error('ARP table', None)
+            except Exception as e:
+                # shown in the title of the device, a print would write over the ui
+                device.set_background_error('ARP table', e)
+            self.expire()
+            time.sleep(interval)
+
+arp_cache = ArpCache()
+
+
+'''
+Process wide pool of SNMP engines, shared by all SNMP devices.
+
+A device borrows an engine for the duration of a request, so the number of engines is
+bounded by the number of concurrent requests and not by the number of devices.
+pysnmp configures USM users per engine by user name, so credentials with the same
+user name but different keys are never put on the same engine.
+
+The expensive password hashing is done once per password and hash algorithm.
+Once the engine ID of an agent is known, the localized keys are cached per
+(user, engine ID, auth protocol) and passed to pysnmp ready to use.
+'''
+class SnmpEnginePool(object):
+
+    hash_names = {'MD5': 'md5', 'SHA': 'sha1'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # list of [engine, {(user name, engine id): user data}, busy, {(engine id, transport info): seeded entry}]
+        self.engines = []
+        self.user_data = {}
+        self.master_keys = {}
+        self.localized_keys = {}
+        # (host, port) of the devices, that got user data. A device reconfigures its user, when the
+        # engine ID of the agent changes, and the trap receiver gets user data too, neither is a new device
+        self.devices = set()
+        self.stats = {
+            'devices': 0,
+            'engines': 0, 'engine_cpu': 0.0,
+            'master_keys': 0, 'master_key_hits': 0, 'master_key_cpu': 0.0,
+            'localized_keys': 0, 'localized_key_hits': 0, 'localized_key_cpu': 0.0,
+            'requests': 0,
+        }
+
+    def _master_key(self, password, auth_protocol):
+        key = (password, auth_protocol)
+        if key in self.master_keys:
+            self.stats['master_key_hits'] += 1
+            return self.master_keys[key]
+        started = time.process_time()
+        self.master_keys[key] = snmp_password_to_key(password, self.hash_names[auth_protocol])
+        self.stats['master_key_cpu'] += time.process_time() - started
+        self.stats['master_keys'] += 1
+        return self.master_keys[key]
+
+    def _localized_key(self, user, password, engine_id, auth_protocol):
+        key = (user, password, engine_id, auth_protocol)
+        if key in self.localized_keys:
+            self.stats['localized_key_hits'] += 1
+            return self.localized_keys[key]
+        master_key = self._master_key(password, auth_protocol)
+        started = time.process_time()
+        self.localized_keys[key] = snmp_localize_key(master_key, engine_id, self.hash_names[auth_protocol])
+        self.stats['localized_key_cpu'] += time.process_time() - started
+        self.stats['localized_keys'] += 1
+        return self.localized_keys[key]
+
+    def get_user_data(self, user, authkey, privkey, auth_protocol='MD5', priv_protocol='AES', engine_id=None, device=None):
+        '''
+        Returns the UsmUserData for the credentials, auth_protocol is MD5 or SHA, priv_protocol is AES or DES.
+        engine_id is the engine ID of the agent as bytes, if it is known. device is the (host, port)
+        of the device, that uses the credentials, for the statistics
+        '''
+        if auth_protocol != 'SHA':
+            auth_protocol = 'MD5'
+        if priv_protocol != 'DES':
+            priv_protocol = 'AES'
+        key = (user, authkey, privkey, auth_protocol, priv_protocol, engine_id)
+        with self.lock:
+            if device is not None:
+                self.devices.add(device)
+                self.stats['devices'] = len(self.devices)
+            if key in self.user_data:
+                return self.user_data[key]
+
+            authProtocol = usmHMACMD5AuthProtocol
+            privProtocol = usmAesCfb128Protocol
+            if auth_protocol == 'SHA':
+                authProtocol = usmHMACSHAAuthProtocol
+            if priv_protocol == 'DES':
+                privProtocol = usmDESPrivProtocol
+
+            if 'usmKeyTypeMaster' not in globals():
+                # pysnmp without support for precomputed keys
+                userData = UsmUserData(user, authkey, privkey, authProtocol=authProtocol, privProtocol=privProtocol)
+            elif engine_id is None:
+                userData = UsmUserData(user, self._master_key(authkey, auth_protocol), self._master_key(privkey, auth_protocol),
+                                       authProtocol=authProtocol, privProtocol=privProtocol,
+                                       authKeyType=usmKeyTypeMaster, privKeyType=usmKeyTypeMaster)
+            else:
+                # the privacy key is localized with the hash algorithm of the auth protocol
+                userData = UsmUserData(user, self._localized_key(user, authkey, engine_id, auth_protocol),
+                                       self._localized_key(user, privkey, engine_id, auth_protocol),
+                                       authProtocol=authProtocol, privProtocol=privProtocol,
+                                       securityEngineId=rfc1902.OctetString(engine_id),
+                                       authKeyType=usmKeyTypeLocalized, privKeyType=usmKeyTypeLocalized)
+            self.user_data[key] = userData
+            return userData
+
+    @contextlib.contextmanager
+    def engine(self, userData, discovery=None, transport=None):
+        '''
+        Borrows an engine, that is idle and has no other user with the same name configured.
+        discovery is a SnmpDiscoveryCache entry of the agent at the transport target, if one is known
+        '''
+        user_key = (str(userData.userName), str(userData.securityEngineId))
+        with self.lock:
+            self.stats['requests'] += 1
+            record = None
+            for r in self.engines:
+                if not r[2] and r[1].get(user_key, userData) is userData:
+                    record = r
+                    break
+            if record is None:
+                started = time.process_time()
+                record = [SnmpEngine(), {}, False, {}]
+                self.stats['engine_cpu'] += time.process_time() - started
+                self.stats['engines'] += 1
+                self.engines.append(record)
+            record[1][user_key] = userData
+            record[2] = True
+            if discovery is not None and transport is not None:
+                seed_key = (discovery['engine_id'], transport.getTransportInfo())
+                if seed_key not in record[3] and SnmpDiscoveryCache.seed_engine(record[0], discovery, seed_key[1]):
+                    record[3][seed_key] = discovery
+        try:
+            yield record[0]
+        finally:
+            with self.lock:
+                record[2] = False
+
+    def forget_engine(self, discovery, transport):
+        '''
+        Removes the seeded engine ID of an agent from all engines, e.g. after the agent got a new one
+        '''
+        seed_key = (discovery['engine_id'], transport.getTransportInfo())
+        with self.lock:
+            for record in self.engines:
+                if record[3].pop(seed_key, None) is not None:
+                    SnmpDiscoveryCache.unseed_engine(record[0], discovery, seed_key[1])
+
+    def report(self):
+        '''
+        Text summary of the work done and the work saved by sharing engines and keys
+        '''
+        s = self.stats
+        saved_engines = max(0, s['devices'] - s['engines'])
+        lines = ['SNMP engine pool: %d engines for %d devices, %d requests' % (s['engines'], s['devices'], s['requests'])]
+        if s['engines'] > 0:
+            lines.append('  engine setup:    %.3fs cpu, about %.3fs saved' % (s['engine_cpu'], s['engine_cpu'] / s['engines'] * saved_engines))
+        if s['master_keys'] > 0:
+            lines.append('  password hashes: %d computed in %.3fs cpu, %d reused, about %.3fs saved' % (
+                s['master_keys'], s['master_key_cpu'], s['master_key_hits'], s['master_key_cpu'] / s['master_keys'] * s['master_key_hits']))
+        if s['localized_keys'] > 0:
+            lines.append('  localized keys:  %d computed in %.3fs cpu, %d reused, about %.3fs saved' % (
+                s['localized_keys'], s['localized_key_cpu'], s['localized_key_hits'], s['localized_key_cpu'] / s['localized_keys'] * s['localized_key_hits']))
+        return '\n'.join(lines)
+
+snmp_engine_pool = SnmpEnginePool()
+
+
+'''
+Receives SNMP traps and informs and applies their varbinds to the cached rows of the device,
+that sent them. One thread with its own engine per local port serves all devices with the
+same trap_port, the sender is matched by IP address.
+
+linkUp/linkDown carry ifAdminStatus.N and ifOperStatus.N, pethPsePortOnOffNotification carries
+pethPsePortDetectionStatus.G.P, these update single rows. Traps without varbinds of a walked
+column (e.g. ATEN outlet traps) cause a refresh of the device instead.
+
+SNMPv3 traps are authenticated with the engine ID of the agent from the discovery cache,
+informs with the engine ID of the receiver.
+'''
+class SnmpTrapReceiver(threading.Thread):
+
+    receivers = {}
+    receivers_lock = threading.Lock()
+    # called with the device, after rows of a device were updated
+    update_callbacks = []
+    # called with the device, when a trap couldn't be applied to the rows
+    refresh_callbacks = []
+
+    @classmethod
+    def register(cls, device, port):
+        with cls.receivers_lock:
+            receiver = cls.receivers.get(port)
+            if receiver is None:
+                receiver = SnmpTrapReceiver(port)
+                cls.receivers[port] = receiver
+                receiver.start()
+        receiver.add_device(device)
+        return receiver
+
+    def __init__(self, port):
+        threading.Thread.__init__(self, name='SnmpTrapReceiver-%d' % port, daemon=True)
+        load_backend('snmp_traps')
+        self.port = port
+        self.lock = threading.Lock()
+        # ip -> list of devices
+        self.devices = {}
+        # (user name, engine id) of the configured users
+        self.users = set()
+        self.communities = set()
+        self.error = None
+        self.snmpEngine = snmp_entity_engine.SnmpEngine()
+        try:
+            snmp_config.addTransport(self.snmpEngine, snmp_udp.domainName,
+                                     snmp_udp.UdpTransport().openServerMode(('0.0.0.0', port)))
+        except Exception as e:
+            # e.g. no permission for port 162, the devices are polled only
+            self.error = e
+            return
+        snmp_ntfrcv.NotificationReceiver(self.snmpEngine, self._notification)
+
+    def add_device(self, device):
+        try:
+            ip = socket.gethostbyname(device.cfg['host'])
+        except OSError:
+            ip = device.cfg['host']
+        if self.error is not None:
+            # e.g. port 162 without root or the port is used by the daemon, the device gets no traps
+            device.set_background_error('traps', self.error)
+            return
+        with self.lock:
+            if device not in self.devices.get(ip, []):
+                self.devices.setdefault(ip, []).append(device)
+            self.add_user(device)
+            community = device.cfg.get('trap_community')
+            if community and community not in self.communities:
+                snmp_config.addV1System(self.snmpEngine, 'trap-%d' % len(self.communities), community)
+                self.communities.add(community)
+
+    def add_user(self, device):
+        '''
+        Adds the USM user of the device for informs and, once the engine ID of the agent is known, for traps
+        '''
+        engine_ids = [None]
+        if device.discovery is not None:
+            engine_ids.append(bytes.fromhex(device.discovery['engine_id']))
+        for engine_id in engine_ids:
+            if (device.cfg['user'], engine_id) in self.users:
+                continue
+            userData = snmp_engine_pool.get_user_data(device.cfg['user'], device.cfg['authkey'], device.cfg['privkey'],
+                                                      device.cfg['auth_protocol'], device.cfg['priv_protocol'], engine_id)
+            kwargs = {}
+            if engine_id is not None:
+                kwargs['securityEngineId'] = rfc1902.OctetString(engine_id)
+            if hasattr(userData, 'authKeyType'):
+                kwargs['authKeyType'] = userData.authKeyType
+                kwargs['privKeyType'] = userData.privKeyType
+            snmp_config.addV3User(self.snmpEngine, userData.userName, userData.authProtocol, userData.authKey,
+                                  userData.privProtocol, userData.privKey, **kwargs)
+            self.users.add((device.cfg['user'], engine_id))
+
+    def run(self):
+        if self.error is not None:
+            return
+        dispatcher = self.snmpEngine.transportDispatcher
+        dispatcher.jobStarted(1)
+        try:
+            dispatcher.runDispatcher()
+        except Exception as e:
+            # the devices are polled only from now on
+            self.error = e
+            with self.lock:
+                devices = [device for ip in self.devices for device in self.devices[ip]]
+            for device in devices:
+                device.set_background_error('traps', e)
+                for callback in self.update_callbacks:
+                    callback(device)
+
+    def _notification(self, snmpEngine, stateReference, contextEngineId, contextName, varBinds, cbCtx):
+        execContext = snmpEngine.observer.getExecutionContext('rfc3412.receiveMessage:request')
+        ip = execContext['transportAddress'][0]
+        varBinds = [(str(oid), value) for oid, value in varBinds]
+        with self.lock:
+            devices = list(self.devices.get(ip, []))
+        for device in devices:
+            try:
+                with device.io_lock:
+                    applied = device.apply_trap(varBinds)
+                device.set_background_error('traps', None)
+            except Exception as e:
+                # an exception would end the dispatcher, the refresh reads the rows instead
+                device.set_background_error('traps', e)
+                applied = False
+            callbacks = self.update_callbacks
+            if not applied:
+                callbacks = self.refresh_callbacks
+            for callback in callbacks:
+                callback(device)
+
+
+'''
+Common base class of the devices controlled with SNMPv3
+'''
+class SNMPDevice(PowerStripController):
+
+    # single values, key is used in the code, value is the OID
+    oids = {}
+    # start oids of table columns
+    bulk_cmd_oids = {}
+    # rows requested per GETBULK PDU. It is halved, when the agent answers with tooBig.
+    max_repetitions = 10
+    # poll class of the columns, columns not listed are 'fast' and walked on every refresh
+    column_classes = {}
+    # seconds between two walks of the columns of a poll class, can be set in the config as static_interval and slow_interval
+    poll_intervals = {'static': 3600, 'slow': 300, 'fast': 0}
+    # columns, that a switch command changes
+    switch_columns = []
+    # sysUpTime.0 and ifNumber.0, see SnmpGeometryCache
+    geometry_oids = ['.1.3.6.1.2.1.1.3.0', '.1.3.6.1.2.1.2.1.0']
+    # outlet state -> value written by switch_many
+    switch_values = {0: 1, 1: 2}
+    # varbinds per SET PDU, halved when the agent answers tooBig
+    max_set_varbinds = 64
+    # ARP tables, walked by ArpCache. ipNetToPhysicalTable also has IPv6 neighbours, old agents only have ipNetToMediaTable
+    arp_oids = {
+        'ipNetToPhysicalPhysAddress': '.1.3.6.1.2.1.4.35.1.4',
+        'ipNetToMediaPhysAddress': '.1.3.6.1.2.1.4.22.1.2',
+    }
+    # snmpEngineID, snmpEngineBoots and snmpEngineTime from SNMP-FRAMEWORK-MIB
+    engine_oids = ['.1.3.6.1.6.3.10.2.1.1.0', '.1.3.6.1.6.3.10.2.1.2.0', '.1.3.6.1.6.3.10.2.1.3.0']
+
+    def __init__(self, cfg):
+        super(SNMPDevice, self).__init__(cfg)
+        # for received data. key is same as in bulk_cmd_oids, value is a list with the value for each row
+        self.data = {}
+        # key is same as in bulk_cmd_oids, value maps the index of a row to its position
+        self.row_index = {}
+        # key is same as in bulk_cmd_oids, value is the time of the last walk of the column
+        self.polled = {}
+        # table sizes and index mappings, see discover_geometry
+        self.geometry = None
+        # time of the last check of the geometry with sysUpTime and ifNumber
+        self.geometry_checked = 0
+        if 'max_repetitions' in self.cfg:
+            self.max_repetitions = int(self.cfg['max_repetitions'])
+        self._configure_connection()
+        self.trap_receiver = None
+        self.arp_source = False
+
+    def start_background(self):
+        if self.trap_receiver is None and int(self.cfg.get('trap_port', 0)) > 0:
+            self.trap_receiver = SnmpTrapReceiver.register(self, int(self.cfg['trap_port']))
+        if not self.arp_source and self.cfg.getboolean('arp_table', False):
+            arp_cache.add_source(self)
+            self.arp_source = True
 
-    # pull into snmp client super class
     def _configure_connection(self):
-        self.snmpEngine = SnmpEngine()
-        authProtocol = usmHMACMD5AuthProtocol
-        privProtocol = usmAesCfb128Protocol
-        if self.cfg['auth_protocol'] == 'SHA':
-            authProtocol = usmHMACSHAAuthProtocol
-        if self.cfg['priv_protocol'] == 'DES':
-            privProtocol = usmDESPrivProtocol
-        self.userData = UsmUserData(self.cfg['user'], self.cfg['authkey'], self.cfg['privkey'], authProtocol=authProtocol, privProtocol=privProtocol)
         port = 161
         if not self.cfg['port'] == None:
             port = int(self.cfg['port'])
+        self.port = port
         self.transport = UdpTransportTarget((self.cfg['host'], port), timeout=0.5, retries=1)
+        self._configure_user()
+
+    def _configure_user(self):
+        # engines and keys are shared with the other SNMP devices
+        # with the engine ID from the last run the engine discovery is skipped
+        self.discovery = snmp_discovery_cache.get(self.cfg['host'], self.port)
+        # set after the first successful request with the cached parameters
+        self.discovery_confirmed = False
+        engine_id = None
+        if self.discovery is not None:
+            engine_id = bytes.fromhex(self.discovery['engine_id'])
+        self.userData = snmp_engine_pool.get_user_data(self.cfg['user'], self.cfg['authkey'], self.cfg['privkey'],
+                                                       self.cfg['auth_protocol'], self.cfg['priv_protocol'], engine_id,
+                                                       (self.cfg['host'], self.port))
+
+    # errorIndications, with which the agent rejects outdated engine parameters
+    discovery_errors = ('UnknownEngineID', 'NotInTimeWindow', 'WrongDigest', 'UnknownUserName',
+                        'UnknownSecurityName', 'AuthenticationFailure', 'DecryptionError')
+
+    def _request_done(self, errorIndication):
+        '''
+        Keeps the discovery cache valid. Cached engine parameters are dropped, when the agent rejects
+        them, the next request runs a regular discovery. A timeout drops them only, if they didn't work
+        once yet: pysnmp doesn't see the report of an agent with a new engine ID, the request times out.
+        A timeout of an agent, that answered before, keeps them, an unreachable agent doesn't cause a
+        rediscovery and a rewrite of the cache on every poll.
+        After a successful request without (or with old) cached parameters they are read from the agent.
+        '''
+        if errorIndication:
+            rejected = type(errorIndication).__name__ in self.discovery_errors
+            if self.discovery is not None and (rejected or not self.discovery_confirmed):
+                snmp_engine_pool.forget_engine(self.discovery, self.transport)
+                snmp_discovery_cache.forget(self.cfg['host'], self.port)
+                self._configure_user()
+        else:
+            self.discovery_confirmed = True
+            if snmp_discovery_cache.is_stale(self.discovery):
+                self._remember_engine()
+
+    def _remember_engine(self):
+        g = self._pooled_cmd(getCmd, *[ObjectType(ObjectIdentity(oid)) for oid in self.engine_oids])
+        try:
+            errorIndication, errorStatus, errorIndex, varBinds = next(g)
+        finally:
+            g.close()
+        if errorIndication or errorStatus:
+            return
+        try:
+            engine_id = varBinds[0][1].asOctets()
+            boots = int(varBinds[1][1])
+            engine_time = int(varBinds[2][1])
+        except Exception:
+            # noSuchObject, the agent doesn't implement SNMP-FRAMEWORK-MIB
+            return
+        self.discovery = snmp_discovery_cache.put(self.cfg['host'], self.port, engine_id, boots, engine_time)
+        if self.trap_receiver is not None:
+            # the traps of the agent can be authenticated now
+            with self.trap_receiver.lock:
+                self.trap_receiver.add_user(self)
+
+    def _get_oid(self, oidKey):
+        if oidKey in self.oids:
+            return self.oids[oidKey]
+        if oidKey in self.arp_oids:
+            return self.arp_oids[oidKey]
+        return self.bulk_cmd_oids[oidKey]
 
-    # pull into snmp client super class
     def _getObjectType(self, oidKey):
-         if oidKey in self.oids:
-	         objectType = ObjectType(self.oids[oidKey]) #.addAsn1MibSource( 'file:///home/gobuki/bin/snmp/PE_MIB_1.1.115')
-         else:
-	         objectType = ObjectType(self.bulk_cmd_oids[oidKey]) #.addAsn1MibSource( 'file:///home/gobuki/bin/snmp/PE_MIB_1.1.115')
-         return objectType
-
-    def _parse_mac_addresses(self, iterator):
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
+        return ObjectType(ObjectIdentity(self._get_oid(oidKey)))
+
+    @staticmethod
+    def _has_value(varBind):
+        '''
+        False for the exception values endOfMibView, noSuchObject and noSuchInstance. pysnmp returns
+        a last row with endOfMibView and the OID of the row before at the end of a table
+        '''
+        return not isinstance(varBind[1], (EndOfMibView, NoSuchObject, NoSuchInstance))
+
+    def _raise_error(self, errorIndication, errorStatus, errorIndex, varBinds):
+        '''
+        Raises the error of a request as IOError, the DevicePoller shows it as last_error.
+        Nothing is printed, the requests run in worker threads while the ui is shown
+        '''
         if errorIndication:
-            print(errorIndication)
-        elif errorStatus:
-            print('%s at %s' % (errorStatus.prettyPrint(),
-                        errorIndex and varBinds[int(errorIndex) - 1][0] or '?'))
+            raise IOError('%s: %s' % (self.cfg['host'], errorIndication))
+        raise IOError('%s: %s at %s' % (self.cfg['host'], errorStatus.prettyPrint(),
+                                        errorIndex and varBinds[int(errorIndex) - 1][0] or '?'))
+
+    def _pooled_cmd(self, cmd, *args, **kwargs):
+        '''
+        Runs a pysnmp.hlapi command generator with an engine from the pool.
+        The engine is given back, when the generator is exhausted or closed
+        '''
+        with snmp_engine_pool.engine(self.userData, self.discovery, self.transport) as snmpEngine:
+            for result in cmd(snmpEngine, self.userData, self.transport, ContextData(), *args, **kwargs):
+                yield result
+
+    def _snmp_request(self, cmd, *varBinds):
+        '''
+        Single request with an engine from the pool, returns
+        errorIndication, errorStatus, errorIndex, varBinds
+        '''
+        with snmp_engine_pool.engine(self.userData, self.discovery, self.transport) as snmpEngine:
+            result = next(cmd(snmpEngine, self.userData, self.transport, ContextData(), *varBinds))
+        self._request_done(result[0])
+        return result
+
+    def get_result(self, iterator):
+        listvar = []
+        try:
+            errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
+        finally:
+            iterator.close()
+        self._request_done(errorIndication)
+        if errorIndication or errorStatus:
+            self._raise_error(errorIndication, errorStatus, errorIndex, varBinds)
+        for varBind in varBinds:
+            listvar.append(str(varBind[1]))
+        return listvar
+
+    def getGetCmd(self, oidKey):
+        if isinstance(oidKey, str):
+            return self._pooled_cmd(getCmd, self._getObjectType(oidKey))
         else:
-            for varBind in varBinds:
-                # cut off the prefix, so only 6 values separated by dots should remain
-                mac_as_oid = str(varBind[0]).replace('1.3.6.1.2.1.17.4.3.1.2.','')
-                split_oid = mac_as_oid.split('.')
-                if len(split_oid) == 6:
-                    iPort = varBind[1]
-                    if iPort <= 8:
-                        if not str(iPort) in self.mac_addresses:
-                            self.mac_addresses[str(iPort)] = [self.oid2mac(split_oid)]
-                        else:
-                            self.mac_addresses[str(iPort)].append(self.oid2mac(split_oid))
-                        #print(self.oid2mac(split_oid) + " found at port " + str(varBind[1]))
-
-    def _append_result(self, iterator, listvar):
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-        if errorIndication:
-            print(errorIndication)
-        elif errorStatus:
-            print('%s at %s' % (errorStatus.prettyPrint(),
-                        errorIndex and varBinds[int(errorIndex) - 1][0] or '?'))
+            object_types = [self._getObjectType(key) for key in oidKey]
+            return self._pooled_cmd(getCmd, *object_types)
+
+    def _walk_table(self, column_keys, max_rows=None, scalar_keys=()):
+        '''
+        Walks the given table columns side by side. All columns are requested as varbinds
+        of the same GETBULK PDU and each PDU returns max_repetitions rows, so a table with
+        n rows costs about n / max_repetitions round trips instead of n round trips per column.
+        The walk stops at the first row, in which all columns left their table, or after max_rows rows.
+
+        Returns a dict with a list of (index, value) tuples for each column key. The index is the
+        OID suffix following the column OID, e.g. '3' for outlet 3 or '1.3' for PoE group 1, port 3.
+
+        scalar_keys are requested as non-repeaters in the same PDU, their OID is the one before the
+        value (e.g. sysUpTime for sysUpTime.0). The dict has the value of the first response for them
+        '''
+        prefixes = [self._get_oid(key).lstrip('.') + '.' for key in column_keys]
+        non_repeaters = len(scalar_keys)
+        max_repetitions = self.max_repetitions
+        if max_rows is not None:
+            max_repetitions = min(max_repetitions, max_rows)
+
+        while True:
+            columns = dict((key, []) for key in column_keys)
+            too_big = False
+            error = None
+            rows = 0
+            g = self._pooled_cmd(bulkCmd, non_repeaters, max_repetitions,
+                                 *[self._getObjectType(key) for key in list(scalar_keys) + column_keys], lexicographicMode=False)
+            for errorIndication, errorStatus, errorIndex, varBinds in g:
+                if errorStatus and int(errorStatus) == 1 and max_repetitions > 1:
+                    # tooBig, retry with smaller responses
+                    too_big = True
+                    break
+                if errorIndication or errorStatus:
+                    error = (errorIndication, errorStatus, errorIndex, varBinds)
+                    break
+
+                if rows == 0:
+                    for key, varBind in zip(scalar_keys, varBinds[:non_repeaters]):
+                        if self._has_value(varBind):
+                            columns[key] = varBind[1]
+                in_table = False
+                for key, prefix, varBind in zip(column_keys, prefixes, varBinds[non_repeaters:]):
+                    oid = str(varBind[0])
+                    if oid.startswith(prefix) and self._has_value(varBind):
+                        columns[key].append((oid[len(prefix):], varBind[1]))
+                        in_table = True
+                if not in_table:
+                    break
+                rows += 1
+                if max_rows is not None and rows >= max_rows:
+                    break
+
+            g.close()
+            if not too_big:
+                # partial columns would look like a changed table
+                self._request_done(error and error[0])
+                if error is not None:
+                    self._raise_error(*error)
+                return columns
+            max_repetitions = max(1, max_repetitions // 2)
+            self.max_repetitions = max_repetitions
+
+    def _switch_oid(self, outlet_id):
+        '''
+        Returns the OID, that switches the outlet
+        '''
+        raise NotImplementedError()
+
+    def switch_on(self, outlet_id):
+        self.switch_many({outlet_id: 1})
+
+    def switch_off(self, outlet_id):
+        self.switch_many({outlet_id: 0})
+
+    def switch_many(self, states):
+        '''
+        Switches several outlets, states is a dict {outlet_id: 0 or 1}.
+        All changes are sent as varbinds of one SET PDU. If the agent answers tooBig,
+        they are sent in smaller chunks and the chunk size is kept for the next time
+        '''
+        changes = [(outlet_id, (self._switch_oid(outlet_id), rfc1902.Integer(self.switch_values[1 if states[outlet_id] else 0])))
+                   for outlet_id in sorted(states)]
+        while len(changes) > 0:
+            chunk = changes[:self.max_set_varbinds]
+            errorIndication, errorStatus, errorIndex, varBinds = self._snmp_request(setCmd, *[varBind for outlet_id, varBind in chunk])
+            if errorStatus and int(errorStatus) == 1 and len(chunk) > 1:
+                # tooBig
+                self.max_set_varbinds = max(1, len(chunk) // 2)
+                continue
+            if errorIndication:
+                raise IOError(str(errorIndication))
+            if errorStatus:
+                raise IOError('%s at outlet %d' % (errorStatus.prettyPrint(), chunk[max(0, int(errorIndex) - 1)][0]))
+            for outlet_id, varBind in chunk:
+                if states[outlet_id]:
+                    self._apply_on_state(self.outlets, outlet_id)
+                else:
+                    self._apply_off_state(self.outlets, outlet_id)
+            changes = changes[len(chunk):]
+        self._columns_changed(self.switch_columns)
+
+    def _walk_column(self, key, max_rows=None, start_index=None):
+        '''
+        Yields (index, value) of a table column, while the responses arrive, so a large table is
+        never kept as a whole. After tooBig the walk continues after the last row with smaller responses.
+        With start_index the walk begins after that row
+        '''
+        prefix = self._get_oid(key).lstrip('.') + '.'
+        start = self._get_oid(key)
+        if start_index is not None:
+            start = prefix + start_index
+        max_repetitions = self.max_repetitions
+        rows = 0
+        while True:
+            too_big = False
+            error = None
+            g = self._pooled_cmd(bulkCmd, 0, max_repetitions, ObjectType(ObjectIdentity(start)), lexicographicMode=True)
+            try:
+                for errorIndication, errorStatus, errorIndex, varBinds in g:
+                    if errorStatus and int(errorStatus) == 1 and max_repetitions > 1:
+                        too_big = True
+                        break
+                    if errorIndication or errorStatus:
+                        error = (errorIndication, errorStatus, errorIndex, varBinds)
+                        break
+                    oid = str(varBinds[0][0])
+                    if not oid.startswith(prefix) or not self._has_value(varBinds[0]):
+                        break
+                    yield oid[len(prefix):], varBinds[0][1]
+                    start = oid
+                    rows += 1
+                    if max_rows is not None and rows >= max_rows:
+                        break
+            finally:
+                g.close()
+            if not too_big:
+                self._request_done(error and error[0])
+                if error is not None:
+                    self._raise_error(*error)
+                return
+            max_repetitions = max(1, max_repetitions // 2)
+            self.max_repetitions = max_repetitions
+
+    def _store_columns(self, columns):
+        '''
+        Stores the walked values as strings in self.data and returns the number of complete rows
+        '''
+        if not any(columns.values()):
+            return 0
+        for key in columns:
+            self.data[key] = [str(value) for index, value in columns[key]]
+            self.row_index[key] = dict((index, i) for i, (index, value) in enumerate(columns[key]))
+        return min(len(columns[key]) for key in columns)
+
+    def discover_geometry(self):
+        '''
+        Returns a dict with the index lists of the tables of the device, e.g. the index of each port
+        '''
+        return {}
+
+    def get_geometry(self):
+        '''
+        Returns the geometry of the device. It is discovered once and cached on disk, later it is
+        checked with one GET of sysUpTime and ifNumber every slow_interval seconds and discovered
+        again, if the agent restarted or its interfaces changed. Returns {}, if the agent can't be reached
+        '''
+        interval = float(self.cfg.get('slow_interval', self.poll_intervals['slow']))
+        if self.geometry is not None and time.time() - self.geometry_checked < interval:
+            return self.geometry
+        errorIndication, errorStatus, errorIndex, varBinds = self._snmp_request(
+            getCmd, *[ObjectType(ObjectIdentity(oid)) for oid in self.geometry_oids])
+        if errorIndication or errorStatus:
+            return self.geometry or {}
+        uptime = int(varBinds[0][1])
+        try:
+            if_number = int(varBinds[1][1])
+        except (TypeError, ValueError):
+            # noSuchObject, e.g. a PDU without IF-MIB
+            if_number = None
+        self.geometry_checked = time.time()
+        entry = snmp_geometry_cache.get(self.cfg['host'], self.port)
+        if snmp_geometry_cache.is_valid(entry, uptime, if_number):
+            self.geometry = entry['geometry']
         else:
-            for varBind in varBinds:
-                listvar.append(str(varBind[1]))
+            self.geometry = self.discover_geometry()
+            snmp_geometry_cache.put(self.cfg['host'], self.port, uptime, if_number, self.geometry)
+            # the rows of all columns may have moved
+            self.polled.clear()
+        return self.geometry
+
+    def _value(self, key, index):
+        '''
+        Returns the walked value of a column at the row with the index, None if the row wasn't walked
+        '''
+        row = self.row_index.get(key, {}).get(index)
+        if row is None:
+            return None
+        return self.data[key][row]
+
+    def _outlet_of_index(self, key, index):
+        '''
+        Returns the outlet (starting with 0), that the row of a column with the index belongs to, or None
+        '''
+        return self.row_index[key].get(index)
+
+    def _due_columns(self, column_keys):
+        '''
+        Returns the columns, that have to be walked now, because their poll interval passed
+        '''
+        now = time.time()
+        due = []
+        for key in column_keys:
+            poll_class = self.column_classes.get(key, 'fast')
+            interval = float(self.cfg.get(poll_class + '_interval', self.poll_intervals[poll_class]))
+            if not key in self.polled or now - self.polled[key] >= interval:
+                due.append(key)
+        return due
+
+    def _refresh_columns(self, column_keys, max_rows=None, scalar_keys=()):
+        '''
+        Walks the due columns of a table. If a column has more or fewer rows than at its last walk,
+        all columns are walked again and the geometry is discovered again. The values of scalar_keys
+        are read with the walk (see _walk_table) and stored in self.data, if any column is due
+        '''
+        due = self._due_columns(column_keys)
+        if len(due) == 0:
+            return
+        lengths = dict((key, len(self.data[key])) for key in due if key in self.data)
+        columns = self._walk_table(due, max_rows, scalar_keys)
+        for key in scalar_keys:
+            self.data[key] = columns.pop(key, None)
+        self._store_columns(columns)
+        now = time.time()
+        for key in due:
+            if len(columns[key]) > 0:
+                self.polled[key] = now
+        changed = [key for key in lengths if len(self.data[key]) != lengths[key]]
+        if changed and len(due) < len(column_keys):
+            # e.g. a module was added, the columns of the other classes and the geometry are outdated
+            self._columns_changed(column_keys)
+            snmp_geometry_cache.forget(self.cfg['host'], self.port)
+            self.geometry = None
+            self.get_geometry()
+            self._refresh_columns(column_keys, max_rows, scalar_keys)
+
+    def _columns_changed(self, column_keys):
+        '''
+        The columns are walked at the next refresh, whatever their poll class is
+        '''
+        for key in column_keys:
+            self.polled.pop(key, None)
+
+    def invalidate(self):
+        '''
+        All columns are walked at the next refresh and the geometry is checked again
+        '''
+        self.polled.clear()
+        self.geometry = None
+
+    def apply_trap(self, varBinds):
+        '''
+        Stores the varbinds of a trap, that belong to walked columns, in self.data and updates the affected outlets.
+        Returns False, if the trap has no varbind of a walked column and the device has to be refreshed
+        '''
+        understood = False
+        changed_rows = set()
+        for oid, value in varBinds:
+            for key in self.row_index:
+                prefix = self._get_oid(key).lstrip('.') + '.'
+                if oid.startswith(prefix):
+                    understood = True
+                    index = oid[len(prefix):]
+                    row = self.row_index[key].get(index)
+                    if row is not None:
+                        self.data[key][row] = str(value)
+                        # rows, that are not shown (e.g. uplink ports) are ignored
+                        outlet = self._outlet_of_index(key, index)
+                        if outlet is not None:
+                            changed_rows.add(outlet)
+        rows = len(self.outlets)
+        for row in changed_rows:
+            if row < rows:
+                self._update_outlet(row)
+        if not understood:
+            # e.g. coldStart or a configuration change, everything is read again
+            self.invalidate()
+        return understood
 
-    def refresh_status(self):
-        for key in self.bulk_cmd_oids:
-            self.bulk_cmds[key] = self._get_bulk_cmd(key)
-            if key not in self.data:
-                self.data[key] = []
-        for key in self.data:
-            self.data[key].clear()
-
-        self.bulkCmdMacAddresses = bulkCmd(self.snmpEngine, self.userData, self.transport, ContextData(), 0, 7, self._getObjectType('macAddresses'))
-        self._get_mac_addresses()
- 
-        for i in range(0, 8):
-            for key in self.bulk_cmds:
-                self._append_result(self.bulk_cmds[key], self.data[key])
 
-            self.data["pethPsePortAdminEnable"][i] = int(self.data["pethPsePortAdminEnable"][i])
 
-            itype = int(self.data['ifJackType'][i])
-            stype = ""
-            slink = ""
-            link_status = int(self.data['ifOperStatus'][i])
-           
-            if link_status == 1:
-                slink = "up"
-            elif link_status == 2:
-                slink = "down"
+'''
+Rates of the interface counters of all ports of a switch. The counters of one walk are kept
+in arrays and the rates of all ports are computed in one pass over the previous and the current
+arrays. The time between two walks is taken from sysUpTime, so the rates don't depend on the
+network latency. A lower sysUpTime means the agent restarted, then there are no rates until the next walk.
+32 bit counters wrap, a 64 bit counter never wraps between two polls, so a lower value is a reset of the port.
 
-            if itype == 2:
-                stype = "RJ45 PoE, " + slink
-            else:
-                stype = '<unsupported>'
- 
-            mac_addrs = []
-            if str(i+1) in self.mac_addresses:
-                mac_addrs = self.mac_addresses[str(i+1)]
-
-            outlet = { 
-                    'name': self.data['ifAlias'][i],
-                    'state': int(self.data['pethPsePortAdminEnable'][i]) - 1,
-                    'preset1': 0,
-                    'preset2': 0,
-                    'preset3': 0,
-                    'type': stype,
-                    'mac_addrs': mac_addrs
-            }
-            if i < len(self.outlets):
-                for key in outlet:
-                    self.outlets[i][key] = outlet[key]
-            else:
-                self.outlets.append(outlet)
-        
+The in and out rates of the last history_size walks are kept in a RingBuffer per port.
+'''
+class TrafficCounters(object):
+
+    # column, counter bits
+    counters = [('ifHCInOctets', 64), ('ifHCOutOctets', 64), ('ifInErrors', 32), ('ifOutErrors', 32),
+                ('ifInDiscards', 32), ('ifOutDiscards', 32)]
+    default_history = 240
+
+    def __init__(self, history_size=default_history):
+        self.history_size = history_size
+        self.uptime = None
+        # column -> array of the counters of the last walk
+        self.values = {}
+        # column -> array of the rates per second, NaN if unknown
+        self.rates = {}
+        # (column, port) -> RingBuffer of rates, for ifHCInOctets and ifHCOutOctets. NaN marks a gap
+        self.history = {}
+
+    def update(self, uptime, columns, t=None):
+        '''
+        uptime is sysUpTime in 1/100 seconds, columns has a list of counter values of all ports
+        for each entry of counters. Returns False, if there is no previous walk to compare with
+        '''
+        if t is None:
+            t = time.time()
+        values = {}
+        for (name, bits), column in zip(self.counters, columns):
+            values[name] = array('Q', (int(v) for v in column))
+        previous = self.values
+        ports = len(values[self.counters[0][0]])
+        valid = (self.uptime is not None and uptime > self.uptime
+                 and all(len(previous.get(name, ())) == ports for name in values))
+        nan = float('nan')
+        if valid:
+            seconds = (uptime - self.uptime) / 100.0
+            for name, bits in self.counters:
+                modulus = 1 << bits
+                if bits == 64:
+                    self.rates[name] = array('d', ((c - p) / seconds if c >= p else nan
+                                                   for c, p in zip(values[name], previous[name])))
+                else:
+                    self.rates[name] = array('d', (((c - p) % modulus) / seconds
+                                                   for c, p in zip(values[name], previous[name])))
+            # a 64 bit counter, that went back, is a discontinuity of the port (e.g. a reset of the
+            # interface or a replaced module), the 32 bit counters can't show it and are unknown too
+            for port in range(ports):
+                if any(self.rates[name][port] != self.rates[name][port] for name in ('ifHCInOctets', 'ifHCOutOctets')):
+                    for name, bits in self.counters:
+                        self.rates[name][port] = nan
+            for name in ('ifHCInOctets', 'ifHCOutOctets'):
+                for port, rate in enumerate(self.rates[name]):
+                    buffer = self.history.get((name, port))
+                    if buffer is None:
+                        buffer = RingBuffer(self.history_size)
+                        self.history[(name, port)] = buffer
+                    buffer.append(t, rate)
+        else:
+            # restart of the agent (sysUpTime went back) or the first walk
+            self.reset(t)
+        self.values = values
+        self.uptime = uptime
+        return valid
+
+    def reset(self, t=None):
+        '''
+        Forgets the counters and rates, e.g. when the agent restarted or a walk returned no counters.
+        The next update has no rates, the history gets a gap
+        '''
+        if t is None:
+            t = time.time()
+        self.uptime = None
+        self.values = {}
+        self.rates = {}
+        for buffer in self.history.values():
+            last = buffer.last()
+            if last is not None and last[1] == last[1]:
+                buffer.append(t, float('nan'))
+
+    def port_rates(self, port):
+        '''
+        Returns the outlet values of a port (counting from 0): rx_bps and tx_bps in bits per second,
+        error_rate and discard_rate in packets per second. Unknown rates are None, so they replace
+        the ones of an earlier walk
+        '''
+        result = {'rx_bps': None, 'tx_bps': None, 'error_rate': None, 'discard_rate': None}
+        if not self.rates or port >= len(self.rates['ifHCInOctets']):
+            return result
+        r = dict((name, self.rates[name][port]) for name, bits in self.counters)
+        if r['ifHCInOctets'] == r['ifHCInOctets']:
+            result['rx_bps'] = r['ifHCInOctets'] * 8
+        if r['ifHCOutOctets'] == r['ifHCOutOctets']:
+            result['tx_bps'] = r['ifHCOutOctets'] * 8
+        if r['ifInErrors'] == r['ifInErrors']:
+            result['error_rate'] = r['ifInErrors'] + r['ifOutErrors']
+            result['discard_rate'] = r['ifInDiscards'] + r['ifOutDiscards']
+        return result
 
-    def switch_on(self, outlet_id):
-        self._switch(outlet_id, 2)
-        self._apply_on_state(self.outlets, outlet_id)
+    def get_history(self, port, direction='in', since=None):
+        '''
+        Returns the (time, bytes per second) tuples of a port, oldest first. A NaN rate marks a gap,
+        the agent restarted or the counter of the port was reset
+        '''
+        name = {'in': 'ifHCInOctets', 'out': 'ifHCOutOctets'}[direction]
+        buffer = self.history.get((name, port))
+        if buffer is None:
+            return []
+        return buffer.items(since)
+
+def format_bps(bps):
+    for unit, factor in (('G', 1e9), ('M', 1e6), ('k', 1e3)):
+        if bps >= factor:
+            return '%.1f%s' % (bps / factor, unit)
+    return '%.0f' % bps
+
+
+def parse_mac(text):
+    '''
+    Returns the MAC as int, accepts aa:bb:cc:dd:ee:ff, aa-bb-cc-dd-ee-ff, aabb.ccdd.eeff and aabbccddeeff
+    '''
+    digits = text.replace(':', '').replace('-', '').replace('.', '')
+    if len(digits) != 12:
+        raise ValueError('not a MAC address: ' + text)
+    return int(digits, 16)
+
+def format_mac(mac):
+    return ':'.join('%0.2X' % ((mac >> shift) & 0xff) for shift in range(40, -8, -8))
+
+def find_mac(mac, devices):
+    '''
+    Returns (device, ifIndex, number of MACs on the port) for each switch, that knows the MAC.
+    Ports with fewer MACs come first, the device is most likely plugged into the first one
+    '''
+    found = []
+    for device in devices:
+        if_index = device.find_mac(mac)
+        if if_index is not None:
+            found.append((device, if_index, len(device.port_macs.get(if_index, []))))
+    return sorted(found, key=lambda f: f[2])
+
+
+'''
+Power over Ethernet Power Sourcing Equipment
+Uses standard SNMP OIDs and should be compatible with most PoE devices with SNMP
+'''
+class PoEPSE(SNMPDevice):
+  
+    oids = {
+        # single values
+        'sysName': '.1.3.6.1.2.1.1.5.0',
+        # read as non-repeater with the port walk, returns sysUpTime.0
+        'sysUpTime': '.1.3.6.1.2.1.1.3',
+    }
+    bulk_cmd_oids = {
+	# start oids
+        'ifAlias': '.1.3.6.1.2.1.31.1.1.1.18',
+        'ifName': '.1.3.6.1.2.1.31.1.1.1.1',
+        'ifAdminStatus': '.1.3.6.1.2.1.2.2.1.7',
+        'ifOperStatus': '.1.3.6.1.2.1.2.2.1.8',
+        'ifMtu': '.1.3.6.1.2.1.2.2.1.4',
+        'ifJackType': '.1.3.6.1.2.1.26.2.2.1.2',
+        # indexed by PoE group and port
+        'pethPsePortAdminEnable': '.1.3.6.1.2.1.105.1.1.1.3',
+        'pethPsePortDetectionStatus': '.1.3.6.1.2.1.105.1.1.1.6',
+        # dot1dBasePortIfIndex, maps the bridge ports of the forwarding table to ifIndex
+        'bridgePortIfIndex': '.1.3.6.1.2.1.17.1.4.1.2',
+        'macAddresses': '.1.3.6.1.2.1.17.4.3.1.2',
+        # traffic counters
+        'ifHCInOctets': '.1.3.6.1.2.1.31.1.1.1.6',
+        'ifHCOutOctets': '.1.3.6.1.2.1.31.1.1.1.10',
+        'ifInDiscards': '.1.3.6.1.2.1.2.2.1.13',
+        'ifInErrors': '.1.3.6.1.2.1.2.2.1.14',
+        'ifOutDiscards': '.1.3.6.1.2.1.2.2.1.19',
+        'ifOutErrors': '.1.3.6.1.2.1.2.2.1.20',
+    }
+    # walked together, the forwarding table (macAddresses) is walked separately
+    port_columns = ['ifAlias', 'ifAdminStatus', 'ifOperStatus', 'ifMtu', 'ifJackType', 'pethPsePortAdminEnable',
+                    'pethPsePortDetectionStatus']
+    # indexed by 'group.port', the other port columns by ifIndex
+    poe_columns = ['pethPsePortAdminEnable', 'pethPsePortDetectionStatus']
+    detection_status = {1: 'disabled', 2: 'searching', 3: 'delivering power', 4: 'fault', 5: 'test', 6: 'other fault'}
+    column_classes = {
+        'ifMtu': 'static',
+        'ifJackType': 'static',
+        'ifAlias': 'slow',
+        'macAddresses': 'slow',
+    }
+    switch_columns = ['pethPsePortAdminEnable', 'pethPsePortDetectionStatus']
+    # walked with the port columns on every refresh, unless traffic=no
+    counter_columns = [name for name, bits in TrafficCounters.counters]
+
+    def __init__(self, cfg):
+        super(PoEPSE, self).__init__(cfg)
+        if not self.cfg.getboolean('traffic', True):
+            self.counter_columns = []
+        self.traffic = TrafficCounters(int(self.cfg.get('traffic_history', TrafficCounters.default_history)))
+        # forwarding table, MAC as 48 bit int -> ifIndex of the port, where it was seen
+        self.mac_index = {}
+        # ifIndex -> MACs as ints
+        self.port_macs = {}
+
+    def discover_geometry(self):
+        '''
+        PoE ports of all groups as 'group.port', the ifIndex of each PoE port, the number of ifTable
+        rows up to the last PoE port and the bridge port -> ifIndex mapping of the forwarding table.
+        POWER-ETHERNET-MIB doesn't tell the ifIndex of a port. With one group the port number is the
+        ifIndex, with several (stacks, modules) the ifName of the port is looked up, e.g. 2/5 or 2/1/5
+        for group 2, port 5
+        '''
+        ports = [index for index, value in self._walk_table(['pethPsePortAdminEnable'])['pethPsePortAdminEnable']]
+        if len(ports) == 0:
+            raise IOError('no PoE ports found on ' + self.cfg['host'])
+        if_names = [(int(index), str(name)) for index, name in self._walk_table(['ifName'])['ifName']]
+        several_groups = len(set(port.split('.')[0] for port in ports)) > 1
+        if_indexes = []
+        for port in ports:
+            group, number = port.split('.')
+            if_index = int(number)
+            if several_groups:
+                pattern = re.compile(r'(^|\D)%s/(\d+/)?%s$' % (group, number))
+                for index, name in if_names:
+                    if pattern.search(name):
+                        if_index = index
+                        break
+            if_indexes.append(if_index)
+        last = max(if_indexes)
+        if_rows = len([index for index, name in if_names if index <= last]) or last
+        bridge_ports = self._walk_table(['bridgePortIfIndex'])['bridgePortIfIndex']
+        return {
+            'ports': ports,
+            'if_indexes': if_indexes,
+            'if_rows': if_rows,
+            'bridge_ports': dict((index, int(if_index)) for index, if_index in bridge_ports),
+        }
+
+    def _port_value(self, key, port):
+        '''
+        Returns the walked value of a port column for the port (starting with 0)
+        '''
+        if key in self.poe_columns:
+            return self._value(key, self.geometry['ports'][port])
+        return self._value(key, str(self.geometry['if_indexes'][port]))
+
+    def _outlet_of_index(self, key, index):
+        try:
+            if key in self.poe_columns:
+                return self.geometry['ports'].index(index)
+            return self.geometry['if_indexes'].index(int(index))
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def refresh_fdb(self, bridge_ports=None):
+        '''
+        Walks the whole forwarding table and rebuilds the MAC index of the switch
+        '''
+        if bridge_ports is None:
+            bridge_ports = self.get_geometry().get('bridge_ports', {})
+        mac_index = {}
+        port_macs = {}
+        for index, port in self._walk_column('macAddresses'):
+            # the index is the MAC, 6 values separated by dots
+            split_oid = index.split('.')
+            if len(split_oid) != 6:
+                continue
+            mac = 0
+            for byte in split_oid:
+                mac = (mac << 8) | int(byte)
+            # the value is the bridge port, PoE port n is ifIndex n
+            if_index = bridge_ports.get(str(port), int(port))
+            mac_index[mac] = if_index
+            port_macs.setdefault(if_index, []).append(mac)
+        self.mac_index = mac_index
+        self.port_macs = port_macs
+        self.polled['macAddresses'] = time.time()
+
+    def find_mac(self, mac):
+        '''
+        Returns the ifIndex of the port, where the MAC (as int) was seen, or None
+        '''
+        return self.mac_index.get(mac)
+
+    def refresh_status(self):
+        geometry = self.get_geometry()
+        if not geometry:
+            raise IOError('no answer from ' + self.cfg['host'])
+        if self._due_columns(['macAddresses']):
+            self.refresh_fdb(geometry['bridge_ports'])
+        self._refresh_columns(self.port_columns + self.counter_columns, scalar_keys=['sysUpTime'],
+                              max_rows=max(len(geometry['ports']), geometry['if_rows']))
+        if self.counter_columns and self.data.get('ifAlias') and not all(self.data.get(key) for key in self.counter_columns):
+            # no IF-MIB counters, e.g. an agent without ifXTable
+            self.counter_columns = []
+            self.traffic.reset()
+        # the geometry is discovered again, if the walk found a changed table
+        geometry = self.geometry
+        ports = len(geometry['ports'])
+        if self.counter_columns and self.data.get('sysUpTime') is not None:
+            counters = [[self._port_value(key, port) for port in range(ports)] for key in self.counter_columns]
+            if all(None not in column for column in counters):
+                self.traffic.update(int(self.data['sysUpTime']), counters)
+            else:
+                # the rates of the last complete walk are outdated
+                self.traffic.reset()
+
+        del self.outlets[ports:]
+        for i in range(0, ports):
+            self._update_outlet(i)
+
+    def _update_outlet(self, i):
+        values = dict((key, self._port_value(key, i)) for key in self.port_columns)
+        if None in values.values():
+            raise IOError('no values of port %s from %s' % (self.geometry['ports'][i], self.cfg['host']))
+
+        itype = int(values['ifJackType'])
+        stype = ""
+        slink = ""
+        link_status = int(values['ifOperStatus'])
+       
+        if link_status == 1:
+            slink = "up"
+        elif link_status == 2:
+            slink = "down"
+
+        if itype == 2:
+            stype = "RJ45 PoE, " + slink
+        else:
+            stype = '<unsupported>'
  
-    def switch_off(self, outlet_id):
-        self._switch(outlet_id, 1)
-        self._apply_off_state(self.outlets, outlet_id)
+        macs = self.port_macs.get(self.geometry['if_indexes'][i], [])
+        mac_addrs = [format_mac(mac) for mac in macs]
+        ip_addrs = []
+        for mac in macs:
+            ip_addrs.extend(arp_cache.lookup(mac))
+
+        outlet = { 
+                'name': values['ifAlias'],
+                'state': int(values['pethPsePortAdminEnable']) - 1,
+                'preset1': 0,
+                'preset2': 0,
+                'preset3': 0,
+                'type': stype,
+                'mac_addrs': mac_addrs,
+                'ip_addrs': ip_addrs,
+                'admin_status': int(values['ifAdminStatus']),
+                'oper_status': link_status,
+                'poe_status': self.detection_status.get(int(values['pethPsePortDetectionStatus']), 'unknown')
+        }
+        outlet.update(self.traffic.port_rates(i))
+        self._store_outlet(i, outlet)
 
     def toggle_outlet(self, outlet_id):
         if self.outlets[outlet_id-1]['state'] == 0:
@@ -598,182 +2638,155 @@ class PoEPSE(PowerStripController):
         else:
             self.switch_off(outlet_id)
 
-    def _switch(self, outlet_id, status):
-        g = setCmd(
-            self.snmpEngine,
-            self.userData,
-            self.transport,
-            ContextData(),
-            ((1, 3, 6, 1, 2, 1, 105, 1, 1, 1, 3, 1, outlet_id), rfc1902.Integer(status))
-        )
-        next(g)
+    def _switch_oid(self, outlet_id):
+        # pethPsePortAdminEnable.group.port
+        port = self.get_geometry()['ports'][outlet_id-1]
+        return (1, 3, 6, 1, 2, 1, 105, 1, 1, 1, 3) + tuple(int(n) for n in port.split('.'))
 
 '''
 Controls ATEN PDUs using SNMP. Support is specific to ATEN devices.
 I developed it for PE8108G, but it should be compatible with PE8104G for example and mabye even others
 '''
-class AtenPDU(PowerStripController):
+class AtenPDU(SNMPDevice):
 
     oids = {                                                                               
         # single values
-        'sysName': ObjectIdentity('.1.3.6.1.2.1.1.5.0'),
-        'modelName': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.1.0'),
-        'uptime': ObjectIdentity('.1.3.6.1.2.1.1.3.0'),
-        'time': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.3.4.8.2.2.0'),
-        'date': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.3.4.8.2.1.0'),
-        'deviceMAC': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.3.4.1.0'),
-        'deviceIP': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.3.4.2.0'),
-        'deviceFWVersion': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.3.4.3.0'),
-        'devicePower': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.4.1'),
-        'devicePowerDissipation': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.5.1'),
-        'deviceVoltage': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.3.1'),
-        'deviceCurrent': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.2.1'),
-        'inputMaxVoltage': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.6.1'),
-        'inputMaxCurrent': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.7.1'),
+        'sysName': '.1.3.6.1.2.1.1.5.0',
+        'modelName': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.1.0',
+        'uptime': '.1.3.6.1.2.1.1.3.0',
+        'time': '.1.3.6.1.4.1.21317.1.3.2.2.3.4.8.2.2.0',
+        'date': '.1.3.6.1.4.1.21317.1.3.2.2.3.4.8.2.1.0',
+        'deviceMAC': '.1.3.6.1.4.1.21317.1.3.2.2.3.4.1.0',
+        'deviceIP': '.1.3.6.1.4.1.21317.1.3.2.2.3.4.2.0',
+        'deviceFWVersion': '.1.3.6.1.4.1.21317.1.3.2.2.3.4.3.0',
+        'devicePower': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.4.1',
+        'devicePowerDissipation': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.5.1',
+        'deviceVoltage': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.3.1',
+        'deviceCurrent': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.2.1',
+        'inputMaxVoltage': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.6.1',
+        'inputMaxCurrent': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.7.1',
+        # devicePowerDissipation without the index, the energy counter of the input is read
+        # as non-repeater of the outlet walk
+        'inputPowerDissipation': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.3.1.5',
     }
 
-    # start oids
+    # start oids of the outlet columns, walked together
     bulk_cmd_oids = {                                                                               
-        'outletName': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.10.1.2'),
-        'displayOutletStatus': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.1.5.1.2'),
-        'outletVoltage': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.3'),
-        'outletCurrent': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.2'),
-        'outletPower': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.4'),
-        'outletPowerDissipation': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.5'),
-        'outletValueEntry': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1'),
-        'deviceValueEntry': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1'),
-        'outletOnDelayTime': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.10.1.4'),
-        'outletOffDelayTime': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.10.1.5'),
-        'outletMaxCurrent': ObjectIdentity('.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.6')
+        'outletName': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.10.1.2',
+        'displayOutletStatus': '.1.3.6.1.4.1.21317.1.3.2.2.2.1.5.1.2',
+        'outletVoltage': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.3',
+        'outletCurrent': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.2',
+        'outletPower': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.4',
+        'outletPowerDissipation': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.5',
+        'outletOnDelayTime': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.10.1.4',
+        'outletOffDelayTime': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.10.1.5',
+        'outletMaxCurrent': '.1.3.6.1.4.1.21317.1.3.2.2.2.2.1.1.6'
     }
-    # key is bulk_cmd_oids key
-    bulk_cmds = {}
-
-    # for received data
-    data = {}
+    # names and settings are changed seldom, status and measurements are walked on every refresh
+    column_classes = {
+        'outletName': 'static',
+        'outletOnDelayTime': 'static',
+        'outletOffDelayTime': 'static',
+        'outletMaxCurrent': 'static',
+    }
+    switch_columns = ['displayOutletStatus']
 
     def __init__(self, cfg):
         super(AtenPDU, self).__init__(cfg)
-        self._configure_connection()
 
-    def _get_bulk_cmd(self, first_oid_key):
-        return bulkCmd(self.snmpEngine, self.userData, self.transport, ContextData(), 0, 7, self._getObjectType(first_oid_key))
+    # part of the rated input current, that the outlets may draw together
+    budget_factor = 0.8
 
-    def _configure_connection(self):
-        self.snmpEngine = SnmpEngine()
-        authProtocol = usmHMACMD5AuthProtocol
-        privProtocol = usmAesCfb128Protocol
-        if self.cfg['auth_protocol'] == 'SHA':
-            authProtocol = usmHMACSHAAuthProtocol
-        if self.cfg['priv_protocol'] == 'DES':
-            privProtocol = usmDESPrivProtocol
-        self.userData = UsmUserData(self.cfg['user'], self.cfg['authkey'], self.cfg['privkey'], authProtocol=authProtocol, privProtocol=privProtocol)
-        #self.userData = UsmUserData(self.cfg['user'], self.cfg['authkey'], self.cfg['privkey'], authProtocol=usmHMACMD5AuthProtocol, privProtocol=usmAesCfb128Protocol)
-        port = 161
-        if not self.cfg['port'] == None:
-            port = int(self.cfg['port'])
-        self.transport = UdpTransportTarget((self.cfg['host'], port), timeout=0.5, retries=1)
+    def discover_geometry(self):
+        # index of each outlet in the outlet tables
+        outlets = [index for index, value in self._walk_table(['displayOutletStatus'])['displayOutletStatus']]
+        if len(outlets) == 0:
+            raise IOError('no outlets found on ' + self.cfg['host'])
+        return {'outlets': outlets}
 
-    def _getObjectType(self, oidKey):
-         if oidKey in self.oids:
-	         objectType = ObjectType(self.oids[oidKey]) #.addAsn1MibSource( 'file:///home/gobuki/bin/snmp/PE_MIB_1.1.115')
-         else:
-	         objectType = ObjectType(self.bulk_cmd_oids[oidKey]) #.addAsn1MibSource( 'file:///home/gobuki/bin/snmp/PE_MIB_1.1.115')
-         return objectType
-
-    def _append_result(self, iterator, listvar):                                               
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-        if errorIndication:
-            print(errorIndication)
-        elif errorStatus:
-            print('%s at %s' % (errorStatus.prettyPrint(),
-                        errorIndex and varBinds[int(errorIndex) - 1][0] or '?'))
-        else:
-            for varBind in varBinds:
-                listvar.append(str(varBind[1]))
+    def _outlet_of_index(self, key, index):
+        try:
+            return self.geometry['outlets'].index(index)
+        except (TypeError, KeyError, ValueError):
+            return None
 
-    def get_result(self, iterator):
-        listvar = []
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-        if errorIndication:
-            print(errorIndication)
-        elif errorStatus:
-            print('%s at %s' % (errorStatus.prettyPrint(),
-                        errorIndex and varBinds[int(errorIndex) - 1][0] or '?'))
-        else:
-            for varBind in varBinds:
-                listvar.append(str(varBind[1]))
-        return listvar
-                
+    def get_input_energy(self):
+        try:
+            return float(self.data['inputPowerDissipation'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def get_total_current(self):
+        values = self.get_result(self.getGetCmd('deviceCurrent'))
+        try:
+            return float(values[0])
+        except (IndexError, ValueError):
+            return None
+
+    def get_current_budget(self):
+        budget = super(AtenPDU, self).get_current_budget()
+        if budget is not None:
+            return budget
+        values = self.get_result(self.getGetCmd('inputMaxCurrent'))
+        try:
+            return float(values[0]) * float(self.cfg.get('budget_factor', self.budget_factor))
+        except (IndexError, ValueError):
+            return None
 
     def get_pdu_info(self):
         return self.get_result(
             self.getGetCmd(['sysName','modelName','uptime','time','date','deviceMAC','deviceIP','deviceFWVersion','deviceVoltage','deviceCurrent','devicePower','devicePowerDissipation'])
         )
 
-    def switch_on(self, outlet_id):
-        self._switch(outlet_id, 2)
-        self._apply_on_state(self.outlets, outlet_id)
- 
-    def switch_off(self, outlet_id):
-        self._switch(outlet_id, 1)
-        self._apply_off_state(self.outlets, outlet_id)
-
     def toggle_outlet(self, outlet_id):
         if self.outlets[outlet_id-1]['state'] != 1:
             self.switch_on(outlet_id)
         else:
             self.switch_off(outlet_id)
 
-    def _switch(self, outlet_id, status):
-        g = setCmd(
-            self.snmpEngine,
-            self.userData,
-            self.transport,
-            ContextData(),
-            ((1, 3, 6, 1, 4, 1, 21317, 1, 3, 2, 2, 2, 2, outlet_id + 1, 0), rfc1902.Integer(status))
-        )
-        next(g)
+    def _switch_oid(self, outlet_id):
+        # the outlet with index n is switched with the scalar outletNStatus, ...2.2.2.2.(n+1).0
+        index = self.get_geometry()['outlets'][outlet_id-1]
+        return (1, 3, 6, 1, 4, 1, 21317, 1, 3, 2, 2, 2, 2, int(index) + 1, 0)
 
     def refresh_status(self):
-        for key in self.bulk_cmd_oids:
-            self.bulk_cmds[key] = self._get_bulk_cmd(key)
-            if key not in self.data:
-                self.data[key] = []
-        for key in self.data:
-            self.data[key].clear()
-
-        for i in range(0, 8):
-            for key in self.bulk_cmds:
-                self._append_result(self.bulk_cmds[key], self.data[key])
-                if key == "displayOutletStatus":
-                    self.data[key][i] = int(self.data[key][i])
-            outlet = { 
-                    'name': self.data['outletName'][i],
-                    'state': int(self.data['displayOutletStatus'][i]) - 1,
-                    'preset1': 0,
-                    'preset2': 0,
-                    'preset3': 0,
-                    'power': self.data['outletPower'][i],
-                    'powerDissipation': self.data['outletPowerDissipation'][i],
-                    'current': self.data['outletCurrent'][i],
-                    'max_current': self.data['outletMaxCurrent'][i],
-                    'voltage': self.data['outletVoltage'][i],
-                    'on_delay': self.data['outletOnDelayTime'][i],
-                    'off_delay': self.data['outletOffDelayTime'][i],
-            }
-            if i < len(self.outlets):
-                for key in outlet:
-                    self.outlets[i][key] = outlet[key]
-            else:
-                self.outlets.append(outlet)
-
-    def getGetCmd(self, oidKey):
-        if isinstance(oidKey, str):
-            return getCmd(self.snmpEngine, self.userData, self.transport, ContextData(), self._getObjectType(oidKey))
-        else:
-            object_types = [self._getObjectType(key) for key in oidKey]
-            return getCmd(self.snmpEngine, self.userData, self.transport, ContextData(), *object_types)
+        if not self.get_geometry():
+            raise IOError('no answer from ' + self.cfg['host'])
+        # one walk over the due outlet columns, sized to the number of outlets
+        self._refresh_columns(list(self.bulk_cmd_oids), max_rows=len(self.geometry['outlets']),
+                              scalar_keys=['inputPowerDissipation'])
+
+        outlets = len(self.geometry['outlets'])
+        del self.outlets[outlets:]
+        for i in range(0, outlets):
+            self._update_outlet(i)
+
+    def _update_outlet(self, i):
+        index = self.geometry['outlets'][i]
+        values = dict((key, self._value(key, index)) for key in self.bulk_cmd_oids)
+        if None in values.values():
+            raise IOError('no values of outlet %s from %s' % (index, self.cfg['host']))
+        outlet = { 
+                'name': values['outletName'],
+                'state': int(values['displayOutletStatus']) - 1,
+                'preset1': 0,
+                'preset2': 0,
+                'preset3': 0,
+                'power': values['outletPower'],
+                'powerDissipation': values['outletPowerDissipation'],
+                'current': values['outletCurrent'],
+                'max_current': values['outletMaxCurrent'],
+                'voltage': values['outletVoltage'],
+                'on_delay': values['outletOnDelayTime'],
+                'off_delay': values['outletOffDelayTime'],
+        }
+        try:
+            # for the PowerOnSequencer, what the outlet draws when it is on
+            if outlet['state'] == 1 and float(outlet['current']) > 0:
+                outlet['on_current'] = outlet['current']
+        except ValueError:
+            pass
+        self._store_outlet(i, outlet)
  
            
 
@@ -807,12 +2820,174 @@ class SignalWrap(urwid.WidgetWrap):
         return result
 
 
+'''
+Receives the status datagrams of ANEL NET-PwrCtrl devices. The devices send them to their
+UDP receive port, when the state of an outlet changed and as answer to switch commands.
+One thread per receive port serves all configured strips, the sender is matched by IP address.
+
+Datagram fields, separated by ':'
+NET-PwrCtrl:<name>:<ip>:<netmask>:<gateway>:<mac>:<outlet 1 name>,<state>: ... :<outlet 8 name>,<state>:<lock mask>:<http port>...
+'''
+class AnelBroadcastListener(threading.Thread):
+
+    listeners = {}
+    listeners_lock = threading.Lock()
+    # called with the device, after the outlets of a device were updated
+    update_callbacks = []
+
+    @classmethod
+    def register(cls, device, port):
+        with cls.listeners_lock:
+            listener = cls.listeners.get(port)
+            if listener is None:
+                listener = AnelBroadcastListener(port)
+                cls.listeners[port] = listener
+                listener.start()
+        listener.add_device(device)
+        return listener
+
+    def __init__(self, port):
+        threading.Thread.__init__(self, name='AnelBroadcastListener-%d' % port, daemon=True)
+        self.port = port
+        self.lock = threading.Lock()
+        # ip -> list of devices
+        self.devices = {}
+        self.error = None
+        self.sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', port))
+            self.sock = sock
+        except OSError as e:
+            # e.g. no permission for ports below 1024, the strips are polled with http only
+            self.error = e
+
+    def add_device(self, device):
+        try:
+            ip = socket.gethostbyname(device.cfg['host'])
+        except OSError:
+            ip = device.cfg['host']
+        with self.lock:
+            self.devices.setdefault(ip, []).append(device)
+
+    def run(self):
+        if self.sock is None:
+            return
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+                self.handle_datagram(data, address[0])
+                self.error = None
+            except Exception as e:
+                # the strips are polled with http, as long as the error is set
+                self.error = e
+                time.sleep(1)
+
+    @staticmethod
+    def parse_datagram(data):
+        '''
+        Returns the ip field and a list of [name, state] of the outlets or None
+        '''
+        fields = data.decode('latin-1').strip().split(':')
+        if len(fields) < 7 or not fields[0].startswith('NET-'):
+            return None
+        outlet_data = []
+        for field in fields[6:]:
+            if field.startswith('IO-') or not ',' in field:
+                break
+            name, state = field.rsplit(',', 1)
+            if not state.strip() in ('0', '1'):
+                break
+            outlet_data.append([name, state.strip()])
+        return fields[2].strip(), outlet_data
+
+    def handle_datagram(self, data, address):
+        parsed = self.parse_datagram(data)
+        if parsed is None:
+            return
+        ip, outlet_data = parsed
+        with self.lock:
+            devices = list(self.devices.get(address) or self.devices.get(ip, []))
+        for device in devices:
+            device.post_status(outlet_data)
+            # the outlets are also changed by the poller threads and the daemon. While one of them
+            # holds the io_lock, it applies the posted status itself, e.g. a switch command waiting for it
+            if not device.io_lock.acquire(blocking=False):
+                continue
+            try:
+                device.apply_posted_status()
+            finally:
+                device.io_lock.release()
+            for callback in self.update_callbacks:
+                callback(device)
+
+
+'''
+Sends switch commands to an ANEL strip over one UDP socket, that stays open.
+Sw_on/Sw_off switch one outlet, "Sw" followed by a byte with one bit per outlet
+(bit 0 is outlet 1) sets all outlets with one datagram.
+'''
+class AnelCommandChannel(object):
+
+    def __init__(self, host, port, user, pwd):
+        self.credentials = (user + pwd).encode()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+
+    def switch(self, outlet_id, state):
+        command = 'Sw_off'
+        if state:
+            command = 'Sw_on'
+        self.sock.send(command.encode() + str(outlet_id).encode() + self.credentials + b'\n')
+
+    def set_all(self, states):
+        # states is a list with 0 or 1 for outlet 1 to 8
+        mask = 0
+        for i, state in enumerate(states):
+            if state:
+                mask |= 1 << i
+        self.sock.send(b'Sw' + bytes([mask]) + self.credentials + b'\n')
+
+
 '''
 Controls Anel NET-PwrCtrl powerstrips
 '''
 class NetPwrCtrl(PowerStripController):
+
+    # seconds between http status requests, while status datagrams are received
+    status_check_interval = 60
+    # default udp port, the strips send their status to
+    udp_receive_port = 77
+    # seconds to wait for the status, that confirms a switch command
+    ack_timeout = 1.0
+    # a bit mask command sets all outlets, the states of the other outlets must be
+    # known and not older than this. a status datagram counts as well as a http request,
+    # but a running listener is no guarantee, datagrams get lost and the front panel
+    # or the web interface switch outlets too
+    max_state_age = 2
+
     def __init__(self, cfg):
         super(NetPwrCtrl, self).__init__(cfg)
+        self.last_http_check = 0
+        self.last_broadcast = 0
+        # states of all physical outlets, configured or not, and the time they were received
+        self.physical_states = []
+        self.states_updated = 0
+        # the last status datagram (outlet data) from the listener, not applied yet. Guarded by
+        # status_condition, not by the io_lock, the listener must not wait for a switch command
+        self.status_condition = threading.Condition()
+        self.posted_status = None
+        self.channel = None
+        self.listener = None
+        if 'status_check_interval' in self.cfg:
+            self.status_check_interval = float(self.cfg['status_check_interval'])
+
+    def start_background(self):
+        # without the listener switch commands are confirmed and the states read over http
+        port = int(self.cfg.get('udp_receive_port', self.udp_receive_port))
+        if self.listener is None and port > 0:
+            self.listener = AnelBroadcastListener.register(self, port)
 
     def is_outlet_configured(self, outlet_index): 
         is_configured = False
@@ -820,30 +2995,60 @@ class NetPwrCtrl(PowerStripController):
         # in this case access to cfg entry fails in if condition
         try:
             is_configured = not self.cfg[str(outlet_index)] == None
+        except KeyError:
+            pass
         except Exception as e:
             print(e)
 
         return is_configured
 
+    def is_listening(self):
+        return self.listener is not None and self.listener.error is None
+
     def refresh_status(self):
-        outlet_data = self._fetch_outlet_states()
+        self.apply_posted_status()
+        # between the http requests the state is kept up to date by the status datagrams
+        if self.listener is None or self.listener.error is not None or time.time() - self.last_http_check > self.status_check_interval:
+            self._apply_outlet_states(self._fetch_outlet_states())
+            self.last_http_check = time.time()
+
+    def post_status(self, outlet_data):
+        '''
+        Called by the AnelBroadcastListener thread with a received status, it is applied with apply_posted_status
+        '''
+        with self.status_condition:
+            self.posted_status = outlet_data
+            self.status_condition.notify_all()
+
+    def apply_posted_status(self):
+        # called with the io_lock held
+        with self.status_condition:
+            outlet_data = self.posted_status
+            self.posted_status = None
+        if outlet_data is not None:
+            self.apply_broadcast(outlet_data)
+
+    def apply_broadcast(self, outlet_data):
+        # called with the io_lock held
+        self.last_broadcast = time.time()
+        self._apply_outlet_states(outlet_data)
+
+    def _apply_outlet_states(self, outlet_data):
+        # outlet_data is a list with [name, state, ...] of each outlet
+        self.physical_states = [int(od[1]) for od in outlet_data]
+        self.states_updated = time.time()
         outlet_index = 1
         for od in outlet_data:
             if self.is_outlet_configured(outlet_index):
-                name = od[1]
                 outlet = { 
                     'name': self.cfg[str(outlet_index)],
                     'state': int(od[1]),
-                    'preset1': 0,
-                    'preset2': 0,
-                    'preset3': 0,
+                    'preset1': self._get_preset_value(0, outlet_index),
+                    'preset2': self._get_preset_value(1, outlet_index),
+                    'preset3': self._get_preset_value(2, outlet_index),
       
                 }
-                if outlet_index-1 < len(self.outlets):
-                    for key in outlet:
-                        self.outlets[outlet_index-1][key] = outlet[key]
-                else:
-                    self.outlets.append(outlet)
+                self._store_outlet(outlet_index-1, outlet)
                
 
             outlet_index += 1
@@ -866,17 +3071,89 @@ class NetPwrCtrl(PowerStripController):
         self.last_refresh = values[3]
         return outlet_data;
 
-    def _switch(self, outlet_id, command):
-        s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        s.sendto((command + str(outlet_id) + self.cfg['user'] + self.cfg['pwd'] +"\n").encode(), (self.cfg['host'], int(self.cfg['port'])))
+    def get_channel(self):
+        if self.channel is None:
+            self.channel = AnelCommandChannel(self.cfg['host'], int(self.cfg['port']), self.cfg['user'], self.cfg['pwd'])
+        return self.channel
+
+    def _states_are_current(self):
+        if len(self.physical_states) == 0:
+            return False
+        # states_updated is set by the http request and by every status datagram
+        return time.time() - self.states_updated < self.max_state_age
+
+    def switch_many(self, states):
+        '''
+        Switches several outlets with one datagram, states is a dict {outlet_id: 0 or 1}.
+        Waits for the status of the strip, that confirms the new states
+        '''
+        if len(states) == 0:
+            return
+        channel = self.get_channel()
+        if len(states) == 1:
+            outlet_id, state = list(states.items())[0]
+            send = lambda: channel.switch(outlet_id, state)
+        else:
+            if not self._states_are_current():
+                self._apply_outlet_states(self._fetch_outlet_states())
+            wanted = list(self.physical_states)
+            for outlet_id in states:
+                wanted[outlet_id-1] = 1 if states[outlet_id] else 0
+            send = lambda: channel.set_all(wanted)
+
+        # one retransmission, it's UDP
+        send()
+        if not self._wait_for_states(states):
+            send()
+            if not self._wait_for_states(states):
+                # no status datagram received, ask the web server
+                self._apply_outlet_states(self._fetch_outlet_states())
+                if not self._states_match(states):
+                    raise IOError('%s did not confirm the switch command' % self.cfg['host'])
+
+        for outlet_id in states:
+            if states[outlet_id]:
+                self._apply_on_state(self.outlets, outlet_id)
+            else:
+                self._apply_off_state(self.outlets, outlet_id)
+
+    def _states_match(self, states):
+        for outlet_id in states:
+            if outlet_id > len(self.physical_states) or self.physical_states[outlet_id-1] != (1 if states[outlet_id] else 0):
+                return False
+        return True
+
+    def _wait_for_states(self, states):
+        '''
+        Waits for a status with the wanted states. The strip sends it to the udp_receive_port,
+        the AnelBroadcastListener posts it. Without a listener the web server is asked
+        '''
+        sent = time.time()
+        deadline = sent + self.ack_timeout
+        if not self.is_listening():
+            while True:
+                self._apply_outlet_states(self._fetch_outlet_states())
+                if self._states_match(states):
+                    return True
+                if time.time() + 0.2 >= deadline:
+                    return False
+                time.sleep(0.2)
+        while True:
+            self.apply_posted_status()
+            if self.states_updated >= sent and self._states_match(states):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            with self.status_condition:
+                if self.posted_status is None:
+                    self.status_condition.wait(remaining)
 
     def switch_on(self, outlet_id):
-        self._switch(outlet_id, "Sw_on")
-        self._apply_on_state(self.outlets, outlet_id)
+        self.switch_many({outlet_id: 1})
 
     def switch_off(self, outlet_id):
-        self._switch(outlet_id, "Sw_off")
-        self._apply_off_state(self.outlets, outlet_id)
+        self.switch_many({outlet_id: 0})
 
     def toggle_outlet(self, outlet_id):
         if self.outlets[outlet_id-1]['state'] == 0:
@@ -884,22 +3161,6 @@ class NetPwrCtrl(PowerStripController):
         else:
             self.switch_off(outlet_id)
 
-    def activate_preset(self, preset_index):
-        outlet_id = 1
-        outlets_switched_on = 0
-
-        for outlet in self.outlets:
-            preset_value = outlet['preset'+ str(preset_index)]
-
-            if preset_value != outlet['state']:
-                # sleep before toggling the next outlet
-                if outlets_switched_on > 0:
-                    time.sleep(self.multi_power_on_delay)
-                self.toggle_outlet(outlet_id)
-                if preset_value == 1:
-                   outlets_switched_on += 1
-            outlet_id += 1
-
 
 class OutletDetailView(urwid.WidgetWrap):
     def __init__ (self):
@@ -912,6 +3173,16 @@ class OutletDetailView(urwid.WidgetWrap):
            s += f'Power:  {o["power"]}\n'
         if 'current' in o:
            s += f'Current:  {o["current"]}'
+        if 'poe_status' in o:
+           s += f'PoE:  {o["poe_status"]}\n'
+        if o.get('mac_addrs'):
+           s += f'MACs:  {", ".join(o["mac_addrs"])}\n'
+        if o.get('ip_addrs'):
+           s += f'IPs:  {", ".join(o["ip_addrs"])}\n'
+        if 'rx_bps' in o or 'tx_bps' in o:
+           s += f'Traffic:  in {format_bps(o.get("rx_bps", 0))}bit/s, out {format_bps(o.get("tx_bps", 0))}bit/s\n'
+        if 'error_rate' in o:
+           s += f'Errors:  {o["error_rate"]:.2f}/s, discards {o["discard_rate"]:.2f}/s\n'
         if 'sensor_data' in o:
            s += self.format_sensor_data(o['sensor_data'])
         self._w.set_text(s)
@@ -922,6 +3193,503 @@ class OutletDetailView(urwid.WidgetWrap):
         print(sensor_data)
 
 
+'''
+History of up to size values. Timestamps and values are kept in arrays, that start with
+initial_size entries and double while they fill up, so a history, that only got a few
+samples, stays small. The oldest sample is overwritten once the buffer has size samples.
+'''
+class RingBuffer(object):
+
+    initial_size = 64
+
+    def __init__(self, size):
+        self.size = size
+        capacity = min(size, self.initial_size)
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('f', bytes(4 * capacity))
+        # position of the next sample and number of valid samples
+        self.next = 0
+        self.count = 0
+
+    def _grow(self):
+        # the buffer grows before it is full for the first time, so the samples are in 0 to count-1
+        capacity = len(self.times)
+        added = min(self.size, 2 * capacity) - capacity
+        self.times.extend(array('d', bytes(8 * added)))
+        self.values.extend(array('f', bytes(4 * added)))
+
+    def append(self, t, value):
+        self.times[self.next] = t
+        self.values[self.next] = value
+        if self.count < self.size:
+            self.count += 1
+            if self.count == len(self.times) < self.size:
+                self._grow()
+        self.next = (self.next + 1) % len(self.times)
+
+    def last(self):
+        if self.count == 0:
+            return None
+        i = (self.next - 1) % len(self.times)
+        return (self.times[i], self.values[i])
+
+    def items(self, since=None):
+        '''
+        Returns the (time, value) tuples, oldest first, optionally only the ones newer than since
+        '''
+        capacity = len(self.times)
+        start = (self.next - self.count) % capacity
+        result = []
+        for n in range(0, self.count):
+            i = (start + n) % capacity
+            if since is None or self.times[i] > since:
+                result.append((self.times[i], self.values[i]))
+        return result
+
+    def nbytes(self):
+        return self.times.itemsize * len(self.times) + self.values.itemsize * len(self.values)
+
+
+'''
+History of one metric of one outlet in three resolutions. Every sample goes to the raw tier,
+the average of each minute to the minute tier and the average of each hour to the hour tier.
+With the default sizes that is one hour of per second samples, one day of minutes and a year of hours.
+A sample takes 12 bytes and the buffers grow with the samples, a metric polled every 5 seconds
+takes about 60 KiB after a day and at most 160 KiB after a year. history in the config sets
+smaller sizes for many outlets.
+'''
+class MetricSeries(object):
+
+    # tier name -> (seconds per sample, number of samples)
+    tiers = [('raw', 0, 3600), ('minute', 60, 1440), ('hour', 3600, 8760)]
+
+    def __init__(self, sizes=None):
+        '''
+        sizes replaces the number of samples of the tiers, e.g. [600, 1440, 720]
+        '''
+        if sizes is not None:
+            self.tiers = [(name, interval, size) for (name, interval, default), size in zip(self.tiers, sizes)]
+        self.buffers = {}
+        # tier name -> [bucket start, sum, count] of the average in progress
+        self.buckets = {}
+        for name, interval, size in self.tiers:
+            self.buffers[name] = RingBuffer(size)
+            if interval > 0:
+                self.buckets[name] = [None, 0.0, 0]
+
+    def append(self, t, value):
+        self.buffers['raw'].append(t, value)
+        for name, interval, size in self.tiers:
+            if interval == 0:
+                continue
+            bucket = self.buckets[name]
+            start = t - t % interval
+            if bucket[0] != start:
+                if bucket[2] > 0:
+                    self.buffers[name].append(bucket[0], bucket[1] / bucket[2])
+                bucket[0] = start
+                bucket[1] = 0.0
+                bucket[2] = 0
+            bucket[1] += value
+            bucket[2] += 1
+
+    def items(self, tier='raw', since=None):
+        return self.buffers[tier].items(since)
+
+    def nbytes(self):
+        return sum(b.nbytes() for b in self.buffers.values())
+
+
+'''
+Power metrics of all outlets, recorded after each refresh of a device.
+Key of a series is (device section name, outlet number, metric)
+'''
+class MetricHistory(object):
+
+    # outlet keys, that are recorded if the device provides them
+    metrics = ['voltage', 'current', 'power', 'powerDissipation']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+        # number of samples of the tiers of new series, None for the defaults of MetricSeries
+        self.sizes = None
+        # MetricArchive, that gets all samples too
+        self.archive = None
+
+    def record(self, device, t=None):
+        if t is None:
+            t = time.time()
+        name = device.cfg.name
+        samples = []
+        with self.lock:
+            for i, outlet in enumerate(device.outlets):
+                for metric in self.metrics:
+                    if metric not in outlet:
+                        continue
+                    try:
+                        value = float(outlet[metric])
+                    except (TypeError, ValueError):
+                        continue
+                    key = (name, i + 1, metric)
+                    series = self.series.get(key)
+                    if series is None:
+                        series = MetricSeries(self.sizes)
+                        self.series[key] = series
+                    series.append(t, value)
+                    samples.append((key, value))
+            if self.archive is not None and samples:
+                self.archive.append(t, samples)
+
+    def get(self, device_name, outlet_id, metric, tier='raw', since=None):
+        '''
+        Returns the (time, value) tuples of a metric, oldest first
+        '''
+        with self.lock:
+            series = self.series.get((device_name, outlet_id, metric))
+            if series is None:
+                return []
+            return series.items(tier, since)
+
+    def nbytes(self):
+        with self.lock:
+            return sum(s.nbytes() for s in self.series.values())
+
+metric_history = MetricHistory()
+
+
+# directory for data, that can't be recreated
+DATA_DIR = expanduser('~/.local/share/currentcommander')
+
+
+'''
+Append-only archive of all samples, enabled with archive=yes in the [DEFAULT] section.
+
+There is one file per UTC day with fixed-width records (time as double, series id, value as float),
+appended in time order. The records of a file are sorted by time, so the start and the end of
+a time range are found with a binary search on the memory mapped file and only the files of
+the days in the range are touched. Query time depends on the length of the range, not on the
+size of the archive.
+
+The series ids map to (device section name, outlet number, metric) in series.json.
+'''
+class MetricArchive(object):
+
+    record = struct.Struct('<dIf')
+    period = 86400
+    # longer gaps between power samples don't count for the energy
+    max_gap = 600
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.series_file = os.path.join(path, 'series.json')
+        # (device, outlet, metric) -> id and back
+        self.series_ids = {}
+        self.series_keys = {}
+        self._load_series()
+        self.file = None
+        self.file_period = None
+        self.last_time = 0.0
+
+    def _load_series(self):
+        try:
+            with open(self.series_file) as f:
+                for sid, key in json.load(f).items():
+                    self.series_ids[tuple(key)] = int(sid)
+                    self.series_keys[int(sid)] = tuple(key)
+        except (OSError, ValueError):
+            pass
+
+    def _save_series(self):
+        tmp = self.series_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict((str(sid), list(key)) for sid, key in self.series_keys.items()), f)
+        os.replace(tmp, self.series_file)
+
+    def _series_id(self, key):
+        sid = self.series_ids.get(key)
+        if sid is None:
+            sid = len(self.series_keys)
+            self.series_ids[key] = sid
+            self.series_keys[sid] = key
+            self._save_series()
+        return sid
+
+    def file_name(self, period):
+        return os.path.join(self.path, time.strftime('%Y-%m-%d', time.gmtime(period * self.period)) + '.bin')
+
+    def append(self, t, samples):
+        '''
+        Appends the (key, value) samples taken at time t
+        '''
+        with self.lock:
+            # the binary search needs sorted records, e.g. if the clock was set back
+            t = max(t, self.last_time)
+            self.last_time = t
+            period = int(t // self.period)
+            if period != self.file_period:
+                self.close()
+                self.file = open(self.file_name(period), 'ab')
+                self.file_period = period
+            self.file.write(b''.join(self.record.pack(t, self._series_id(key), value) for key, value in samples))
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_period = None
+
+    def _find(self, mm, count, t):
+        '''
+        Returns the number of the first record in the mapped file with a time >= t
+        '''
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<d', mm, mid * self.record.size)[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, start, end, keys=None):
+        '''
+        Yields (time, key, value) of the records with start <= time < end, optionally only of the given keys
+        '''
+        ids = None
+        if keys is not None:
+            ids = set(self.series_ids[key] for key in keys if key in self.series_ids)
+        size = self.record.size
+        for period in range(int(start // self.period), int(end // self.period) + 1):
+            try:
+                f = open(self.file_name(period), 'rb')
+            except OSError:
+                continue
+            with f:
+                # a record cut off by a crash is ignored
+                count = os.fstat(f.fileno()).st_size // size
+                if count == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    first = self._find(mm, count, start)
+                    last = self._find(mm, count, end)
+                    data = mm[first * size:last * size]
+            for t, sid, value in self.record.iter_unpack(data):
+                if ids is None or sid in ids:
+                    yield t, self.series_keys.get(sid), value
+
+    def rollup(self, start, end, keys=None):
+        '''
+        Returns {key: {'count', 'avg', 'max', 'kwh'}} for the time range, kwh only for the power metric
+        '''
+        result = {}
+        for t, key, value in self.query(start, end, keys):
+            r = result.get(key)
+            if r is None:
+                r = {'count': 0, 'sum': 0.0, 'max': value, 'joule': 0.0, 'last': None}
+                result[key] = r
+            r['count'] += 1
+            r['sum'] += value
+            if value > r['max']:
+                r['max'] = value
+            if r['last'] is not None and t - r['last'][0] <= self.max_gap:
+                r['joule'] += r['last'][1] * (t - r['last'][0])
+            r['last'] = (t, value)
+        for key, r in result.items():
+            r['avg'] = r['sum'] / r['count']
+            if key is not None and key[2] == 'power':
+                r['kwh'] = r['joule'] / 3600000.0
+            for k in ('sum', 'joule', 'last'):
+                del r[k]
+        return result
+
+    def export_csv(self, out, start, end, keys=None):
+        '''
+        Writes the records of the time range to the file object out, one record per line
+        '''
+        writer = csv.writer(out)
+        writer.writerow(['time', 'device', 'outlet', 'metric', 'value'])
+        for t, key, value in self.query(start, end, keys):
+            if key is None:
+                continue
+            writer.writerow([datetime.fromtimestamp(t, timezone.utc).isoformat(), key[0], key[1], key[2], '%g' % value])
+
+
+def configure_archive(config_manager):
+    '''
+    Enables the archive, if archive=yes is set in the [DEFAULT] section, and sets the
+    sizes of the in memory history, if history=raw,minute,hour is set there
+    '''
+    defaults = config_manager.config['DEFAULT']
+    if 'history' in defaults:
+        sizes = [int(size) for size in defaults['history'].split(',')]
+        if len(sizes) != len(MetricSeries.tiers) or min(sizes) < 1:
+            raise ValueError('history needs %d sample counts above 0 like 3600,1440,8760' % len(MetricSeries.tiers))
+        metric_history.sizes = sizes
+    if defaults.getboolean('archive', False):
+        metric_history.archive = MetricArchive(os.path.join(DATA_DIR, 'archive'))
+
+
+def benchmark_archive(days):
+    '''
+    Fills a temporary archive with per second samples of one outlet and prints
+    the time of a one hour and a one day rollup at the end of the archive, while it grows
+    '''
+    path = tempfile.mkdtemp(prefix='currentcommander-archive-')
+    try:
+        archive = MetricArchive(path)
+        sid = archive._series_id(('benchmark', 1, 'power'))
+        first_period = int(time.time() // archive.period) - days
+        checkpoints = set([1, 10, 100, 365, days])
+        print('%8s %12s %14s %14s' % ('days', 'records', '1 hour rollup', '1 day rollup'))
+        for d in range(0, days):
+            period = first_period + d
+            start = period * archive.period
+            with open(archive.file_name(period), 'wb') as f:
+                f.write(b''.join(archive.record.pack(start + i, sid, 100.0 + i % 50) for i in range(0, archive.period)))
+            if d + 1 not in checkpoints:
+                continue
+            end = start + archive.period
+            timings = []
+            for length in (3600, archive.period):
+                started = time.perf_counter()
+                for n in range(0, 5):
+                    archive.rollup(end - length, end)
+                timings.append((time.perf_counter() - started) / 5)
+            print('%8d %12d %12.1fms %12.1fms' % (d + 1, (d + 1) * archive.period, timings[0] * 1000, timings[1] * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+'''
+Runs the device communication in worker threads, so a slow or unreachable device doesn't block the ui.
+A device has at most one job in the queue or in a worker, the others wait in a list of the device and
+are queued one after another. So a hanging device keeps one worker busy and not all of them waiting
+for its io_lock.
+The results are collected in a queue and the owner is woken up through a pipe, if one is set.
+The ui passes the pipe created with urwid.MainLoop.watch_pipe and processes the results in the main loop.
+'''
+class DevicePoller(object):
+
+    def __init__(self, workers=4):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        # devices with a queued, but not yet started refresh
+        self.pending_refreshes = set()
+        # number of queued or running jobs per device
+        self.jobs_in_flight = {}
+        # device -> deque of the jobs waiting for the job of the device in the queue or in a worker
+        self.waiting = {}
+        self.notify_fd = None
+        self.threads = []
+        for i in range(0, workers):
+            t = threading.Thread(target=self._work, name='DevicePoller-%d' % i, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def set_notify_fd(self, fd):
+        self.notify_fd = fd
+
+    def submit(self, device, function, *args, callback=None):
+        '''
+        Queues function(*args) for execution in a worker thread.
+        callback(device, result, error) is called from process_results()
+        '''
+        job = (device, function, args, callback)
+        with self.lock:
+            self.jobs_in_flight[device] = self.jobs_in_flight.get(device, 0) + 1
+            if self.jobs_in_flight[device] > 1:
+                self.waiting.setdefault(device, collections.deque()).append(job)
+                return
+        self.jobs.put(job)
+
+    def refresh(self, device, callback=None):
+        '''
+        Queues a refresh of the device status, unless a refresh is already waiting in the queue
+        '''
+        with self.lock:
+            if device in self.pending_refreshes:
+                return False
+            self.pending_refreshes.add(device)
+        self.submit(device, self._refresh, device, callback=callback)
+        return True
+
+    def _refresh(self, device):
+        with self.lock:
+            self.pending_refreshes.discard(device)
+        device.refresh_status()
+        metric_history.record(device)
+
+    def notify(self, device):
+        '''
+        Announces a state change of the device, that was received without a job,
+        e.g. by a listener thread
+        '''
+        self.results.put((device, None, None, None))
+        self._wakeup()
+
+    def is_busy(self, device):
+        with self.lock:
+            return self.jobs_in_flight.get(device, 0) > 0
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            device, function, args, callback = job
+            result = None
+            error = None
+            with device.io_lock:
+                started = time.time()
+                try:
+                    result = function(*args)
+                except Exception as e:
+                    error = e
+                device.last_poll_duration = time.time() - started
+                device.last_error = error
+            next_job = None
+            with self.lock:
+                self.jobs_in_flight[device] -= 1
+                if self.waiting.get(device):
+                    next_job = self.waiting[device].popleft()
+            if next_job is not None:
+                self.jobs.put(next_job)
+            self.results.put((device, callback, result, error))
+            self._wakeup()
+
+    def _wakeup(self):
+        if self.notify_fd is not None:
+            try:
+                os.write(self.notify_fd, b'.')
+            except OSError:
+                pass
+
+    def process_results(self):
+        '''
+        Calls the callbacks of the finished jobs in the calling thread.
+        Returns the set of devices with finished jobs
+        '''
+        devices = set()
+        while True:
+            try:
+                device, callback, result, error = self.results.get_nowait()
+            except queue.Empty:
+                return devices
+            devices.add(device)
+            if callback is not None:
+                callback(device, result, error)
+
+    def stop(self):
+        for t in self.threads:
+            self.jobs.put(None)
+
+
 class CursesUI:
 
     # activated powerstrip config index
@@ -949,9 +3717,17 @@ class CursesUI:
 
     instances = {}
 
+    refresh_alarm = None
+    presets_loaded = False
+
     def __init__(self):
         self.cfg = ConfigManager()
         self.quit_event_loop = False
+        self.poller = DevicePoller()
+        AnelBroadcastListener.update_callbacks.append(self.poller.notify)
+        SnmpTrapReceiver.update_callbacks.append(self.poller.notify)
+        SnmpTrapReceiver.refresh_callbacks.append(self.poller.refresh)
+        configure_archive(self.cfg)
 
         if self.cfg.config_exists():
             self.load_config(self.selected_powerstrip)
@@ -962,26 +3738,11 @@ class CursesUI:
         self.load_controller_instance(cfg_section)
     
     def load_controller_instance(self, cfg_section):
-        if cfg_section['device'] == "anel_powerstrip":
-            if not cfg_section.name in self.instances:
-                self.instances[cfg_section.name] = NetPwrCtrl(cfg_section)
-            self.active_powerstrip = self.instances[cfg_section.name]
-        elif cfg_section['device'] == "aten_pdu":
-            if not cfg_section.name in self.instances:
-                self.instances[cfg_section.name] = AtenPDU(cfg_section)
-            self.active_powerstrip = self.instances[cfg_section.name]
-        elif cfg_section['device'] == "poe_pse": 
-            if not cfg_section.name in self.instances:
-                self.instances[cfg_section.name] = PoEPSE(cfg_section)
-            self.active_powerstrip = self.instances[cfg_section.name]
-        elif cfg_section['device'] == "ipmi":
-            if not cfg_section.name in self.instances:
-                self.instances[cfg_section.name] = IPMIDevice(cfg_section)
-            self.active_powerstrip = self.instances[cfg_section.name]
-        elif cfg_section['device'] == "redfish":
-            if not cfg_section.name in self.instances:
-                self.instances[cfg_section.name] = RedfishDevice(cfg_section)
-            self.active_powerstrip = self.instances[cfg_section.name]
+        # see DEVICE_DRIVERS
+        if not cfg_section.name in self.instances:
+            self.instances[cfg_section.name] = create_controller(cfg_section)
+            self.instances[cfg_section.name].start_background()
+        self.active_powerstrip = self.instances[cfg_section.name]
 
           
 
@@ -1000,7 +3761,7 @@ class CursesUI:
         #print("after loading config", file=sys.stderr)
         self.selected_powerstrip = next_index
         self.refresh_ui(keep_selection=False)
-        self.title.set_text(self.active_powerstrip.cfg.name + u' ' + self.active_powerstrip.cfg['host'] + ':' + self.active_powerstrip.cfg['port'])
+        self._start_refreshing()
              
     def previous_powerstrip(self, w, size, key):
         prev_index = self.selected_powerstrip - 1
@@ -1010,7 +3771,7 @@ class CursesUI:
         self.selected_powerstrip = prev_index
         self.load_config(self.selected_powerstrip)
         self.refresh_ui(keep_selection=False)
-        self.title.set_text(self.active_powerstrip.cfg.name + u' ' + self.active_powerstrip.cfg['host'] + ':' + self.active_powerstrip.cfg['port'])
+        self._start_refreshing()
 
     def load_preset_config(self):
         self.preset1_content.clear()
@@ -1037,13 +3798,22 @@ class CursesUI:
         # for some devices it does not make much sense to configure grouped presets
         # only display presets, when presets are configured to save 50% of the screen space for other stuff
         if not 'preset1' in self.active_powerstrip.cfg and not 'preset2' in self.active_powerstrip.cfg and not 'preset3' in self.active_powerstrip.cfg:
-            del self.body_pile.contents[1]
+            if len(self.body_pile.contents) > 1:
+                del self.body_pile.contents[1]
         #    self.preset_view = self.body_pile.contents[1]
         #    if self.preset_view in self.body_pile.contents:
         #        self.body_pile.contents.remove(self.preset_view)
 
 
     def refresh_ui(self, keep_selection=True):
+        '''
+        Shows the last known state of the active device and requests a refresh in the background.
+        The ui is updated again, when the refresh is done
+        '''
+        self.poller.refresh(self.active_powerstrip)
+        self.update_ui(keep_selection)
+
+    def update_ui(self, keep_selection=True):
         pos = None
         if keep_selection:
             try:
@@ -1051,53 +3821,32 @@ class CursesUI:
             except:
                 True
 
-        self.active_powerstrip.refresh_status()
-
-        self.content.clear()
-
-        for outlet in self.active_powerstrip.outlets:
-            # main checkbox
-            if 'type' in outlet:
-                name = outlet['name'] + ' ' + outlet['type']
-            else:
-                name = outlet['name']
-
-            if 'voltage' in outlet:
-                name += ' (' + outlet['voltage'] + 'V'
-            if 'current' in outlet:
-                name += ', ' + outlet['current'] + 'A'
-            if 'power' in outlet:
-                name += ', ' + outlet['power'] + 'W)'
-            if 'mac_addrs' in outlet:
-                if len(outlet['mac_addrs']) > 0:
-                    name += ' ' + outlet['mac_addrs'][0]
-                if len(outlet['mac_addrs']) > 1:
-                    name += ' ' + outlet['mac_addrs'][1]
-                if len(outlet['mac_addrs']) > 2:
-                    name += ' ' + outlet['mac_addrs'][2]
-            if 'bootdev' in outlet:
-                    name += ' ' + outlet['bootdev']
-
-            # ATEN PDU uses 2 as on, checkbox 1 for checked
-            state = outlet['state']
-            if state == 2:
-                state = 1
-
-            cb = urwid.CheckBox(name, state, on_state_change=self.on_checkbox_toggled)
-
-            # checkboxes for preset visualization (have no handler)
-            self.content.append(urwid.AttrMap(cb, "normal", "selected"))
-
-        self.outlets_listview.set_data(self.active_powerstrip.outlets)
+        rebuilt = self.outlets_listview.set_data(self.active_powerstrip.outlets)
 
         self.listview_header.set_text(self.get_outlets_listview_header())
+        self.update_title()
 
-        if keep_selection:
-            if pos is not None and len(self.active_powerstrip.outlets) > 0:
+        if keep_selection and rebuilt:
+            if pos is not None and pos < len(self.active_powerstrip.outlets):
                 self.outlets_listview.lb.set_focus(pos)
 
+    def update_title(self):
+        ps = self.active_powerstrip
+        text = ps.cfg.name + u' ' + ps.cfg['host'] + ':' + ps.cfg['port']
+        if not ps.get_last_refresh() == None:
+            text += ' ' + ps.get_last_refresh()
+        if self.poller.is_busy(ps):
+            text += '  (updating)'
+        elif ps.last_error is not None:
+            text += '  (error: ' + str(ps.last_error) + ')'
+        elif len(ps.background_errors) > 0:
+            text += '  (' + ', '.join('%s: %s' % (source, ps.background_errors[source]) for source in sorted(ps.background_errors)) + ')'
+        self.title.set_text(text)
+
     def get_outlets_listview_header(self):
         text = "Name                State"
+        if len(self.active_powerstrip.outlets) == 0:
+            return text
         o = self.active_powerstrip.outlets[0]
         #if 'last_on' in o:
         #    text += '{:>12s}'.format("Last on")
@@ -1119,6 +3868,10 @@ class CursesUI:
             text += "  Type"
         if 'mac_addrs' in o:
             text += "           MACs seen at port"
+        if 'ip_addrs' in o:
+            text += "  IP"
+        if 'rx_bps' in o or 'tx_bps' in o:
+            text += "             RX bit/s TX bit/s"
         if 'bootdev' in o:
             text += "  Boot Device"
         return text
@@ -1149,7 +3902,6 @@ class CursesUI:
         self.preset2_button = urwid.Button("Activate", on_press = self.activate_preset2)
         self.preset3_content = urwid.SimpleListWalker([])
         self.preset3_button = urwid.Button("Activate", on_press = self.activate_preset3)
-        self.outlets_listbox = urwid.ListBox(self.content)
         self.preset1_listbox = urwid.ListBox(self.preset1_content)
         self.preset2_listbox = urwid.ListBox(self.preset2_content)
         self.preset3_listbox = urwid.ListBox(self.preset3_content)
@@ -1177,13 +3929,9 @@ class CursesUI:
 
     def init_ui(self):
     
-        header_text = self.active_powerstrip.cfg.name + u' ' + self.active_powerstrip.cfg['host'] + ':' + self.active_powerstrip.cfg['port']
-        if not self.active_powerstrip.get_last_refresh() == None:
-            header_test += ' ' + self.active_powerstrip.get_last_refresh()
-        self.title = urwid.Text(header_text)
+        self.title = urwid.Text("")
         header = urwid.AttrMap(self.title, 'titlebar')
-        self.content = urwid.SimpleListWalker([])
-    
+
         #bodypile = urwid.Pile([self.outlets_listbox, urwid.Text(u'Foo')])
 
         #left_col_pile = urwid.Pile([self.create_device_listview(), self.create_outlets_listview()])
@@ -1199,9 +3947,42 @@ class CursesUI:
             config = self.cfg.init()
 
         self.main_loop = urwid.MainLoop(self.layout, self.palette, unhandled_input=self.handle_input)
+        self._profile_first_paint()
+        self.poller.set_notify_fd(self.main_loop.watch_pipe(self.device_jobs_done))
         urwid.connect_signal(self.outlets_listview, "show_details", self.show_details)
         self.refresh_ui() 
         self.load_preset_config()
+        self._start_refreshing()
+
+    def _profile_first_paint(self):
+        draw_screen = self.main_loop.draw_screen
+        def draw_screen_and_mark(*args, **kwargs):
+            draw_screen(*args, **kwargs)
+            profile_mark('first paint')
+            self.main_loop.draw_screen = draw_screen
+        self.main_loop.draw_screen = draw_screen_and_mark
+
+    def device_jobs_done(self, data):
+        '''
+        Called in the main loop, when the DevicePoller finished jobs
+        '''
+        devices = self.poller.process_results()
+        if self.active_powerstrip in devices:
+            profile_mark('first device status shown')
+            self.update_ui()
+            if not self.presets_loaded and len(self.active_powerstrip.outlets) > 0:
+                self.load_preset_config()
+                self.presets_loaded = True
+        # keep the pipe open
+        return True
+
+    def refresh_device(self, device, result=None, error=None):
+        '''
+        DevicePoller callback, refreshes the device state after switching
+        '''
+        self.poller.refresh(device)
+        if device == self.active_powerstrip:
+            self.update_title()
 
     def show_details(self, outlet, foo):
         self.outlet_detail_view.set_outlet(outlet)
@@ -1230,9 +4011,8 @@ class CursesUI:
         else:
              try:
                   outlet_id = int(key)
-                  if 0 < outlet_id < 9:
-                      self.netpwrctrl.toggle_outlet(outlet_id);
-                      self.refresh_ui()
+                  if 0 < outlet_id <= len(self.active_powerstrip.outlets):
+                      self.toggle_outlet(outlet_id)
              except:
                   True
                        
@@ -1313,42 +4093,66 @@ class CursesUI:
         #    return { 'name': b['id'], "filename": b['filename'], "position": b['position'], "rating": edit_rating.value(), "comment": edit_comment.get_edit_text() }
         
 
-    def on_checkbox_toggled(self, arg1, arg2):
-        self.toggle_selected_outlet()
-
     def toggle_selected_outlet_by_click(self, a, b):
         self.toggle_selected_outlet()
 
     def toggle_selected_outlet(self):
+        if len(self.active_powerstrip.outlets) == 0:
+            return
         outlet_id = self.outlets_listview.lb.focus_position + 1
-        self.active_powerstrip.toggle_outlet(outlet_id);
-        self.refresh_ui()
+        self.toggle_outlet(outlet_id)
+
+    def toggle_outlet(self, outlet_id):
+        ps = self.active_powerstrip
+        self.poller.submit(ps, ps.toggle_outlet, outlet_id, callback=self.refresh_device)
+        self.update_title()
+
+    def activate_preset(self, preset_index):
+        ps = self.active_powerstrip
+        self.poller.submit(ps, ps.activate_preset, preset_index, callback=self.refresh_device)
+        self.update_title()
 
     def activate_preset1(self, x):
-        self.active_powerstrip.activate_preset(0)
-        self.refresh_ui()
+        self.activate_preset(0)
 
     def activate_preset2(self, x):
-        self.active_powerstrip.activate_preset(1)
-        self.refresh_ui()
+        self.activate_preset(1)
 
     def activate_preset3(self, x):
-        self.active_powerstrip.activate_preset(2)
-        self.refresh_ui()
+        self.activate_preset(2)
+
+    def get_refresh_interval(self):
+        # refresh_interval can be set per device or for all devices in the [DEFAULT] section
+        try:
+            return float(self.active_powerstrip.cfg.get('refresh_interval', 0))
+        except ValueError:
+            return 0
 
     def _refresh(self, loop=None, user_data=None):
-        self.refresh_ui()
-        self.refresh_alarm = self.loop.set_alarm_in(
-            self.refresh_interval_seconds, self.animate_graph)
+        self.refresh_alarm = None
+        self.poller.refresh(self.active_powerstrip)
+        self.update_title()
+        self._start_refreshing()
+
+    def _start_refreshing(self):
+        self._stop_refreshing()
+        refresh_interval_seconds = self.get_refresh_interval()
+        if refresh_interval_seconds > 0:
+            self.refresh_alarm = self.main_loop.set_alarm_in(
+                refresh_interval_seconds, self._refresh)
 
     def _stop_refreshing(self):
         if self.refresh_alarm:
-            self.loop.remove_alarm(self.refresh_alarm)
+            self.main_loop.remove_alarm(self.refresh_alarm)
         self.refresh_alarm = None
 
     def run(self):
         self.init_ui()
-        self.main_loop.run()
+        try:
+            self.main_loop.run()
+        finally:
+            self.poller.stop()
+            IPMISessionLoop.shutdown()
         #self.screen.start()
         #self.event_loop()
 
@@ -1452,6 +4256,625 @@ class ConfigManager:
     
 
 
+__usage__ = '''usage: currentcommander.py [options]                                 start the ui
+       currentcommander.py [options] on|off|toggle <section> <outlet>  switch an outlet
+       currentcommander.py [options] preset <section> <1-3>            activate a preset
+       currentcommander.py [options] status <section>                  print the outlets
+       currentcommander.py [options] where <mac>                       find the switch port of a MAC address
+       currentcommander.py [options] batch [<file>]                    run the commands of a file or stdin
+       currentcommander.py [options] daemon                            keep the devices connected
+       currentcommander.py [options] export <start> <end>              print the archived samples as csv
+       currentcommander.py [options] rollup <start> <end>              print avg, max and kWh per outlet
+       currentcommander.py [options] benchmark-archive [days]
+       currentcommander.py [options] benchmark-listview [rows]
+       currentcommander.py [options] exporter [[<address>:]<port>]     serve /metrics for Prometheus (port 9880)
+
+<section> is the name or the index of the device section in ~/.netpower.ini, starting with 0
+<start> and <end> are local times like 2024-05-14 or 2024-05-14T08:30
+The device commands are sent to the daemon, if one is running.
+Batch commands are separated by newlines or ';', e.g. on 0 1-4; off 2 3,5; cycle 3 *
+
+
+options:
+  -h, --help           show this help
+  --no-daemon          run device commands directly, even if a daemon is running
+  --jobs=<n>           number of devices a batch switches at the same time (default 4)
+  --snmp-stats         print the work saved by sharing SNMP engines and keys on exit
+  --startup-profile    print import, first paint and first status timings on exit'''
+
+# device= value of the config sections -> (controller class, backend)
+DEVICE_DRIVERS = {
+    'anel_powerstrip': (NetPwrCtrl, 'anel'),
+    'aten_pdu': (AtenPDU, 'snmp'),
+    'poe_pse': (PoEPSE, 'snmp'),
+    'ipmi': (IPMIDevice, 'ipmi'),
+    'redfish': (RedfishDevice, 'redfish'),
+}
+
+def create_controller(cfg_section):
+    '''
+    Returns a new controller for the device type configured in the section.
+    The backend of the device type is imported, when it is used the first time
+    '''
+    device = cfg_section['device']
+    if not device in DEVICE_DRIVERS:
+        raise ValueError('unknown device type ' + device + ' in section ' + cfg_section.name)
+    controller_class, backend = DEVICE_DRIVERS[device]
+    load_backend(backend)
+    controller = controller_class(cfg_section)
+    profile_mark('first controller created')
+    return controller
+
+
+'''
+Headless mode for Prometheus. Every configured device is polled on its own schedule
+(refresh_interval, default 15 seconds) and the metrics text is rendered after each poll.
+A scrape only returns the last rendered text, so scrapes never cause device requests.
+'''
+class MetricsExporter(object):
+
+    default_interval = 15
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    # outlet key -> metric name, help
+    outlet_metrics = [
+        ('voltage', 'currentcommander_outlet_voltage_volts', 'Outlet voltage'),
+        ('current', 'currentcommander_outlet_current_amperes', 'Outlet current'),
+        ('power', 'currentcommander_outlet_power_watts', 'Outlet power'),
+        ('admin_status', 'currentcommander_port_admin_status', 'ifAdminStatus of the port, 1 up, 2 down'),
+        ('oper_status', 'currentcommander_port_oper_status', 'ifOperStatus of the port, 1 up, 2 down'),
+    ]
+    # outlets without an energy counter of the device get the power integrated over the polls,
+    # longer gaps between polls don't count for that
+    max_gap = 600
+
+    def __init__(self, config_manager):
+        self.cfg = config_manager
+        self.poller = DevicePoller()
+        self.devices = []
+        for section in self.cfg.get_sections():
+            try:
+                device = create_controller(self.cfg.get_section(section))
+                device.start_background()
+                self.devices.append(device)
+            except Exception as e:
+                print('%s: %s' % (section, e), file=sys.stderr)
+        self.next_poll = dict((device, 0) for device in self.devices)
+        # device -> rendered lines of the device
+        self.rendered = {}
+        # device -> time of the last poll without error
+        self.last_success = {}
+        # (device name, outlet number) -> [kWh, time of the last power value, last power value],
+        # for the outlets without an energy counter
+        self.energy = {}
+        self.snapshot = b''
+        AnelBroadcastListener.update_callbacks.append(self.poller.notify)
+        SnmpTrapReceiver.update_callbacks.append(self.poller.notify)
+        SnmpTrapReceiver.refresh_callbacks.append(self.poller.refresh)
+        configure_archive(self.cfg)
+
+    def get_interval(self, device):
+        try:
+            interval = float(device.cfg.get('refresh_interval', 0))
+        except ValueError:
+            interval = 0
+        if interval <= 0:
+            interval = self.default_interval
+        return interval
+
+    @staticmethod
+    def labels(**labels):
+        escaped = []
+        for name, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append('%s="%s"' % (name, value))
+        return '{' + ','.join(escaped) + '}'
+
+    def _add_energy(self, key, power, now):
+        energy = self.energy.get(key)
+        if energy is None:
+            energy = [0.0, now, power]
+            self.energy[key] = energy
+        elif now - energy[1] <= self.max_gap:
+            energy[0] += energy[2] * (now - energy[1]) / 3600000.0
+        energy[1] = now
+        energy[2] = power
+        return energy[0]
+
+    def render(self, device, now=None):
+        '''
+        Returns the samples of the device as (metric name, labels, value) tuples
+        '''
+        if now is None:
+            now = time.time()
+        name = device.cfg.name
+        samples = []
+        device_labels = self.labels(device=name)
+        samples.append(('currentcommander_poll_duration_seconds', device_labels, device.last_poll_duration or 0))
+        samples.append(('currentcommander_poll_error', device_labels, int(device.last_error is not None)))
+        if device.last_error is None:
+            self.last_success[device] = now
+        if device in self.last_success:
+            samples.append(('currentcommander_last_poll_timestamp_seconds', device_labels, self.last_success[device]))
+        for i, outlet in enumerate(device.outlets):
+            labels = self.labels(device=name, outlet=i + 1, name=outlet.get('name', ''))
+            samples.append(('currentcommander_outlet_state', labels, int(outlet.get('state') == 1)))
+            for key, metric, help_text in self.outlet_metrics:
+                try:
+                    value = float(outlet[key])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                samples.append((metric, labels, value))
+            try:
+                # the counter of the PDU keeps counting, while the exporter doesn't run
+                energy = float(outlet['powerDissipation'])
+            except (KeyError, TypeError, ValueError):
+                energy = None
+                try:
+                    energy = self._add_energy((name, i + 1), float(outlet['power']), now)
+                except (KeyError, TypeError, ValueError):
+                    pass
+            if energy is not None:
+                samples.append(('currentcommander_outlet_energy_kwh_total', labels, energy))
+        energy = device.get_input_energy()
+        if energy is not None:
+            samples.append(('currentcommander_input_energy_kwh_total', device_labels, energy))
+        return samples
+
+    def update_snapshot(self):
+        helps = {
+            'currentcommander_poll_duration_seconds': ('gauge', 'Duration of the last poll of the device'),
+            'currentcommander_poll_error': ('gauge', '1 if the last poll of the device failed'),
+            'currentcommander_last_poll_timestamp_seconds': ('gauge', 'Time of the last successful poll'),
+            'currentcommander_outlet_state': ('gauge', 'Outlet state, 1 on, 0 off'),
+            'currentcommander_outlet_energy_kwh_total': ('counter', 'Energy used by the outlet, the counter of the device or the power integrated since the exporter started'),
+            'currentcommander_input_energy_kwh_total': ('counter', 'Energy counter of the device input'),
+        }
+        for key, metric, help_text in self.outlet_metrics:
+            helps[metric] = ('gauge', help_text)
+        # grouped by metric name, as the text format requires
+        by_metric = {}
+        for device in self.devices:
+            for metric, labels, value in self.rendered.get(device, []):
+                by_metric.setdefault(metric, []).append('%s%s %s' % (metric, labels, repr(float(value))))
+        lines = []
+        for metric in sorted(by_metric):
+            metric_type, help_text = helps[metric]
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s %s' % (metric, metric_type))
+            lines.extend(by_metric[metric])
+        self.snapshot = ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def create_server(self, address, port):
+        load_backend('exporter')
+        exporter = self
+
+        class MetricsHandler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.snapshot
+                self.send_response(200)
+                self.send_header('Content-Type', exporter.content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return http_server.ThreadingHTTPServer((address, port), MetricsHandler)
+
+    def run(self, address, port):
+        server = self.create_server(address, port)
+        threading.Thread(target=server.serve_forever, name='MetricsExporter', daemon=True).start()
+        read_fd, write_fd = os.pipe()
+        self.poller.set_notify_fd(write_fd)
+        try:
+            while True:
+                now = time.time()
+                for device in self.devices:
+                    if now >= self.next_poll[device] and not self.poller.is_busy(device):
+                        self.next_poll[device] = now + self.get_interval(device)
+                        self.poller.refresh(device)
+                timeout = max(0.1, min([self.next_poll[d] for d in self.devices] + [now + 60]) - now)
+                if select.select([read_fd], [], [], timeout)[0]:
+                    os.read(read_fd, 4096)
+                devices = self.poller.process_results()
+                for device in devices:
+                    self.rendered[device] = self.render(device)
+                if devices:
+                    self.update_snapshot()
+        finally:
+            server.shutdown()
+            self.poller.stop()
+
+
+# commands for a single device -> number of arguments after the section
+DEVICE_COMMANDS = {'on': 1, 'off': 1, 'toggle': 1, 'cycle': 1, 'preset': 1, 'status': 0}
+
+def find_section(config_manager, section):
+    '''
+    Returns the name of the config section given by name or index
+    '''
+    sections = config_manager.get_sections()
+    if section in sections:
+        return section
+    try:
+        return sections[int(section)]
+    except (ValueError, IndexError):
+        raise ValueError('no device section ' + str(section))
+
+def run_device_command(ctrl, command, argument=None):
+    '''
+    Runs one of DEVICE_COMMANDS and returns the outlets of the device afterwards
+    '''
+    if not command in DEVICE_COMMANDS:
+        raise ValueError('unknown command ' + str(command))
+    # the switch commands update the cached outlets. toggle, cycle and presets depend on the current
+    # states, the cached ones of a long running daemon may be outdated by the front panel or other clients
+    if command in ('status', 'toggle', 'cycle', 'preset') or len(ctrl.outlets) == 0:
+        ctrl.refresh_status()
+    if command in ('on', 'off') and isinstance(argument, list):
+        # several outlets with as few requests as the device allows
+        ctrl.switch_many(dict((outlet_id, int(command == 'on')) for outlet_id in argument))
+    elif command == 'on':
+        ctrl.switch_on(argument)
+    elif command == 'off':
+        ctrl.switch_off(argument)
+    elif command == 'toggle':
+        ctrl.toggle_outlet(argument)
+    elif command == 'cycle':
+        ctrl.power_cycle(argument)
+    elif command == 'preset':
+        ctrl.activate_preset(argument - 1)
+    return ctrl.outlets
+
+def format_outlets(outlets):
+    lines = []
+    for i, outlet in enumerate(outlets):
+        state = 'off'
+        if outlet.get('state') == 1:
+            state = 'on'
+        lines.append('%3d  %-3s  %s' % (i + 1, state, outlet.get('name', '')))
+    return '\n'.join(lines)
+
+
+def locate_mac(config_manager, mac, get_controller=None):
+    '''
+    Looks up the MAC in the forwarding tables of all configured PoE switches. The tables are walked
+    concurrently, if they are older than the slow poll interval. Returns a list of dicts with section,
+    port, port name and the number of MACs on the port, the most likely port first
+    '''
+    if get_controller is None:
+        get_controller = lambda section_name: create_controller(config_manager.get_section(section_name))
+    devices = {}
+    lock = threading.Lock()
+
+    def refresh(section_name):
+        try:
+            ctrl = get_controller(section_name)
+            with ctrl.io_lock:
+                if ctrl._due_columns(['macAddresses']):
+                    ctrl.refresh_fdb()
+            with lock:
+                devices[ctrl] = section_name
+        except Exception as e:
+            print('%s: %s' % (section_name, e), file=sys.stderr)
+
+    threads = []
+    for section_name in config_manager.get_sections():
+        if config_manager.get_section(section_name).get('device') == 'poe_pse':
+            t = threading.Thread(target=refresh, args=(section_name,), daemon=True)
+            t.start()
+            threads.append(t)
+    for t in threads:
+        t.join()
+
+    locations = []
+    for device, if_index, mac_count in find_mac(mac, devices):
+        name = ''
+        if_indexes = (device.geometry or {}).get('if_indexes', [])
+        if if_index in if_indexes and if_indexes.index(if_index) < len(device.outlets):
+            name = device.outlets[if_indexes.index(if_index)].get('name', '')
+        locations.append({'section': devices[device], 'port': if_index, 'name': name, 'macs': mac_count})
+    return locations
+
+def format_locations(locations):
+    lines = []
+    for l in locations:
+        lines.append('%s port %d %s (%d MACs on the port)' % (l['section'], l['port'], l['name'], l['macs']))
+    return '\n'.join(lines)
+
+
+def json_default(o):
+    if isinstance(o, Outlet):
+        return o.to_dict()
+    return str(o)
+
+
+# Unix socket of the daemon
+DAEMON_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', CACHE_DIR), 'currentcommander.sock')
+# seconds a client waits for the answer of the daemon. A command waits for the io_lock of the device
+# (a running poll with its SNMP retries) and may take long itself: a Redfish power on waits up to
+# power_wait seconds, a cycle or preset the delays of the PowerOnSequencer
+DAEMON_TIMEOUT = 120
+
+'''
+Long running process, that keeps the controllers of all configured devices and with them
+the SNMP engines, IPMI sessions and http connections. It answers device commands on a
+Unix socket, one JSON object per line:
+
+request:  {"command": "on", "section": "PDU", "argument": 3}
+response: {"ok": true, "outlets": [...]}  or  {"ok": false, "error": "..."}
+
+Commands for different devices run concurrently, commands for the same device one after the other.
+'''
+class ControlDaemon(object):
+
+    # seconds a client may take to send a request
+    client_timeout = 10
+
+    def __init__(self, config_manager, path=DAEMON_SOCKET):
+        self.cfg = config_manager
+        self.path = path
+        self.lock = threading.Lock()
+        # section name -> controller
+        self.controllers = {}
+
+    def get_controller(self, section_name):
+        with self.lock:
+            ctrl = self.controllers.get(section_name)
+            if ctrl is None:
+                ctrl = create_controller(self.cfg.get_section(section_name))
+                ctrl.start_background()
+                self.controllers[section_name] = ctrl
+            return ctrl
+
+    def handle(self, request):
+        try:
+            if request.get('command') == 'where':
+                mac = parse_mac(str(request.get('argument')))
+                return {'ok': True, 'locations': locate_mac(self.cfg, mac, self.get_controller)}
+            section_name = find_section(self.cfg, request.get('section'))
+            ctrl = self.get_controller(section_name)
+            with ctrl.io_lock:
+                outlets = run_device_command(ctrl, request.get('command'), request.get('argument'))
+                return {'ok': True, 'section': section_name, 'outlets': outlets}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+    def warm_up(self):
+        '''
+        Connects to all devices in the background
+        '''
+        def connect(section_name):
+            try:
+                ctrl = self.get_controller(section_name)
+                with ctrl.io_lock:
+                    ctrl.refresh_status()
+            except Exception as e:
+                print('%s: %s' % (section_name, e), file=sys.stderr)
+        for section_name in self.cfg.get_sections():
+            threading.Thread(target=connect, args=(section_name,), daemon=True).start()
+
+    def create_server(self):
+        load_backend('daemon')
+        daemon = self
+
+        class ControlHandler(socketserver.StreamRequestHandler):
+            # applied to the client socket, a stalled client doesn't keep its thread forever
+            timeout = daemon.client_timeout
+
+            def handle(self):
+                try:
+                    for line in self.rfile:
+                        try:
+                            response = daemon.handle(json.loads(line))
+                        except ValueError as e:
+                            response = {'ok': False, 'error': 'invalid request: ' + str(e)}
+                        self.wfile.write(json.dumps(response, default=json_default).encode('utf-8') + b'\n')
+                except OSError:
+                    # timeout or the client went away
+                    pass
+
+        if exists(self.path):
+            if daemon_request({'command': 'status'}, self.path, self.client_timeout) is not None:
+                raise OSError('a daemon is already running on ' + self.path)
+            # left over from a daemon, that didn't exit cleanly
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # the socket is created with mode 0600, no other user can connect, not even between bind and chmod
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.path, ControlHandler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        return server
+
+    def run(self):
+        server = self.create_server()
+        self.warm_up()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+
+def daemon_request(request, path=DAEMON_SOCKET, timeout=DAEMON_TIMEOUT):
+    '''
+    Sends a request to the daemon and returns the response, or None if no daemon is running.
+    A daemon, that doesn't answer within timeout seconds, gives an error response
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            line = sock.makefile('rb').readline()
+        except socket.timeout:
+            return {'ok': False, 'error': 'no answer from the daemon within %g seconds, the command may still be running' % timeout}
+    if not line:
+        raise IOError('the daemon closed the connection')
+    return json.loads(line)
+
+
+def parse_outlets(spec, count=None):
+    '''
+    Returns the outlet numbers of a list like 1-4,7. * stands for all count outlets
+    '''
+    outlets = []
+    for part in spec.split(','):
+        if part == '*':
+            if count is None:
+                raise ValueError('* needs the number of outlets')
+            outlets.extend(range(1, count + 1))
+        elif '-' in part:
+            first, last = part.split('-', 1)
+            outlets.extend(range(int(first), int(last) + 1))
+        else:
+            outlets.append(int(part))
+    return outlets
+
+def parse_batch(text):
+    '''
+    Parses a batch script. Commands are separated by newlines or ';', # starts a comment.
+    Returns a list of (command number, section, command, argument)
+    '''
+    commands = []
+    for line in text.splitlines():
+        for part in line.split('#')[0].split(';'):
+            words = part.split()
+            if len(words) == 0:
+                continue
+            if not words[0] in DEVICE_COMMANDS:
+                raise ValueError('unknown command: ' + part.strip())
+            if len(words) != DEVICE_COMMANDS[words[0]] + 2:
+                raise ValueError('wrong number of arguments: ' + part.strip())
+            argument = None
+            if len(words) > 2:
+                argument = words[2]
+                # checked here, so a typo doesn't stop the script half way
+                parse_outlets(argument, 0)
+            commands.append((len(commands) + 1, words[1], words[0], argument))
+    return commands
+
+
+'''
+Runs the commands of a batch script. The commands are grouped per device, the groups
+run concurrently in a bounded number of threads and the commands of a group in script order.
+Each command goes to the daemon, if one is running, or to a controller of the group.
+'''
+class BatchRunner(object):
+
+    def __init__(self, config_manager, workers=4, use_daemon=True):
+        self.cfg = config_manager
+        self.workers = workers
+        self.use_daemon = use_daemon
+        self.groups = queue.Queue()
+        self.lock = threading.Lock()
+        # (command number, section, command, outlet, ok, message, seconds)
+        self.results = []
+
+    def _execute(self, state, section_name, command, argument):
+        request = {'command': command, 'section': section_name, 'argument': argument}
+        response = None
+        if self.use_daemon:
+            response = daemon_request(request)
+        if response is None:
+            self.use_daemon = False
+            if state.get('ctrl') is None:
+                state['ctrl'] = create_controller(self.cfg.get_section(section_name))
+            response = {'ok': True, 'outlets': run_device_command(state['ctrl'], command, argument)}
+        if not response['ok']:
+            raise IOError(response['error'])
+        return response['outlets']
+
+    def _run_group(self, section_name, commands):
+        state = {}
+        for number, section, command, spec in commands:
+            try:
+                if command == 'status':
+                    arguments = [None]
+                elif command == 'preset':
+                    arguments = [int(spec)]
+                elif '*' in spec:
+                    arguments = parse_outlets(spec, len(self._execute(state, section_name, 'status', None)))
+                else:
+                    arguments = parse_outlets(spec)
+                if command in ('on', 'off', 'cycle') and len(arguments) > 1:
+                    # switched together with switch_many, cycle with one delay for all outlets
+                    arguments = [arguments]
+            except Exception as e:
+                self._add_result(number, section_name, command, spec, False, str(e), 0)
+                continue
+            for argument in arguments:
+                started = time.perf_counter()
+                try:
+                    outlets = self._execute(state, section_name, command, argument)
+                    message = 'ok'
+                    if command == 'status':
+                        message = ' '.join('%d:%s' % (i + 1, 'on' if o.get('state') == 1 else 'off') for i, o in enumerate(outlets))
+                    self._add_result(number, section_name, command, argument, True, message, time.perf_counter() - started)
+                except Exception as e:
+                    self._add_result(number, section_name, command, argument, False, str(e), time.perf_counter() - started)
+
+    def _add_result(self, number, section_name, command, argument, ok, message, seconds):
+        if argument is None:
+            argument = ''
+        elif isinstance(argument, list):
+            argument = ','.join(str(outlet_id) for outlet_id in argument)
+        with self.lock:
+            self.results.append((number, section_name, command, str(argument), ok, message, seconds))
+
+    def _work(self):
+        while True:
+            try:
+                section_name, commands = self.groups.get_nowait()
+            except queue.Empty:
+                return
+            self._run_group(section_name, commands)
+
+    def run(self, commands):
+        '''
+        Runs the parsed commands and returns the results in script order
+        '''
+        grouped = {}
+        for number, section, command, argument in commands:
+            try:
+                section_name = find_section(self.cfg, section)
+            except ValueError as e:
+                self._add_result(number, section, command, argument, False, str(e), 0)
+                continue
+            grouped.setdefault(section_name, []).append((number, section, command, argument))
+        for section_name in grouped:
+            self.groups.put((section_name, grouped[section_name]))
+
+        threads = []
+        for i in range(0, min(self.workers, len(grouped))):
+            t = threading.Thread(target=self._work, name='BatchRunner-%d' % i, daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return sorted(self.results, key=lambda r: r[0])
+
+    @staticmethod
+    def format_results(results):
+        lines = ['%4s  %-16s %-7s %-6s %8s  %s' % ('#', 'device', 'command', 'outlet', 'time', 'result')]
+        for number, section_name, command, argument, ok, message, seconds in results:
+            if not ok:
+                message = 'FAILED: ' + message
+            lines.append('%4d  %-16s %-7s %-6s %6.0fms  %s' % (number, section_name, command, argument, seconds * 1000, message))
+        return '\n'.join(lines)
+
+
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -1461,41 +4884,145 @@ def main(argv=None):
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "h", ["help"])
-        except getopt.error(msg):
-            raise Usage(msg)
+            opts, args = getopt.getopt(argv[1:], "h", ["help", "snmp-stats", "startup-profile", "no-daemon", "jobs="])
+        except getopt.GetoptError as msg:
+            raise Usage(str(msg))
+        opts = dict(opts)
+        exit_code = 0
+        if '-h' in opts or '--help' in opts:
+            print(__usage__)
+            return 0
       
-        if len(argv) == 1:
+        if len(args) == 0:
             app = CursesUI()
             app.run()
-        elif len(argv) > 2:
-            command = argv[1]
-            config_section = int(argv[2])
-            outlet_id = int(argv[3])
-            config_manager = ConfigManager()
-            section_name = config_manager.get_sections()[config_section]
-            cfg = config_manager.get_section(section_name)
-                
-            print(cfg.name)
-            ctrl = NetPwrCtrl(cfg)
-            if command == 'on':
-                print("Switching %s outlet %d" % (command, outlet_id))
+        elif args[0] in ('export', 'rollup'):
+            if len(args) != 3:
+                raise Usage(args[0] + ' needs a start and an end time')
+            try:
+                start = datetime.fromisoformat(args[1]).timestamp()
+                end = datetime.fromisoformat(args[2]).timestamp()
+            except ValueError as e:
+                raise Usage(str(e))
+            archive = MetricArchive(os.path.join(DATA_DIR, 'archive'))
+            if args[0] == 'export':
+                archive.export_csv(sys.stdout, start, end)
+            else:
+                rollup = archive.rollup(start, end)
+                for key in sorted(k for k in rollup if k is not None):
+                    r = rollup[key]
+                    line = '%s outlet %d %s: %d samples, avg %g, max %g' % (key[0], key[1], key[2], r['count'], r['avg'], r['max'])
+                    if 'kwh' in r:
+                        line += ', %.3f kWh' % r['kwh']
+                    print(line)
+        elif args[0] == 'exporter':
+            address = ''
+            port = 9880
+            if len(args) > 1:
+                address, _, port = args[1].rpartition(':')
                 try:
-                    ctrl.switch_on(outlet_id)
-                except:
-                    True
-            elif command == 'off':
-                print("Switching %s outlet %d" % (command, outlet_id))
+                    port = int(port)
+                except ValueError:
+                    raise Usage('invalid port ' + args[1])
+            try:
+                MetricsExporter(ConfigManager()).run(address, port)
+            except KeyboardInterrupt:
+                pass
+        elif args[0] == 'benchmark-listview':
+            rows = 10000
+            if len(args) > 1:
+                rows = int(args[1])
+            benchmark_listview(rows)
+        elif args[0] == 'benchmark-archive':
+            days = 30
+            if len(args) > 1:
+                days = int(args[1])
+            benchmark_archive(days)
+        elif args[0] == 'daemon':
+            try:
+                ControlDaemon(ConfigManager()).run()
+            except KeyboardInterrupt:
+                pass
+        elif args[0] == 'batch':
+            try:
+                if len(args) > 1 and args[1] != '-':
+                    with open(args[1]) as f:
+                        commands = parse_batch(f.read())
+                else:
+                    commands = parse_batch(sys.stdin.read())
+                workers = int(opts.get('--jobs', 4))
+            except (OSError, ValueError) as e:
+                raise Usage(str(e))
+            runner = BatchRunner(ConfigManager(), max(1, workers), not '--no-daemon' in opts)
+            results = runner.run(commands)
+            print(BatchRunner.format_results(results))
+            if not all(r[4] for r in results):
+                exit_code = 1
+        elif args[0] == 'where':
+            if len(args) != 2:
+                raise Usage('where needs a MAC address')
+            try:
+                mac = parse_mac(args[1])
+            except ValueError as e:
+                raise Usage(str(e))
+            response = None
+            if not '--no-daemon' in opts:
+                response = daemon_request({'command': 'where', 'argument': args[1]})
+            if response is None:
+                response = {'ok': True, 'locations': locate_mac(ConfigManager(), mac)}
+            if not response['ok']:
+                print(response['error'], file=sys.stderr)
+                exit_code = 1
+            elif len(response['locations']) == 0:
+                print(format_mac(mac) + ' not found', file=sys.stderr)
+                exit_code = 1
+            else:
+                print(format_locations(response['locations']))
+        elif args[0] in DEVICE_COMMANDS:
+            command = args[0]
+            if len(args) != DEVICE_COMMANDS[command] + 2:
+                raise Usage('wrong number of arguments for ' + command)
+            argument = None
+            if DEVICE_COMMANDS[command] > 0:
                 try:
-                    ctrl.switch_off(outlet_id)
-                except:
-                    True
+                    argument = int(args[2])
+                except ValueError:
+                    raise Usage('not a number: ' + args[2])
+            request = {'command': command, 'section': args[1], 'argument': argument}
+
+            response = None
+            if not '--no-daemon' in opts:
+                response = daemon_request(request)
+            if response is None:
+                # no daemon running, talk to the device directly
+                config_manager = ConfigManager()
+                try:
+                    section_name = find_section(config_manager, args[1])
+                    ctrl = create_controller(config_manager.get_section(section_name))
+                    response = {'ok': True, 'section': section_name, 'outlets': run_device_command(ctrl, command, argument)}
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+            if not response['ok']:
+                print(response['error'], file=sys.stderr)
+                exit_code = 1
+            elif command == 'status':
+                print(response['section'])
+                print(format_outlets(response['outlets']))
             else:
-                print("Unknown command")
-            
+                print('%s %s %d' % (response['section'], command, argument))
+        else:
+            raise Usage('unknown command ' + args[0])
+
+        IPMISessionLoop.shutdown()
+        if '--snmp-stats' in opts:
+            print(snmp_engine_pool.report(), file=sys.stderr)
+        if '--startup-profile' in opts:
+            print(startup_profile_report(), file=sys.stderr)
+        return exit_code
+
     except Usage as err:
-        print >>sys.stderr, err.msg
-        print >>sys.stderr, "for help use --help"
+        print(err.msg, file=sys.stderr)
+        print("for help use --help", file=sys.stderr)
         return 2
 
 if __name__ == "__main__":
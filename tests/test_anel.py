@@ -0,0 +1,132 @@
+import configparser
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+def strip_config(**settings):
+    config = configparser.ConfigParser()
+    config['strip'] = dict({'host': '127.0.0.1', 'port': '75', 'user': 'admin', 'pwd': 'anel',
+                            'udp_receive_port': '0', '1': 'one', '2': 'two', '3': 'three'}, **settings)
+    return config['strip']
+
+
+def status_datagram(states):
+    outlets = ':'.join('Nr. %d,%d' % (i + 1, state) for i, state in enumerate(states))
+    return ('NET-PwrCtrl:NET-CONTROL    :127.0.0.1:255.255.255.0:192.168.0.1:0.4.163.10.9.107:'
+            + outlets + ':248:80:NET-PWRCTRL_04.5:xor:').encode('latin-1')
+
+
+class FakeChannel(object):
+    '''
+    Switches the outlets of the fake strip, which sends its status to the listener port like a real strip
+    '''
+
+    def __init__(self, states, port):
+        self.states = states
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _report(self):
+        time.sleep(0.05)
+        self.sock.sendto(status_datagram(self.states), ('127.0.0.1', self.port))
+
+    def switch(self, outlet_id, state):
+        self.states[outlet_id-1] = int(state)
+        threading.Thread(target=self._report).start()
+
+    def set_all(self, states):
+        self.states[:] = states
+        threading.Thread(target=self._report).start()
+
+
+class FakeStrip(cc.NetPwrCtrl):
+
+    def __init__(self, cfg, states):
+        super(FakeStrip, self).__init__(cfg)
+        self.states = states
+        self.http_requests = 0
+
+    def _fetch_outlet_states(self):
+        self.http_requests += 1
+        return [['Nr. %d' % (i + 1), str(state), '0'] for i, state in enumerate(self.states)]
+
+
+@pytest.fixture
+def listener():
+    listener = cc.AnelBroadcastListener(0)
+    listener.start()
+    return listener
+
+
+def listening_strip(listener):
+    strip = FakeStrip(strip_config(), [0, 0, 0, 0, 0, 0, 0, 0])
+    strip.listener = listener
+    listener.add_device(strip)
+    strip.channel = FakeChannel(strip.states, listener.sock.getsockname()[1])
+    strip.refresh_status()
+    strip.http_requests = 0
+    return strip
+
+
+def test_switch_is_confirmed_by_the_listener_under_the_io_lock(listener):
+    strip = listening_strip(listener)
+    started = time.time()
+    with strip.io_lock:
+        strip.switch_many({2: 1})
+    assert time.time() - started < 0.5
+    assert strip.http_requests == 0
+    assert strip.outlets[1]['state'] == 1
+
+
+def test_several_outlets_are_confirmed_by_the_listener(listener):
+    strip = listening_strip(listener)
+    with strip.io_lock:
+        strip.switch_many({1: 1, 3: 1})
+    assert strip.states[:3] == [1, 0, 1]
+    # only the states of the other outlets, which were older than max_state_age
+    assert strip.http_requests <= 1
+    assert [o['state'] for o in strip.outlets] == [1, 0, 1]
+
+
+def test_switch_without_listener_is_confirmed_over_http():
+    strip = FakeStrip(strip_config(), [0, 0, 0, 0, 0, 0, 0, 0])
+    strip.channel = FakeChannel(strip.states, 9)
+    strip.channel.switch = lambda outlet_id, state: strip.states.__setitem__(outlet_id-1, state)
+    started = time.time()
+    strip.switch_many({1: 1})
+    assert time.time() - started < 0.5
+    assert strip.http_requests == 1
+    assert strip.outlets[0]['state'] == 1
+
+
+def test_parse_datagram_of_a_real_strip():
+    # NET-PwrCtrl HOME, firmware 4.5, as sent to port 77 after each change
+    data = (b'NET-PwrCtrl:NET-CONTROL    :192.168.0.244:255.255.255.0:192.168.0.1:0.4.163.10.9.107:'
+            b'Nr. 1,1:Nr. 2,1:Nr. 3,0:Nr. 4,0:Nr. 5,0:Nr. 6,0:Nr. 7,0:Nr. 8,1:248:80:NET-PWRCTRL_04.5:xor:\r\n')
+    ip, outlets = cc.AnelBroadcastListener.parse_datagram(data)
+    assert ip == '192.168.0.244'
+    assert outlets == [['Nr. 1', '1'], ['Nr. 2', '1'], ['Nr. 3', '0'], ['Nr. 4', '0'],
+                       ['Nr. 5', '0'], ['Nr. 6', '0'], ['Nr. 7', '0'], ['Nr. 8', '1']]
+
+
+def test_parse_datagram_stops_at_the_io_ports():
+    # ADV and IO models send their inputs after the outlets, names may contain commas and latin-1
+    data = ('NET-PwrCtrl:NET-CONTROL    :10.0.0.5:255.0.0.0:10.0.0.1:0.4.163.20.1.2:'
+            'Server, rack 1,1:K\xfchlung,0:IO-1,0,0:IO-2,1,1:p:23.5\xb0C:').encode('latin-1')
+    ip, outlets = cc.AnelBroadcastListener.parse_datagram(data)
+    assert ip == '10.0.0.5'
+    assert outlets == [['Server, rack 1', '1'], ['K\xfchlung', '0']]
+
+
+def test_parse_datagram_ignores_other_datagrams():
+    assert cc.AnelBroadcastListener.parse_datagram(b'') is None
+    assert cc.AnelBroadcastListener.parse_datagram(b'Sw_on1adminanel') is None
+    assert cc.AnelBroadcastListener.parse_datagram(b'NET-PwrCtrl:short:1') is None
@@ -0,0 +1,89 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+DAY = 86400
+# 2026-01-01 00:00 UTC
+START = 1767225600.0
+POWER = ('pdu', 1, 'power')
+CURRENT = ('pdu', 1, 'current')
+
+
+def filled_archive(path):
+    '''
+    A power sample every 60 seconds from 23:00 to 01:00 of the next day, the current every 120 seconds
+    '''
+    archive = cc.MetricArchive(str(path))
+    for n in range(121):
+        t = START + DAY - 3600 + 60 * n
+        samples = [(POWER, 100.0 if t < START + DAY else 200.0)]
+        if n % 2 == 0:
+            samples.append((CURRENT, 0.5))
+        archive.append(t, samples)
+    archive.close()
+    return archive
+
+
+def test_records_go_to_one_file_per_day(tmp_path):
+    filled_archive(tmp_path)
+    assert sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.bin')) == ['2026-01-01.bin', '2026-01-02.bin']
+
+
+def test_query_spans_the_day_files(tmp_path):
+    archive = filled_archive(tmp_path)
+    records = list(archive.query(START + DAY - 120, START + DAY + 120, [POWER]))
+    assert [t - START - DAY for t, key, value in records] == [-120, -60, 0, 60]
+    assert [value for t, key, value in records] == [100.0, 100.0, 200.0, 200.0]
+    assert all(key == POWER for t, key, value in records)
+    # the end is exclusive, ranges without files are empty
+    assert len(list(archive.query(START + DAY - 3600, START + DAY + 3600))) == 120 + 60
+    assert list(archive.query(START, START + 3600)) == []
+
+
+def test_series_ids_survive_a_restart(tmp_path):
+    filled_archive(tmp_path)
+    archive = cc.MetricArchive(str(tmp_path))
+    assert len(list(archive.query(START, START + 2 * DAY, [CURRENT]))) == 61
+    assert list(archive.query(START, START + 2 * DAY, [('pdu', 2, 'power')])) == []
+
+
+def test_rollup_across_midnight(tmp_path):
+    archive = filled_archive(tmp_path)
+    result = archive.rollup(START + DAY - 3600, START + DAY + 3600)
+    power = result[POWER]
+    assert power['count'] == 120
+    assert power['max'] == 200.0
+    assert power['avg'] == 150.0
+    # an hour at 100 W and 59 minutes at 200 W
+    assert abs(power['kwh'] - (100.0 + 200.0 * 59 / 60) / 1000) < 1e-9
+    assert result[CURRENT]['avg'] == 0.5
+    assert 'kwh' not in result[CURRENT]
+
+
+def test_rollup_skips_gaps(tmp_path):
+    archive = cc.MetricArchive(str(tmp_path))
+    archive.append(START, [(POWER, 100.0)])
+    archive.append(START + 60, [(POWER, 100.0)])
+    # longer than max_gap, e.g. while the program wasn't running
+    archive.append(START + 3600, [(POWER, 100.0)])
+    archive.close()
+    assert abs(archive.rollup(START, START + DAY)[POWER]['kwh'] - 100.0 * 60 / 3600000) < 1e-12
+
+
+def test_records_stay_sorted_when_the_clock_goes_back(tmp_path):
+    archive = cc.MetricArchive(str(tmp_path))
+    archive.append(START + 100, [(POWER, 1.0)])
+    archive.append(START + 50, [(POWER, 2.0)])
+    archive.close()
+    assert [t - START for t, key, value in archive.query(START, START + 200)] == [100, 100]
+
+
+def test_export_csv(tmp_path):
+    archive = filled_archive(tmp_path)
+    out = io.StringIO()
+    archive.export_csv(out, START + DAY, START + DAY + 60, [POWER])
+    assert out.getvalue().splitlines() == ['time,device,outlet,metric,value',
+                                           '2026-01-02T00:00:00+00:00,pdu,1,power,200']
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+MAC = bytes.fromhex('0004a30a096b')
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cc.time, 'time', clock.time)
+    return clock
+
+
+def test_parse_ipv4_row_of_ipnettophysicaltable():
+    # ifIndex 3, ipv4, 4 bytes
+    assert cc.ArpCache.parse_row('ipNetToPhysicalPhysAddress', '3.1.4.192.168.0.10', MAC) == (0x0004a30a096b, '192.168.0.10')
+
+
+def test_parse_ipv6_row_of_ipnettophysicaltable():
+    index = '3.2.16.' + '.'.join(str(b) for b in bytes.fromhex('fe800000000000000204a3fffe0a096b'))
+    assert cc.ArpCache.parse_row('ipNetToPhysicalPhysAddress', index, MAC) == (0x0004a30a096b, 'fe80::204:a3ff:fe0a:96b')
+
+
+def test_parse_row_of_ipnettomediatable():
+    assert cc.ArpCache.parse_row('ipNetToMediaPhysAddress', '12.10.0.0.1', MAC) == (0x0004a30a096b, '10.0.0.1')
+
+
+@pytest.mark.parametrize('key, index, value', [
+    # empty MAC of an incomplete entry
+    ('ipNetToPhysicalPhysAddress', '3.1.4.192.168.0.10', b''),
+    # length doesn't match the address
+    ('ipNetToPhysicalPhysAddress', '3.1.4.192.168.0', MAC),
+    # ipv4z
+    ('ipNetToPhysicalPhysAddress', '3.3.8.192.168.0.10.0.0.0.1', MAC),
+    ('ipNetToPhysicalPhysAddress', '3', MAC),
+    ('ipNetToMediaPhysAddress', '12.10.0.0', MAC),
+])
+def test_parse_row_skips_other_rows(key, index, value):
+    assert cc.ArpCache.parse_row(key, index, value) is None
+
+
+def test_entries_expire(clock):
+    cache = cc.ArpCache()
+    cache.put(1, '10.0.0.1', 60)
+    cache.put(1, 'fe80::1', 600)
+    cache.put(1, '10.0.0.2', 600)
+    cache.put(2, '10.0.0.3', 60)
+    assert cache.lookup(1) == ['10.0.0.1', '10.0.0.2', 'fe80::1']
+    clock.now += 61
+    assert cache.lookup(1) == ['10.0.0.2', 'fe80::1']
+    assert cache.lookup(2) == []
+    cache.expire()
+    assert sorted(cache.entries) == [1]
+    assert sorted(cache.entries[1]) == ['10.0.0.2', 'fe80::1']
+    # seen again in a later walk
+    cache.put(1, '10.0.0.1', 60)
+    assert cache.lookup(1) == ['10.0.0.1', '10.0.0.2', 'fe80::1']
+    clock.now += 600
+    cache.expire()
+    assert cache.entries == {}
+    assert cache.lookup(3) == []
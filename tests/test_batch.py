@@ -0,0 +1,115 @@
+import configparser
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+def test_parse_outlets():
+    assert cc.parse_outlets('3') == [3]
+    assert cc.parse_outlets('1-4,7') == [1, 2, 3, 4, 7]
+    assert cc.parse_outlets('*', 3) == [1, 2, 3]
+    assert cc.parse_outlets('2,*', 2) == [2, 1, 2]
+    with pytest.raises(ValueError):
+        cc.parse_outlets('*')
+    for spec in ('', 'a', '1-', '1,,2', '1-b'):
+        with pytest.raises(ValueError):
+            cc.parse_outlets(spec, 8)
+
+
+def test_parse_batch():
+    text = 'on 0 1-4; off pdu 2 # comment\n\n  cycle 1 * ;status 0\n# only a comment\npreset pdu 2'
+    assert cc.parse_batch(text) == [
+        (1, '0', 'on', '1-4'),
+        (2, 'pdu', 'off', '2'),
+        (3, '1', 'cycle', '*'),
+        (4, '0', 'status', None),
+        (5, 'pdu', 'preset', '2'),
+    ]
+    assert cc.parse_batch('') == []
+
+
+@pytest.mark.parametrize('text', ['reboot 0 1', 'on 0', 'status 0 1', 'on 0 1 2', 'off 0 x', 'on 0 1;off 0 1-'])
+def test_parse_batch_rejects_bad_commands(text):
+    with pytest.raises(ValueError):
+        cc.parse_batch(text)
+
+
+class Config(cc.ConfigManager):
+
+    def __init__(self, *sections):
+        self.config = configparser.ConfigParser()
+        for section in sections:
+            self.config[section] = {'device': 'fake'}
+
+
+class FakeDevice(cc.PowerStripController):
+    '''
+    Records the calls in the log of the test. With a barrier the first call waits for the other device
+    '''
+    created = []
+    barrier = None
+
+    def __init__(self, cfg, log):
+        super(FakeDevice, self).__init__(cfg)
+        self.log = log
+        for i in range(4):
+            self._store_outlet(i, {'name': str(i + 1), 'state': 0})
+        FakeDevice.created.append(cfg.name)
+
+    def _call(self, *call):
+        if self.barrier is not None:
+            barrier = self.barrier
+            self.barrier = None
+            barrier.wait(2)
+        self.log.append((self.cfg.name,) + call)
+
+    def refresh_status(self):
+        self._call('refresh')
+
+    def switch_on(self, outlet_id):
+        if outlet_id == 4:
+            raise IOError('outlet 4 is broken')
+        self._call('on', outlet_id)
+        self._apply_on_state(self.outlets, outlet_id)
+
+    def switch_off(self, outlet_id):
+        self._call('off', outlet_id)
+        self._apply_off_state(self.outlets, outlet_id)
+
+    def switch_many(self, states):
+        self._call('many', states)
+
+
+@pytest.fixture
+def devices(monkeypatch):
+    log = []
+    monkeypatch.setattr(FakeDevice, 'created', [])
+    monkeypatch.setattr(cc, 'create_controller', lambda cfg: FakeDevice(cfg, log))
+    return log
+
+
+def test_batch_runs_the_commands_per_device_in_script_order(devices, monkeypatch):
+    monkeypatch.setattr(FakeDevice, 'barrier', threading.Barrier(2))
+    runner = cc.BatchRunner(Config('a', 'b'), workers=2, use_daemon=False)
+    results = runner.run(cc.parse_batch('on a 1; on b 2; off a 1,3; on 1 4; status 0; on 5 1; on b 3'))
+    # both devices were switched at the same time, or the barrier had broken
+    assert all(ok for number, section, command, argument, ok, message, seconds in results if number not in (4, 6))
+    assert sorted(FakeDevice.created) == ['a', 'b']
+    assert [call[1:] for call in devices if call[0] == 'a'] == [('on', 1), ('many', {1: 0, 3: 0}), ('refresh',)]
+    assert [call[1:] for call in devices if call[0] == 'b'] == [('on', 2), ('on', 3)]
+    assert [r[0] for r in results] == [1, 2, 3, 4, 5, 6, 7]
+    assert results[2][3] == '1,3'
+    assert results[3][4] is False and results[3][5] == 'outlet 4 is broken'
+    assert results[4][5] == '1:on 2:off 3:off 4:off'
+    assert results[5][4] is False and results[5][5] == 'no device section 5'
+
+
+def test_star_asks_the_device_for_the_outlets(devices):
+    runner = cc.BatchRunner(Config('a'), use_daemon=False)
+    runner.run(cc.parse_batch('off a *'))
+    assert devices == [('a', 'refresh'), ('a', 'many', {1: 0, 2: 0, 3: 0, 4: 0})]
@@ -0,0 +1,101 @@
+import configparser
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+class EmptyConfig(cc.ConfigManager):
+
+    def __init__(self):
+        self.config = configparser.ConfigParser()
+
+
+class FakePDU(cc.PowerStripController):
+
+    def __init__(self, name, outlets, input_energy=None):
+        config = configparser.ConfigParser()
+        config[name] = {}
+        super(FakePDU, self).__init__(config[name])
+        for i, values in enumerate(outlets):
+            self._store_outlet(i, values)
+        self.input_energy = input_energy
+        self.last_poll_duration = 0.25
+
+    def get_input_energy(self):
+        return self.input_energy
+
+
+@pytest.fixture
+def exporter():
+    exporter = cc.MetricsExporter(EmptyConfig())
+    yield exporter
+    exporter.poller.stop()
+    cc.AnelBroadcastListener.update_callbacks.remove(exporter.poller.notify)
+    cc.SnmpTrapReceiver.update_callbacks.remove(exporter.poller.notify)
+    cc.SnmpTrapReceiver.refresh_callbacks.remove(exporter.poller.refresh)
+
+
+def samples(exporter, device, now):
+    return dict(((metric, labels), value) for metric, labels, value in exporter.render(device, now))
+
+
+def test_render_outlets(exporter):
+    pdu = FakePDU('rack "A"', [{'name': 'srv', 'state': 1, 'voltage': 230, 'current': 0.5}, {'name': 'off', 'state': 0}])
+    result = samples(exporter, pdu, 1000.0)
+    labels = '{device="rack \\"A\\"",outlet="1",name="srv"}'
+    assert result[('currentcommander_outlet_state', labels)] == 1
+    assert result[('currentcommander_outlet_voltage_volts', labels)] == 230.0
+    assert result[('currentcommander_outlet_current_amperes', labels)] == 0.5
+    assert ('currentcommander_outlet_power_watts', labels) not in result
+    assert result[('currentcommander_outlet_state', '{device="rack \\"A\\"",outlet="2",name="off"}')] == 0
+    assert result[('currentcommander_poll_error', '{device="rack \\"A\\""}')] == 0
+    assert result[('currentcommander_last_poll_timestamp_seconds', '{device="rack \\"A\\""}')] == 1000.0
+
+
+def test_failed_poll_keeps_the_last_success(exporter):
+    pdu = FakePDU('pdu', [])
+    exporter.render(pdu, 1000.0)
+    pdu.last_error = 'timeout'
+    result = samples(exporter, pdu, 1015.0)
+    assert result[('currentcommander_poll_error', '{device="pdu"}')] == 1
+    assert result[('currentcommander_last_poll_timestamp_seconds', '{device="pdu"}')] == 1000.0
+
+
+def test_energy_counter_of_the_device_is_used(exporter):
+    pdu = FakePDU('pdu', [{'name': 'srv', 'power': 100, 'powerDissipation': 12.5}], input_energy=40.0)
+    exporter.render(pdu, 1000.0)
+    result = samples(exporter, pdu, 4600.0)
+    assert result[('currentcommander_outlet_energy_kwh_total', '{device="pdu",outlet="1",name="srv"}')] == 12.5
+    assert result[('currentcommander_input_energy_kwh_total', '{device="pdu"}')] == 40.0
+    assert exporter.energy == {}
+
+
+def test_energy_is_integrated_without_counter(exporter):
+    pdu = FakePDU('pdu', [{'name': 'srv', 'power': 100}])
+    key = ('currentcommander_outlet_energy_kwh_total', '{device="pdu",outlet="1",name="srv"}')
+    assert samples(exporter, pdu, 1000.0)[key] == 0.0
+    pdu.outlets[0]['power'] = 300
+    assert samples(exporter, pdu, 1300.0)[key] == pytest.approx(100 * 300 / 3600000.0)
+    # a gap longer than max_gap doesn't count
+    assert samples(exporter, pdu, 1300.0 + exporter.max_gap + 1)[key] == pytest.approx(100 * 300 / 3600000.0)
+    assert ('currentcommander_input_energy_kwh_total', '{device="pdu"}') not in samples(exporter, pdu, 2000.0)
+
+
+def test_snapshot_groups_the_metrics(exporter):
+    first = FakePDU('first', [{'name': 'a', 'state': 1}])
+    second = FakePDU('second', [{'name': 'b', 'state': 0}])
+    exporter.devices = [first, second]
+    for device in exporter.devices:
+        exporter.rendered[device] = exporter.render(device, 1000.0)
+    exporter.update_snapshot()
+    lines = exporter.snapshot.decode('utf-8').splitlines()
+    start = lines.index('# TYPE currentcommander_outlet_state gauge')
+    assert lines[start - 1] == '# HELP currentcommander_outlet_state Outlet state, 1 on, 0 off'
+    assert lines[start + 1:start + 3] == ['currentcommander_outlet_state{device="first",outlet="1",name="a"} 1.0',
+                                          'currentcommander_outlet_state{device="second",outlet="1",name="b"} 0.0']
+    assert lines.count('# TYPE currentcommander_outlet_state gauge') == 1
+    assert '# TYPE currentcommander_outlet_energy_kwh_total counter' not in lines
@@ -0,0 +1,69 @@
+import configparser
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+def test_ring_buffer_grows_with_the_samples():
+    buffer = cc.RingBuffer(1000)
+    assert buffer.nbytes() == 12 * buffer.initial_size
+    for n in range(100):
+        buffer.append(float(n), n)
+    assert buffer.nbytes() == 12 * 128
+    assert buffer.items() == [(float(n), n) for n in range(100)]
+    assert buffer.last() == (99.0, 99)
+
+
+def test_ring_buffer_overwrites_the_oldest_sample_after_growing():
+    buffer = cc.RingBuffer(100)
+    for n in range(250):
+        buffer.append(float(n), n)
+    assert buffer.nbytes() == 12 * 100
+    assert buffer.items() == [(float(n), n) for n in range(150, 250)]
+    assert buffer.items(since=247.0) == [(248.0, 248), (249.0, 249)]
+    assert buffer.last() == (249.0, 249)
+    assert cc.RingBuffer(10).nbytes() == 12 * 10
+
+
+def test_series_averages_per_minute_and_hour():
+    series = cc.MetricSeries()
+    for t in range(0, 7200, 10):
+        series.append(float(t), 1.0 if t < 3600 else 3.0)
+    minutes = series.items('minute')
+    # the minute and hour in progress are appended with the next sample after them
+    assert len(minutes) == 119
+    assert minutes[0] == (0.0, 1.0) and minutes[-1] == (7080.0, 3.0)
+    assert series.items('hour') == [(0.0, 1.0)]
+    assert len(series.items()) == 720
+
+
+def test_configured_sizes_limit_new_series():
+    config = cc.ConfigManager.__new__(cc.ConfigManager)
+    config.config = configparser.ConfigParser()
+    config.config['DEFAULT'] = {'history': '60,24,2'}
+    history = cc.MetricHistory()
+    original = cc.metric_history
+    cc.metric_history = history
+    try:
+        cc.configure_archive(config)
+    finally:
+        cc.metric_history = original
+    assert history.sizes == [60, 24, 2]
+    series = cc.MetricSeries(history.sizes)
+    for t in range(0, 86400, 5):
+        series.append(float(t), 1.0)
+    assert [len(series.items(tier)) for tier in ('raw', 'minute', 'hour')] == [60, 24, 2]
+    assert series.nbytes() == 12 * (60 + 24 + 2)
+
+
+@pytest.mark.parametrize('value', ['60,24', '60,0,2', 'a,b,c'])
+def test_bad_history_sizes(value):
+    config = cc.ConfigManager.__new__(cc.ConfigManager)
+    config.config = configparser.ConfigParser()
+    config.config['DEFAULT'] = {'history': value}
+    with pytest.raises(ValueError):
+        cc.configure_archive(config)
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+def test_values_are_parsed_once():
+    outlet = cc.Outlet({'name': 'srv', 'state': '1', 'current': '0.25', 'poe_status': 'on', 'mac_addrs': ['aa']})
+    assert outlet['state'] == 1
+    assert outlet['current'] == 0.25
+    assert outlet['mac_addrs'] == ['aa']
+    # unparseable values are stored as None and look missing
+    outlet.update({'voltage': 'n/a'})
+    assert 'voltage' not in outlet
+    assert outlet.get('voltage', 230) == 230
+    with pytest.raises(KeyError):
+        outlet['voltage']
+    with pytest.raises(KeyError):
+        outlet.update({'colour': 'red'})
+
+
+def test_change_mask_is_set_and_cleared():
+    outlet = cc.Outlet({'name': 'srv', 'state': 0, 'current': 0.0})
+    assert outlet.is_changed('name', 'state', 'current')
+    outlet.clear_changes()
+    assert not outlet.is_changed()
+    # the same value doesn't set the bit, even if it comes as a string
+    outlet.update({'state': '0', 'current': 0.0})
+    assert not outlet.is_changed()
+    outlet['state'] = 1
+    assert outlet.is_changed()
+    assert outlet.is_changed('state')
+    assert outlet.is_changed('power', 'state')
+    assert not outlet.is_changed('current', 'name')
+    outlet.clear_changes()
+    assert not outlet.is_changed('state')
+
+
+def test_store_outlet_patches_the_outlets_in_place():
+    ctrl = cc.PowerStripController({})
+    ctrl._store_outlet(0, {'name': 'one', 'state': 1})
+    ctrl._store_outlet(1, {'name': 'two', 'state': 0})
+    first, second = ctrl.outlets
+    for outlet in ctrl.outlets:
+        outlet.clear_changes()
+    ctrl._store_outlet(0, {'name': 'one', 'state': 0})
+    ctrl._store_outlet(1, {'name': 'two', 'state': 0})
+    assert ctrl.outlets[0] is first and ctrl.outlets[1] is second
+    assert first.is_changed('state') and not first.is_changed('name')
+    assert not second.is_changed()
+    assert first.to_dict() == {'name': 'one', 'state': 0}
+
+
+def test_switching_sets_state_and_time():
+    ctrl = cc.PowerStripController({})
+    ctrl._store_outlet(0, {'name': 'one', 'state': 0})
+    ctrl.outlets[0].clear_changes()
+    ctrl._apply_on_state(ctrl.outlets, 1)
+    assert ctrl.outlets[0]['state'] == 1
+    assert ctrl.outlets[0].is_changed('state', 'last_on')
+    assert not ctrl.outlets[0].is_changed('last_off')
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cc.time, 'time', clock.time)
+    monkeypatch.setattr(cc.time, 'sleep', clock.sleep)
+    return clock
+
+
+class LaggingPDU(cc.PowerStripController):
+    '''
+    Reports the current of an outlet lag seconds after it was switched on
+    '''
+
+    def __init__(self, clock, draws, lag=3.0, budget=None):
+        self.clock = clock
+        self.cfg = {}
+        if budget is not None:
+            self.cfg['current_budget'] = str(budget)
+        self.draws = draws
+        self.lag = lag
+        self.switched_on = {}
+        self.outlets = [cc.Outlet({'state': 0, 'on_current': draw}) for draw in draws]
+        self.log = []
+
+    def switch_many(self, states):
+        for outlet_id, state in states.items():
+            self.log.append((self.clock.now, outlet_id, state))
+            if state:
+                self.switched_on[outlet_id] = self.clock.now
+
+    def get_total_current(self):
+        return sum(self.draws[outlet_id-1] for outlet_id, at in self.switched_on.items()
+                   if self.clock.now - at >= self.lag)
+
+
+def test_power_ons_wait_for_the_lagging_current(clock):
+    pdu = LaggingPDU(clock, [2.0, 2.0, 2.0], lag=3.0)
+    cc.PowerOnSequencer(pdu).run({1: 1, 2: 1, 3: 1})
+    times = [t for t, outlet_id, state in pdu.log]
+    # each outlet waits until the current of the one before was reported
+    assert times[1] - times[0] >= 3.0
+    assert times[2] - times[1] >= 3.0
+
+
+def test_budget_sees_the_lagging_current(clock):
+    pdu = LaggingPDU(clock, [4.0, 4.0, 4.0], lag=3.0, budget=10.0)
+    with pytest.raises(IOError):
+        cc.PowerOnSequencer(pdu).run({1: 1, 2: 1, 3: 1})
+    assert [outlet_id for t, outlet_id, state in pdu.log] == [1, 2]
+
+
+def test_unmeasured_outlets_get_the_fixed_delay(clock):
+    pdu = LaggingPDU(clock, [0.5, 0.5], lag=3.0, budget=1.0)
+    for outlet in pdu.outlets:
+        outlet['on_current'] = None
+        outlet['max_current'] = 16.0
+    cc.PowerOnSequencer(pdu).run({1: 1, 2: 1})
+    times = [t for t, outlet_id, state in pdu.log]
+    assert len(times) == 2
+    assert times[1] - times[0] >= pdu.multi_power_on_delay
@@ -0,0 +1,321 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+class EndOfMibView(object):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def snmp_backend(monkeypatch):
+    try:
+        cc.load_backend('snmp')
+    except ImportError:
+        # the walk logic doesn't need pysnmp, only its exception value types
+        monkeypatch.setattr(cc, 'EndOfMibView', EndOfMibView, raising=False)
+        monkeypatch.setattr(cc, 'NoSuchObject', type('NoSuchObject', (), {}), raising=False)
+        monkeypatch.setattr(cc, 'NoSuchInstance', type('NoSuchInstance', (), {}), raising=False)
+        monkeypatch.setattr(cc, 'bulkCmd', None, raising=False)
+    # the fake agent gets the OIDs as strings
+    monkeypatch.setattr(cc, 'ObjectType', lambda oid: oid, raising=False)
+    monkeypatch.setattr(cc, 'ObjectIdentity', lambda oid: oid, raising=False)
+
+
+@pytest.fixture(autouse=True)
+def geometry_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(cc, 'snmp_geometry_cache', cc.SnmpGeometryCache(str(tmp_path / 'geometry.json')))
+    monkeypatch.setattr(cc, 'getCmd', None, raising=False)
+
+
+class FakeAgentMixin(object):
+    '''
+    Answers GETBULK like pysnmp with lexicographicMode=False: one row per column value and
+    a last row with the OID of the row before and endOfMibView
+    '''
+
+    def __init__(self, tables):
+        self.cfg = {'host': 'agent'}
+        self.port = 161
+        self.max_repetitions = 10
+        self.tables = tables
+        self.requests = 0
+        self.outlets = []
+        self.background_errors = {}
+        self.io_lock = threading.Lock()
+        self.data = {}
+        self.row_index = {}
+        self.polled = {}
+        self.geometry = None
+        self.geometry_checked = 0
+        self.uptime = 100000
+        self.if_number = len(tables.get('ifName', []))
+        # errorIndication of the next walks, e.g. a timeout
+        self.failure = None
+
+    def _request_done(self, errorIndication):
+        pass
+
+    def _snmp_request(self, cmd, *varBinds):
+        # sysUpTime.0 and ifNumber.0 of get_geometry
+        return None, 0, 0, [('1.3.6.1.2.1.1.3.0', self.uptime), ('1.3.6.1.2.1.2.1.0', self.if_number)]
+
+    def _getObjectType(self, key):
+        return key
+
+    def _pooled_cmd(self, cmd, non_repeaters, max_repetitions, *keys, **kwargs):
+        self.requests += 1
+        if self.failure is not None:
+            yield self.failure, 0, 0, []
+            return
+        # _walk_column requests the column OID instead of the key
+        oids = dict((self._get_oid(key), key) for key in self.tables)
+        keys = [oids.get(str(key), key) for key in keys]
+        # only sysUpTime is requested as non-repeater
+        scalars = [('1.3.6.1.2.1.1.3.0', self.uptime)] * non_repeaters
+        keys = keys[non_repeaters:]
+        columns = [self.tables[key] for key in keys]
+        rows = max(len(column) for column in columns)
+        for r in range(rows):
+            varBinds = list(scalars)
+            for key, column in zip(keys, columns):
+                prefix = self._get_oid(key).lstrip('.') + '.'
+                if r < len(column):
+                    varBinds.append((prefix + column[r][0], column[r][1]))
+                else:
+                    varBinds.append((prefix + column[-1][0], cc.EndOfMibView()))
+            yield None, 0, 0, varBinds
+        yield None, 0, 0, scalars + [(self._get_oid(key).lstrip('.') + '.' + column[-1][0], cc.EndOfMibView())
+                                     for key, column in zip(keys, columns)]
+
+
+class FakeAgent(FakeAgentMixin, cc.AtenPDU):
+    pass
+
+
+def test_walk_table_drops_end_of_mib_view_row():
+    agent = FakeAgent({'displayOutletStatus': [(str(i), 2) for i in range(1, 10)]})
+    columns = agent._walk_table(['displayOutletStatus'])
+    assert [index for index, value in columns['displayOutletStatus']] == [str(i) for i in range(1, 10)]
+
+
+def test_walk_table_columns_of_different_length():
+    agent = FakeAgent({
+        'displayOutletStatus': [(str(i), 2) for i in range(1, 10)],
+        'outletName': [(str(i), 'outlet') for i in range(1, 6)],
+    })
+    columns = agent._walk_table(['displayOutletStatus', 'outletName'])
+    assert len(columns['displayOutletStatus']) == 9
+    assert len(columns['outletName']) == 5
+
+
+def test_walk_column_drops_end_of_mib_view_row():
+    agent = FakeAgent({'displayOutletStatus': [(str(i), 2) for i in range(1, 10)]})
+    assert len(list(agent._walk_column('displayOutletStatus'))) == 9
+
+
+def aten_tables(outlets):
+    tables = {}
+    for key in cc.AtenPDU.bulk_cmd_oids:
+        tables[key] = [(str(i), 2 if key == 'displayOutletStatus' else 1) for i in range(1, outlets + 1)]
+    return tables
+
+
+def test_aten_geometry_is_kept_between_refreshes():
+    agent = FakeAgent(aten_tables(9))
+    agent.refresh_status()
+    assert agent.geometry == {'outlets': [str(i) for i in range(1, 10)]}
+    assert len(agent.outlets) == 9
+    geometry = agent.geometry
+    agent.polled.pop('displayOutletStatus')
+    agent.refresh_status()
+    assert agent.geometry is geometry
+    assert agent._switch_oid(9)[-2:] == (10, 0)
+
+
+def test_walk_error_is_raised_not_printed(capsys):
+    agent = FakeAgent(aten_tables(4))
+    agent.refresh_status()
+    agent.failure = 'No SNMP response received before timeout'
+    agent.polled.clear()
+    with pytest.raises(IOError, match='No SNMP response'):
+        agent.refresh_status()
+    with pytest.raises(IOError):
+        list(agent._walk_column('displayOutletStatus'))
+    assert capsys.readouterr().out == ''
+    # the outlets of the last successful refresh are kept
+    assert len(agent.outlets) == 4
+
+
+class FakeSwitch(FakeAgentMixin, cc.PoEPSE):
+
+    def __init__(self, tables):
+        FakeAgentMixin.__init__(self, tables)
+        self.counter_columns = []
+        self.mac_index = {}
+        self.port_macs = {}
+        self.traffic = cc.TrafficCounters()
+
+
+def test_poe_ports_of_two_groups_are_matched_by_if_name():
+    # 2 PoE ports in each of 2 stack members, ifIndex 1-3 and 101-103, 3 is an uplink
+    if_indexes = [1, 2, 3, 101, 102, 103]
+    tables = {
+        'ifName': [(str(i), '%d/%d' % (i // 100 + 1, i % 100)) for i in if_indexes],
+        'pethPsePortAdminEnable': [(index, 1) for index in ['1.1', '1.2', '2.1', '2.2']],
+        'pethPsePortDetectionStatus': [(index, 3) for index in ['1.1', '1.2', '2.1', '2.2']],
+        'bridgePortIfIndex': [(str(i), i) for i in if_indexes],
+        'macAddresses': [('0.17.34.51.68.85', 102)],
+    }
+    for key in ['ifAlias', 'ifAdminStatus', 'ifOperStatus', 'ifMtu', 'ifJackType']:
+        tables[key] = [(str(i), 'port %d' % i if key == 'ifAlias' else 2) for i in if_indexes]
+    switch = FakeSwitch(tables)
+    switch.refresh_status()
+    assert switch.geometry['if_indexes'] == [1, 2, 101, 102]
+    assert [o['name'] for o in switch.outlets] == ['port 1', 'port 2', 'port 101', 'port 102']
+    assert switch.outlets[3]['mac_addrs'] == ['00:11:22:33:44:55']
+    assert switch._switch_oid(3)[-2:] == (2, 1)
+    # a trap for ifIndex 101 updates the third port
+    prefix = cc.PoEPSE.bulk_cmd_oids['ifAlias'].lstrip('.')
+    assert switch.apply_trap([(prefix + '.101', 'renamed')])
+    assert switch.outlets[2]['name'] == 'renamed'
+
+
+def free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def send_trap(port, trap_oid, varBinds):
+    hlapi = pytest.importorskip('pysnmp.hlapi')
+    varBinds = [hlapi.ObjectType(hlapi.ObjectIdentity('1.3.6.1.6.3.1.1.4.1.0'), hlapi.ObjectIdentifier(trap_oid))] + \
+               [hlapi.ObjectType(hlapi.ObjectIdentity(oid), hlapi.Integer(value)) for oid, value in varBinds]
+    errorIndication, errorStatus, errorIndex, varBinds = next(hlapi.sendNotification(
+        hlapi.SnmpEngine(), hlapi.CommunityData('public'), hlapi.UdpTransportTarget(('127.0.0.1', port)),
+        hlapi.ContextData(), 'trap', varBinds))
+    assert not errorIndication
+
+
+def test_traps_update_the_ports(monkeypatch):
+    pytest.importorskip('pysnmp.hlapi')
+    tables = {
+        'ifName': [(str(i), 'port %d' % i) for i in (1, 2)],
+        'pethPsePortAdminEnable': [('1.1', 2), ('1.2', 2)],
+        'pethPsePortDetectionStatus': [('1.1', 3), ('1.2', 3)],
+        'bridgePortIfIndex': [('1', 1), ('2', 2)],
+        'macAddresses': [('0.17.34.51.68.85', 1)],
+    }
+    for key in ['ifAlias', 'ifAdminStatus', 'ifOperStatus', 'ifMtu', 'ifJackType']:
+        tables[key] = [(str(i), 'port %d' % i if key == 'ifAlias' else 1) for i in (1, 2)]
+    switch = FakeSwitch(tables)
+    switch.cfg = {'host': '127.0.0.1', 'trap_community': 'public', 'user': 'user', 'authkey': 'authpassword',
+                  'privkey': 'privpassword', 'auth_protocol': 'MD5', 'priv_protocol': 'AES'}
+    switch.discovery = None
+    switch.refresh_status()
+    assert switch.outlets[1]['oper_status'] == 1
+
+    updated = threading.Event()
+    monkeypatch.setattr(cc.SnmpTrapReceiver, 'update_callbacks', [lambda device: updated.set()])
+    monkeypatch.setattr(cc.SnmpTrapReceiver, 'refresh_callbacks', [])
+    port = free_udp_port()
+    receiver = cc.SnmpTrapReceiver(port)
+    assert receiver.error is None
+    receiver.add_device(switch)
+    receiver.start()
+
+    # linkDown of ifIndex 2
+    send_trap(port, '1.3.6.1.6.3.1.1.5.3', [('1.3.6.1.2.1.2.2.1.1.2', 2), ('1.3.6.1.2.1.2.2.1.7.2', 2),
+                                            ('1.3.6.1.2.1.2.2.1.8.2', 2)])
+    assert updated.wait(5)
+    assert switch.background_errors == {}
+    assert switch.outlets[1]['oper_status'] == 2
+    assert switch.outlets[1]['admin_status'] == 2
+    assert switch.outlets[0]['oper_status'] == 1
+
+    # pethPsePortOnOffNotification of group 1, port 1
+    updated.clear()
+    send_trap(port, '1.3.6.1.2.1.105.0.1', [('1.3.6.1.2.1.105.1.1.1.6.1.1', 1)])
+    assert updated.wait(5)
+    assert switch.outlets[0]['poe_status'] == 'disabled'
+    receiver.snmpEngine.transportDispatcher.jobFinished(1)
+
+
+def test_trap_port_in_use_is_shown_on_the_device():
+    pytest.importorskip('pysnmp.hlapi')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', 0))
+    receiver = cc.SnmpTrapReceiver(sock.getsockname()[1])
+    switch = FakeSwitch({})
+    receiver.add_device(switch)
+    sock.close()
+    assert 'traps' in switch.background_errors
+
+
+def test_geometry_is_discovered_again_after_a_restart():
+    agent = FakeAgent(aten_tables(4))
+    agent.refresh_status()
+    agent.tables = aten_tables(6)
+    agent.uptime = 500
+    agent.geometry_checked = 0
+    agent.refresh_status()
+    assert len(agent.geometry['outlets']) == 6
+    assert len(agent.outlets) == 6
+
+
+class RequestTimedOut(object):
+    pass
+
+
+class UnknownEngineID(object):
+    pass
+
+
+def cached_engine_device(monkeypatch, tmp_path):
+    cache = cc.SnmpDiscoveryCache(str(tmp_path / 'engines.json'))
+    cache.put('agent', 161, b'\x80\x00\x1f\x88\x04agent', 1, 100)
+    monkeypatch.setattr(cc, 'snmp_discovery_cache', cache)
+    monkeypatch.setattr(cc.snmp_engine_pool, 'forget_engine', lambda discovery, transport: None)
+    device = FakeAgent({})
+    device.transport = None
+    device.discovery = cache.get('agent', 161)
+    device.discovery_confirmed = False
+    device._configure_user = lambda: setattr(device, 'discovery', cache.get('agent', 161))
+    return device, cache
+
+
+def test_timeouts_keep_a_confirmed_engine_entry(monkeypatch, tmp_path):
+    device, cache = cached_engine_device(monkeypatch, tmp_path)
+    cc.SNMPDevice._request_done(device, None)
+    for i in range(3):
+        cc.SNMPDevice._request_done(device, RequestTimedOut())
+    assert cache.get('agent', 161) is not None
+    cc.SNMPDevice._request_done(device, UnknownEngineID())
+    assert cache.get('agent', 161) is None
+
+
+def test_timeout_drops_an_unconfirmed_engine_entry(monkeypatch, tmp_path):
+    device, cache = cached_engine_device(monkeypatch, tmp_path)
+    cc.SNMPDevice._request_done(device, RequestTimedOut())
+    assert cache.get('agent', 161) is None
+
+
+def test_engine_pool_counts_each_device_once():
+    pytest.importorskip('pysnmp.hlapi')
+    pool = cc.SnmpEnginePool()
+    credentials = ('user', 'authpassword', 'privpassword', 'MD5', 'AES')
+    pool.get_user_data(*credentials, device=('pdu', 161))
+    # the same device after the discovery of the engine ID, and the trap receiver
+    pool.get_user_data(*credentials, engine_id=b'\x80\x00\x1f\x88\x04test', device=('pdu', 161))
+    pool.get_user_data(*credentials, engine_id=b'\x80\x00\x1f\x88\x04test')
+    pool.get_user_data(*credentials, device=('switch', 161))
+    assert pool.stats['devices'] == 2
+    assert pool.report().startswith('SNMP engine pool: 0 engines for 2 devices')
@@ -0,0 +1,87 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+def columns(octets_in, octets_out, errors_in, errors_out=None, discards=None):
+    '''
+    Counters of the ports in the order of TrafficCounters.counters
+    '''
+    ports = len(octets_in)
+    return [octets_in, octets_out, errors_in, errors_out or [0] * ports, discards or [0] * ports, [0] * ports]
+
+
+def test_first_walk_has_no_rates():
+    counters = cc.TrafficCounters()
+    assert counters.update(100, columns([1000], [2000], [0]), t=1.0) is False
+    assert counters.port_rates(0) == {'rx_bps': None, 'tx_bps': None, 'error_rate': None, 'discard_rate': None}
+    assert counters.get_history(0) == []
+
+
+def test_rates_per_second():
+    counters = cc.TrafficCounters()
+    counters.update(1000, columns([1000, 0], [0, 0], [5, 0], [1, 0], [2, 0]), t=10.0)
+    # 10 seconds of sysUpTime, the time of the walk only stamps the history
+    assert counters.update(2000, columns([11000, 0], [500, 0], [25, 0], [1, 0], [12, 0]), t=25.0) is True
+    assert counters.port_rates(0) == {'rx_bps': 8000.0, 'tx_bps': 400.0, 'error_rate': 2.0, 'discard_rate': 1.0}
+    assert counters.port_rates(1) == {'rx_bps': 0.0, 'tx_bps': 0.0, 'error_rate': 0.0, 'discard_rate': 0.0}
+    assert counters.port_rates(2)['rx_bps'] is None
+    assert counters.get_history(0, 'in') == [(25.0, 1000.0)]
+    assert counters.get_history(0, 'out') == [(25.0, 50.0)]
+
+
+def test_32_bit_counter_wraps():
+    counters = cc.TrafficCounters()
+    counters.update(0, columns([0], [0], [2 ** 32 - 10]), t=0.0)
+    counters.update(100, columns([0], [0], [20]), t=1.0)
+    assert counters.port_rates(0)['error_rate'] == 30.0
+
+
+def test_64_bit_counter_going_back_is_a_reset_of_the_port():
+    counters = cc.TrafficCounters()
+    counters.update(0, columns([5000, 5000], [5000, 5000], [10, 10]), t=0.0)
+    # port 0 was reset, its 32 bit counters started again too and would look like a wrap
+    counters.update(100, columns([100, 6000], [100, 5500], [0, 12]), t=1.0)
+    assert counters.port_rates(0) == {'rx_bps': None, 'tx_bps': None, 'error_rate': None, 'discard_rate': None}
+    assert counters.port_rates(1) == {'rx_bps': 8000.0, 'tx_bps': 4000.0, 'error_rate': 2.0, 'discard_rate': 0.0}
+    assert math.isnan(counters.get_history(0)[-1][1])
+    counters.update(200, columns([1100, 7000], [100, 5500], [0, 12]), t=2.0)
+    assert counters.port_rates(0)['rx_bps'] == 8000.0
+    assert counters.get_history(0)[-1] == (2.0, 1000.0)
+
+
+def test_sysuptime_going_back_is_a_restart_of_the_agent():
+    counters = cc.TrafficCounters()
+    counters.update(1000, columns([0], [0], [0]), t=0.0)
+    counters.update(1100, columns([1000], [0], [0]), t=1.0)
+    # the agent restarted or sysUpTime wrapped after 497 days
+    assert counters.update(50, columns([1200], [0], [3]), t=2.0) is False
+    assert counters.port_rates(0)['rx_bps'] is None
+    history = counters.get_history(0)
+    assert history[0] == (1.0, 1000.0)
+    assert history[1][0] == 2.0 and math.isnan(history[1][1])
+    assert counters.update(150, columns([2200], [0], [3]), t=3.0) is True
+    assert counters.port_rates(0)['rx_bps'] == 8000.0
+    # the same sysUpTime twice, e.g. a cached answer, gives no rates either
+    assert counters.update(150, columns([2200], [0], [3]), t=4.0) is False
+
+
+def test_reset_adds_one_gap():
+    counters = cc.TrafficCounters()
+    counters.update(0, columns([0], [0], [0]), t=0.0)
+    counters.update(100, columns([100], [0], [0]), t=1.0)
+    counters.reset(2.0)
+    counters.reset(3.0)
+    assert len(counters.get_history(0)) == 2
+    assert counters.port_rates(0)['rx_bps'] is None
+
+
+def test_history_is_bounded():
+    counters = cc.TrafficCounters(history_size=3)
+    for n in range(6):
+        counters.update(100 * n, columns([1000 * n], [0], [0]), t=float(n))
+    assert counters.get_history(0, since=2.0) == [(3.0, 1000.0), (4.0, 1000.0), (5.0, 1000.0)]
+    assert len(counters.get_history(0)) == 3
@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import currentcommander as cc
+
+
+def outlets(count):
+    return [cc.Outlet({'name': 'port %d' % (i + 1), 'state': i % 2}) for i in range(count)]
+
+
+def render(view):
+    return view.render((80, 10), focus=True)
+
+
+def test_focus_is_clamped_when_the_outlets_shrink():
+    view = cc.ListView()
+    data = outlets(20)
+    view.set_data(data)
+    view.lb.set_focus(12)
+    render(view)
+    del data[5:]
+    assert view.set_data(data) is False
+    render(view)
+    assert view.walker.focus == 4
+    assert all(position < 5 for position in view.walker.widgets)
+
+
+def test_rows_of_replaced_outlets_are_created_again():
+    view = cc.ListView()
+    data = outlets(8)
+    view.set_data(data)
+    render(view)
+    # shrunk and grown again between two updates, e.g. after a rediscovery
+    del data[3:]
+    data.extend(outlets(8)[3:])
+    data[5].update({'name': 'new'})
+    view.set_data(data)
+    render(view)
+    assert view.walker[5].data is data[5]
+    assert 'new' in view.walker[5].text
+
+
+def test_changed_outlet_updates_its_row_only():
+    view = cc.ListView()
+    data = outlets(8)
+    view.set_data(data)
+    render(view)
+    row = view.walker[2]
+    data[2].update({'name': 'renamed'})
+    view.set_data(data)
+    assert view.walker[2] is row
+    assert 'renamed' in row.text
+    assert not data[2].is_changed()